@@ -0,0 +1,149 @@
+from __future__ import print_function
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import functools
+import sys
+import time
+
+sys.path.append('.')
+from batch_client import BatchClient
+from job_monitor import JobMonitor
+import stage_timer
+
+# An asyncio variant of BatchClient which overlaps the control-plane I/O of
+# a run, rather than doing each step after the previous one finishes.
+#
+# The Azure SDK calls are blocking, so each step runs on a thread of a small
+# executor, and asyncio orders the steps by what they actually depend on:
+#
+#   upload task files --> create pool --> create job --> add tasks
+#   resolve node image -------^                            ^   monitor tasks
+#   upload input files ------------------------------------+
+#
+# Unless --pipeline n, a task is added for each input as its upload
+# completes, as in BatchClient.  Tasks are monitored while they are still
+# being submitted, and run() yields each task as it completes.  The subclass hooks are those of BatchClient
+# (set_pool_os_and_size, generate_tasks, add_tasks, on_task_completed, ...),
+# so an existing client is ported with async_variant(StatesBatchClient).
+
+DEFAULT_WORKERS = 8
+
+
+class AsyncBatchClient(BatchClient):
+
+    def execute_steps(self, create_pool=True):
+        asyncio.run(self.execute_async(create_pool))
+
+    async def execute_async(self, create_pool=True):
+        async for task in self.run(create_pool):
+            pass  # each completion has already been passed to on_task_completed
+
+    async def run(self, create_pool=True):
+        """
+        Run the job, yielding each task as it completes; on_task_completed is
+        called first.  Callers which consume the completions themselves use
+        this rather than execute().
+        """
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=int(getattr(self.args, 'asyncworkers', DEFAULT_WORKERS)))
+        try:
+            timeout_minutes = int(self.args.timeout)
+            if self.RESUME_JOB_ID and await self.in_thread(self.resume, self.RESUME_JOB_ID):
+                # reattached to the previous job, which is still running
+                with self.stages.stage('monitor tasks'):
+                    async for task in self.monitor_tasks(timeout_minutes):
+                        yield task
+                await self.timed('collect output', self.capture_stdout_stderr_streams)
+                return
+
+            steps = [self.provision_pool(create_pool and not self.resumed_pool)]
+            if self.PIPELINE and len(self.local_input_files) > 0:
+                self.start_input_upload(self.args.cin, self.local_input_files)  # on its own thread
+            else:
+                steps.append(self.timed(
+                    'upload input files', self.upload_local_input_files, self.args.cin, self.local_input_files))
+            await asyncio.gather(*steps)
+            await self.timed('create job', self.create_job)
+
+            submission = asyncio.ensure_future(self.timed('add tasks', self.submit_all_tasks))
+            try:
+                with self.stages.stage('monitor tasks'):
+                    async for task in self.monitor_tasks(timeout_minutes, submission):
+                        yield task
+            finally:
+                if not submission.done():
+                    submission.cancel()
+            await self.timed('collect output', self.capture_stdout_stderr_streams)
+        finally:
+            self.executor.shutdown(wait=False)
+
+    def submit_all_tasks(self):
+        # the tasks of the inputs uploaded so far, then of each pipelined upload as it completes
+        results = self.add_tasks()
+        self.wait_for_input_upload()
+        return results
+
+    def in_thread(self, func, *args):
+        # a future of func(*args), run on the executor
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, stage_timer.propagate(functools.partial(func, *args)))
+
+    def timed(self, stage, func, *args):
+        # the stage's span is opened on the executor thread, so the calls made there count toward it
+        return self.in_thread(self.stages.timed, stage, func, *args)
+
+    async def provision_pool(self, create_pool=True):
+        # the start task needs the task files; the node image is resolved while they upload
+        task_upload = asyncio.ensure_future(
+            self.timed('upload task files', self.upload_task_files, self.args.ctask, self.local_task_files))
+        if create_pool:
+            await self.timed(
+                'resolve image', self.select_latest_verified_vm_image_with_node_agent_sku,
+                self.batch_client, self.NODE_OS_PUBLISHER, self.NODE_OS_OFFER, self.NODE_OS_SKU)
+        await task_upload
+        if create_pool:
+            await self.timed('create pool', self.create_pool)  # the image is now a cache hit
+
+    async def monitor_tasks(self, timeout_minutes, submission=None):
+        """
+        JobMonitor.poll on the executor, with the waits between polls on the
+        event loop.  While the submission is running the job is never
+        considered complete, the interval does not back off, and a poll
+        follows as soon as it finishes.
+        """
+        timeout = datetime.timedelta(minutes=timeout_minutes)
+        print("Monitoring all tasks for 'Completed' state, timeout in {}...".format(timeout))
+        completed = collections.deque()
+
+        def task_completed(task):
+            # called on the executor thread which fetched the task
+            self.on_task_completed(task)
+            completed.append(task)
+
+        monitor = JobMonitor(self.batch_client, self.JOB_ID, on_task_completed=task_completed)
+        expiration = time.time() + timeout.total_seconds()
+        done = False
+        while not done and time.time() < expiration:
+            submitting = submission is not None and not submission.done()
+            done = await self.in_thread(monitor.poll, submitting)
+            while completed:
+                yield completed.popleft()
+            if submission is not None and submission.done():
+                submission.result()  # re-raises a failed submission
+            if not done:
+                sleep_seconds = max(0.0, min(monitor.interval, expiration - time.time()))
+                monitor.counters['sleep_seconds'] += sleep_seconds
+                if submitting:
+                    await asyncio.wait([submission], timeout=sleep_seconds)
+                else:
+                    await asyncio.sleep(sleep_seconds)
+        monitor.print_report()
+        if not done:
+            print("ERROR: Tasks did not reach 'Completed' state within timeout period of " + str(timeout))
+
+
+def async_variant(client_class):
+    # e.g. async_variant(StatesBatchClient); AsyncBatchClient precedes the subclass in the mro
+    return type('Async' + client_class.__name__, (AsyncBatchClient, client_class), dict())
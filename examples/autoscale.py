@@ -0,0 +1,186 @@
+from __future__ import print_function
+import argparse
+import csv
+import math
+import re
+
+# Autoscale formulas for Batch pools, driven by the pending task backlog,
+# and an offline evaluator which replays a recorded backlog curve through
+# the same rules to show the node counts the formula would have chosen.
+#
+# $PendingTasks is the service's count of active plus running tasks.  The
+# formula sizes the pool to that backlog, bounded by min_nodes and max_nodes,
+# and only scales down once the backlog has stayed low for the grace period.
+# An optional share of the nodes may be low-priority nodes.  The formula's
+# arithmetic is floating point, so node counts are rounded with ceil() and
+# floor(), as target_nodes rounds them, and the replay matches the service.
+#
+# python autoscale.py --func formula --minnodes 0 --maxnodes 20 --lowpriorityshare 0.5
+# python autoscale.py --func replay --curve data/backlog.csv --maxnodes 20
+# python autoscale.py --func replay --maxnodes 20    (uses a synthetic backlog curve)
+
+EVALUATION_INTERVAL_MINUTES = 5  # the service minimum
+
+FORMULA_TEMPLATE = """\
+$latest = max($PendingTasks.GetSample(1));
+$coverage = $PendingTasks.GetSamplePercent(TimeInterval_Minute * {grace_minutes});
+$recent = $coverage < {min_coverage} ? $latest : max($PendingTasks.GetSample(TimeInterval_Minute * {grace_minutes}));
+$demand = max($latest, $recent);
+$nodes = min({max_nodes}, max({min_nodes}, ceil($demand / {tasks_per_node})));
+$lowpri = floor($nodes * {low_priority_share});
+$TargetLowPriorityNodes = $lowpri;
+$TargetDedicatedNodes = max({min_dedicated}, $nodes - $lowpri);
+$NodeDeallocationOption = taskcompletion;"""
+
+KNOWN_VARIABLES = [
+    '$PendingTasks', '$TargetDedicatedNodes', '$TargetLowPriorityNodes', '$NodeDeallocationOption']
+
+
+class AutoscaleSettings(object):
+
+    def __init__(self, min_nodes=0, max_nodes=10, tasks_per_node=1, grace_minutes=10,
+                 low_priority_share=0.0, min_coverage=70):
+        self.min_nodes = int(min_nodes)
+        self.max_nodes = int(max_nodes)
+        self.tasks_per_node = max(1, int(tasks_per_node))  # concurrent tasks per node
+        self.grace_minutes = int(grace_minutes)            # scale-down grace period
+        self.low_priority_share = float(low_priority_share)
+        self.min_coverage = int(min_coverage)              # sample percentage needed to trust the history
+        self.validate()
+
+    def validate(self):
+        if self.min_nodes < 0 or self.max_nodes < self.min_nodes:
+            raise ValueError('invalid node bounds: min {} max {}'.format(self.min_nodes, self.max_nodes))
+        if not 0.0 <= self.low_priority_share <= 1.0:
+            raise ValueError('low_priority_share must be between 0 and 1: {}'.format(self.low_priority_share))
+        if self.grace_minutes < 0:
+            raise ValueError('grace_minutes must not be negative: {}'.format(self.grace_minutes))
+
+    def min_dedicated(self):
+        # the dedicated nodes kept even when the pool is otherwise at min_nodes
+        return int(self.min_nodes * (1.0 - self.low_priority_share))
+
+    def formula(self):
+        text = FORMULA_TEMPLATE.format(
+            min_nodes=self.min_nodes,
+            max_nodes=self.max_nodes,
+            tasks_per_node=self.tasks_per_node,
+            grace_minutes=self.grace_minutes,
+            low_priority_share=self.low_priority_share,
+            min_coverage=self.min_coverage,
+            min_dedicated=self.min_dedicated())
+        validate_formula(text)
+        return text
+
+    def target_nodes(self, latest, recent):
+        # python equivalent of the formula; returns (dedicated, low-priority)
+        demand = max(latest, recent)
+        nodes = min(self.max_nodes, max(self.min_nodes, int(math.ceil(float(demand) / self.tasks_per_node))))
+        lowpri = int(math.floor(nodes * self.low_priority_share))
+        return max(self.min_dedicated(), nodes - lowpri), lowpri
+
+
+def validate_formula(text):
+    """
+    Local syntax checks before the formula is sent to the service: balanced
+    parentheses, one assignment per statement, and only known service
+    variables.  The service performs the full validation on pool.add and
+    pool.evaluate_auto_scale.
+    """
+    if text.count('(') != text.count(')'):
+        raise ValueError('unbalanced parentheses in autoscale formula')
+    statements = [s.strip() for s in text.split(';') if s.strip()]
+    if not text.strip().endswith(';'):
+        raise ValueError('autoscale formula must end with a semicolon')
+    assigned = set()
+    for statement in statements:
+        if '=' not in statement.replace('==', '').replace('<=', '').replace('>=', '').replace('!=', ''):
+            raise ValueError('statement is not an assignment: {}'.format(statement))
+        name = statement.split('=')[0].strip()
+        assigned.add(name)
+        for variable in re.findall(r'\$[A-Za-z]+', statement):
+            if variable not in assigned and variable not in KNOWN_VARIABLES:
+                raise ValueError('unknown variable {} in: {}'.format(variable, statement))
+    return True
+
+def evaluate_on_pool(batch_client, pool_id, formula):
+    # asks the service to evaluate the formula against an existing pool, without applying it
+    run = batch_client.pool.evaluate_auto_scale(pool_id, formula)
+    if run.error:
+        raise ValueError('autoscale evaluation failed: {} {}'.format(run.error.code, run.error.message))
+    return run.results
+
+def replay(settings, curve, interval_minutes=EVALUATION_INTERVAL_MINUTES):
+    """
+    Replay a backlog curve, a list of (minute, pending_tasks) samples in
+    minute order, through the formula rules.  Returns a list of
+    (minute, pending, dedicated, low_priority) at each evaluation.
+    """
+    timeline = list()
+    if not curve:
+        return timeline
+    last_minute = curve[-1][0]
+    minute = 0
+    while minute <= last_minute:
+        samples = [p for m, p in curve if m <= minute]
+        latest = samples[-1] if samples else 0
+        window = [p for m, p in curve if minute - settings.grace_minutes < m <= minute]
+        coverage = 100.0 * len(window) / max(1, settings.grace_minutes)
+        recent = max(window) if window and coverage >= settings.min_coverage else latest
+        dedicated, lowpri = settings.target_nodes(latest, recent)
+        timeline.append((minute, latest, dedicated, lowpri))
+        minute += interval_minutes
+    return timeline
+
+def read_curve(csv_file):
+    # csv rows of minute,pending_tasks; a header row is optional
+    curve = list()
+    with open(csv_file, 'rt') as f:
+        for row in csv.reader(f):
+            if row and row[0].strip().isdigit():
+                curve.append((int(row[0]), int(row[1])))
+    return sorted(curve)
+
+def synthetic_curve():
+    # a burst of 400 tasks drained by the pool, a quiet hour, then a smaller burst
+    curve, pending = list(), 0
+    for minute in range(0, 180):
+        if minute == 5:
+            pending += 400
+        if minute == 120:
+            pending += 120
+        pending = max(0, pending - 6)
+        curve.append((minute, pending))
+    return curve
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--func',             required=True,  help='formula or replay')
+    parser.add_argument('--minnodes',         required=False, help='Minimum node count', default='0')
+    parser.add_argument('--maxnodes',         required=False, help='Maximum node count', default='10')
+    parser.add_argument('--taskspernode',     required=False, help='Concurrent tasks per node', default='1')
+    parser.add_argument('--grace',            required=False, help='Scale-down grace period in minutes', default='10')
+    parser.add_argument('--lowpriorityshare', required=False, help='Fraction of nodes which may be low-priority', default='0')
+    parser.add_argument('--curve',            required=False, help='CSV file of minute,pending_tasks samples')
+    args = parser.parse_args()
+
+    settings = AutoscaleSettings(
+        args.minnodes, args.maxnodes, args.taskspernode, args.grace, args.lowpriorityshare)
+
+    if args.func == 'formula':
+        print(settings.formula())
+
+    elif args.func == 'replay':
+        curve = read_curve(args.curve) if args.curve else synthetic_curve()
+        print('{:>6} {:>8} {:>9} {:>7}'.format('minute', 'pending', 'dedicated', 'lowpri'))
+        node_minutes = 0
+        for minute, pending, dedicated, lowpri in replay(settings, curve):
+            print('{:>6} {:>8} {:>9} {:>7}'.format(minute, pending, dedicated, lowpri))
+            node_minutes += (dedicated + lowpri) * EVALUATION_INTERVAL_MINUTES
+        fixed_minutes = settings.max_nodes * (curve[-1][0] + EVALUATION_INTERVAL_MINUTES)
+        print('node-minutes: {} autoscaled vs {} fixed at {} nodes'.format(
+            node_minutes, fixed_minutes, settings.max_nodes))
+
+    else:
+        print('invalid function: {}'.format(args.func))
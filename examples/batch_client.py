@@ -1,10 +1,11 @@
 from __future__ import print_function
 import argparse
 import datetime
-import io
 import json
 import os
+import queue
 import sys
+import threading
 import time
 
 import azure.storage.blob as azureblob
@@ -14,9 +15,26 @@ import azure.batch.models as batchmodels
 
 sys.path.append('.')
 sys.path.append('..')
+from upload_cache import UploadCache, file_md5
+from autoscale import AutoscaleSettings, EVALUATION_INTERVAL_MINUTES
+from download_engine import ParallelDownloader
+import image_resolver
+import job_manifest
+from job_monitor import JobMonitor
+import node_slots
+from retry_policy import RetryPolicy, first_listed, unwrapped
+import stage_timer
+from pool_manager import PoolManager, pool_fingerprint
+from task_output import TaskOutputCollector
+import task_packing
+from task_submitter import TaskSubmitter
+from upload_engine import ParallelUploader
+import wheelhouse
 
 STANDARD_OUT_FILE_NAME = 'stdout.txt'
 STANDARD_ERR_FILE_NAME = 'stderr.txt'
+NODE_WORKER_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'node_worker.py')
+FIRST_NODE_POLL_SECONDS = 5
 
 # Reusable superclass for submitting Azure Batch jobs.
 # Class BatchClient may be used "as is", or extended/inherited.
@@ -45,50 +63,244 @@ class BatchClient(object):
             self.TASK_FILE         = args.task
             self.JOB_ID            = '{}-{}'.format(args.job, self.epoch).lower()
             self.JOB_CONTAINER     = 'job-' + self.JOB_ID.lower()
+            self.UPLOAD_CONCURRENCY = int(getattr(args, 'uploadconcurrency', 8))
+            self.SUBMIT_CONCURRENCY = int(getattr(args, 'submitconcurrency', 4))
+            self.OUTPUT_CONCURRENCY = int(getattr(args, 'outputconcurrency', 8))
+            self.OUTPUT_TAIL_KB     = getattr(args, 'outputtailkb', None)
+            self.DOWNLOAD_CONCURRENCY = int(getattr(args, 'downloadconcurrency', 8))
+            self.PACK_KB            = int(getattr(args, 'packkb', 0) or 0)
+            self.PACK_SECONDS       = float(getattr(args, 'packseconds', 0) or 0)
+            self.REUSE_POOL        = str(getattr(args, 'reusepool', 'n')).lower() == 'y'
+            self.POOL_IDLE_TTL     = int(getattr(args, 'poolidlettl', 30))  # minutes
+            self.pool_manager      = None
+            self.CHECKPOINT        = str(getattr(args, 'checkpoint', 'y')).lower() == 'y'
+            self.RESUME_JOB_ID     = getattr(args, 'resume', None)
+            self.PIPELINE          = str(getattr(args, 'pipeline', 'y')).lower() == 'y'
+            self.NODE_WORKER       = str(getattr(args, 'nodeworker', 'n')).lower() == 'y'
+            if self.NODE_WORKER:
+                self.add_task_file(NODE_WORKER_FILE)
+            self.uploaded_inputs   = None  # while pipelined input uploads are pending, a queue of their ResourceFiles
+            self.input_upload_error = None
+            self.stages            = stage_timer.StageTimer()
+            self.SPANS_FILE        = getattr(args, 'spansfile', None) or stage_timer.DEFAULT_SPANS_FILE
+            self.first_node_stop   = None
+            self.first_node_thread = None
+            self.manifest          = None
+            self.resumed_pool      = False
+            self.WHEELHOUSE        = str(getattr(args, 'wheelhouse', 'n')).lower() == 'y'
+            self.wheelhouse        = None
+            self.pool_leased       = False
+            self.autoscale         = None
+            if str(getattr(args, 'autoscale', 'n')).lower() == 'y':
+                self.autoscale = AutoscaleSettings(
+                    min_nodes=getattr(args, 'minnodes', 0),
+                    max_nodes=getattr(args, 'maxnodes', None) or self.POOL_NODE_COUNT,
+                    grace_minutes=getattr(args, 'scaledowngrace', 10),
+                    low_priority_share=getattr(args, 'lowpriorityshare', 0.0))
+            self.upload_cache      = None
+            if str(getattr(args, 'uploadcache', 'y')).lower() == 'y':
+                self.upload_cache  = UploadCache()
+            self.retry_policy      = RetryPolicy(max_attempts=getattr(args, 'maxattempts', 6))
+            self.retry_policy.on_call = stage_timer.record_call
             self.set_pool_os_and_size()
+            self.configure_task_slots()
             self.create_blob_client()
             self.create_batch_service_client()
-            self.create_container(args.job)
-            self.create_container(args.ctask)
-            self.create_container(args.cin)
-            self.create_container(args.cout)
+            with self.stages.stage('create containers'):
+                self.create_container(args.job)
+                self.create_container(args.ctask)
+                self.create_container(args.cin)
+                self.create_container(args.cout)
         except:
             print("Unexpected error in BatchClient constructor: ", sys.exc_info()[0])
 
     def execute(self, create_pool=True):
         try:
-            timeout_minutes = int(self.args.timeout)
+            self.execute_steps(create_pool)
+
+        except batchmodels.batch_error.BatchErrorException as err:
+            self.print_batch_exception(err)
+            raise
+        except Exception:
+            print(sys.exc_info()[1])
+        finally:
+            if self.manifest:
+                self.checkpoint()
+                self.manifest.print_report()
+            self.stop_watching_nodes()
+            self.retry_policy.print_report()
+            self.stages.print_report()
+            self.save_spans()
+
+    def execute_steps(self, create_pool=True):
+        """
+        Unless --pipeline n, the pool and job are created as soon as the task
+        files are staged, while the local input files upload in the
+        background, and a task is generated for each input as its upload
+        completes.  AsyncBatchClient overlaps the steps with asyncio instead,
+        see async_batch_client.py.
+        """
+        timeout_minutes = int(self.args.timeout)
+        if self.RESUME_JOB_ID and self.resume(self.RESUME_JOB_ID):
+            # reattached to the previous job, which is still running
+            with self.stages.stage('monitor tasks'):
+                self.execute_tasks(timeout_minutes)
+            with self.stages.stage('collect output'):
+                self.capture_stdout_stderr_streams()
+            return
+        with self.stages.stage('upload task files'):
             self.upload_task_files(self.args.ctask, self.local_task_files)
-            self.upload_local_input_files(self.args.cin, self.local_input_files)
-            if create_pool:
+        if self.PIPELINE and len(self.local_input_files) > 0:
+            self.start_input_upload(self.args.cin, self.local_input_files)
+        else:
+            with self.stages.stage('upload input files'):
+                self.upload_local_input_files(self.args.cin, self.local_input_files)
+        if create_pool and not self.resumed_pool:
+            with self.stages.stage('create pool'):
                 self.create_pool()
+        with self.stages.stage('create job'):
             self.create_job()
+        with self.stages.stage('add tasks'):
             self.add_tasks()
+            self.wait_for_input_upload()
+        with self.stages.stage('monitor tasks'):
             self.execute_tasks(timeout_minutes)
+        with self.stages.stage('collect output'):
             self.capture_stdout_stderr_streams()
 
+    def start_input_upload(self, container, file_paths):
+        # uploads on a background thread; each ResourceFile is queued as its upload completes, then None
+        self.uploaded_inputs = queue.Queue()
+        self.input_upload_error = None
+        uploader = self.create_uploader()
+
+        def on_complete(result):
+            if result.succeeded():
+                self.uploaded_inputs.put(result.value)
+
+        def upload():
+            with self.stages.stage('upload input files'):
+                try:
+                    uploader.upload(container, file_paths, on_complete)
+                    self.save_upload_cache()
+                except Exception as e:
+                    self.input_upload_error = e
+                finally:
+                    self.uploaded_inputs.put(None)
+
+        thread = threading.Thread(target=upload, name='input-upload')
+        thread.daemon = True
+        thread.start()
+
+    def uploaded_input_files(self):
+        # the pipelined uploads as they complete; each is added to blob_input_files and the job manifest
+        while self.uploaded_inputs is not None:
+            input_file = self.uploaded_inputs.get()
+            if input_file is None:
+                self.uploaded_inputs = None
+                break
+            self.blob_input_files.append(input_file)
+            if self.manifest:
+                self.manifest.add_input(self.input_name(input_file))
+            yield input_file
+        if self.input_upload_error:
+            error, self.input_upload_error = self.input_upload_error, None
+            raise error
+
+    def wait_for_input_upload(self):
+        # subclasses which use blob_input_files directly, rather than input_groups, call this first
+        for input_file in self.uploaded_input_files():
+            pass
+
+    def resume(self, previous_job_id):
+        """
+        Resume a previous run from its job manifest.  If the previous job is
+        still running, reattach to it and return True.  Otherwise drop the
+        inputs which already completed, so that the new job runs only the
+        failed and unfinished inputs, and return False.
+        """
+        previous = job_manifest.load(previous_job_id, self.blob_client)
+        if previous is None:
+            raise ValueError('no job manifest for job {}'.format(previous_job_id))
+        previous.print_report()
+
+        if previous.has_unfinished_tasks() and self.job_is_active(previous_job_id):
+            print('reattaching to job {} on pool {}'.format(previous_job_id, previous.pool_id))
+            self.JOB_ID = previous_job_id
+            self.JOB_CONTAINER = job_manifest.job_container_name(previous_job_id)
+            self.POOL_ID = previous.pool_id
+            self.manifest = previous
+            return True
+
+        self.blob_input_files = [f for f in self.blob_input_files if previous.needs_run(self.input_name(f))]
+        self.local_input_files = [f for f in self.local_input_files if previous.needs_run(os.path.basename(f))]
+        print('resuming job {} as {} with {} inputs which did not complete'.format(
+            previous_job_id, self.JOB_ID, len(self.blob_input_files) + len(self.local_input_files)))
+        if not self.REUSE_POOL and previous.pool_id and self.pool_is_active(previous.pool_id):
+            # warm pools are reacquired by create_pool; otherwise run on the previous job's pool
+            self.POOL_ID = previous.pool_id
+            self.resumed_pool = True
+        self.manifest = previous.start_job(self.JOB_ID, self.POOL_ID)
+        return False
+
+    def job_is_active(self, job_id):
+        try:
+            job = self.batch_client.job.get(job_id, job_get_options=batchmodels.JobGetOptions(select='id,state'))
         except batchmodels.batch_error.BatchErrorException as err:
-            self.print_batch_exception(err)
+            if err.error and err.error.code == 'JobNotFound':
+                return False
             raise
-        except Exception:
-            print(sys.exc_info()[1])
+        return job.state == batchmodels.JobState.active
+
+    def pool_is_active(self, pool_id):
+        try:
+            pool = self.batch_client.pool.get(pool_id, pool_get_options=batchmodels.PoolGetOptions(select='id,state'))
+        except batchmodels.batch_error.BatchErrorException as err:
+            if err.error and err.error.code == 'PoolNotFound':
+                return False
+            raise
+        return pool.state == batchmodels.PoolState.active
+
+    def input_name(self, input_file):
+        # the blob name of a listed Blob, or the file path of an uploaded ResourceFile
+        return getattr(input_file, 'name', None) or input_file.file_path
+
+    def checkpoint(self, force=True):
+        # saves the job manifest locally, and mirrors it to the job container
+        if not self.CHECKPOINT or self.manifest is None:
+            return
+        if force or self.manifest.save_due():
+            self.manifest.save()
+            try:
+                self.manifest.mirror(self.blob_client, self.JOB_CONTAINER)
+            except Exception as e:
+                print('unable to mirror the job manifest to {}: {}'.format(self.JOB_CONTAINER, e))
+
+    def save_spans(self):
+        # one line of JSON per span, appended to SPANS_FILE, to compare runs
+        try:
+            self.stages.save(self.SPANS_FILE, job_id=self.JOB_ID, pool_id=self.POOL_ID,
+                             client=type(self).__name__, epoch=self.epoch)
+        except Exception as e:
+            print('unable to save the spans to {}: {}'.format(self.SPANS_FILE, e))
 
     def submit_job(self):
         self.execute(False)
 
     def create_blob_client(self):
-        self.blob_client = azureblob.BlockBlobService(
+        # service calls are retried on throttling and transient errors; see retry_policy.py
+        self.blob_client = self.retry_policy.wrap(azureblob.BlockBlobService(
             account_name=self.STORAGE_ACCOUNT_NAME,
-            account_key=self.STORAGE_ACCOUNT_KEY)
+            account_key=self.STORAGE_ACCOUNT_KEY), 'blob')
         return self.blob_client
 
     def create_batch_service_client(self):
         credentials = batchauth.SharedKeyCredentials(
             self.BATCH_ACCOUNT_NAME,
             self.BATCH_ACCOUNT_KEY)
-        self.batch_client = batch.BatchServiceClient(
+        self.batch_client = self.retry_policy.wrap(batch.BatchServiceClient(
             credentials,
-            base_url=self.BATCH_ACCOUNT_URL)
+            base_url=self.BATCH_ACCOUNT_URL))
         return self.batch_client
 
     def add_task_file(self, file_path):
@@ -106,6 +318,12 @@ class BatchClient(object):
     def blob_input_file_count(self):
         return len(self.blob_input_files)
 
+    def input_file_count(self):
+        # including the local input files whose pipelined upload is still pending
+        if self.uploaded_inputs is not None:
+            return len(self.blob_input_files) + len(self.local_input_files)
+        return len(self.blob_input_files)
+
     def query_yes_no(self, question, default="yes"):
         valid = {'y': 'yes', 'n': 'no'}
         if default is None:
@@ -126,35 +344,61 @@ class BatchClient(object):
             except (KeyError, IndexError):
                 print("Please respond with 'yes' or 'no' (or 'y' or 'n').\n")
 
+    def create_uploader(self):
+        # the blob calls of upload_file_to_container are retried by the retry policy, not again by the uploader
+        return ParallelUploader(
+            self.upload_file_to_container,
+            concurrency=self.UPLOAD_CONCURRENCY,
+            max_attempts=1)
+
     def upload_task_files(self, container, file_paths):
         if len(file_paths) > 0:
-            for file_path in file_paths:
-                f = self.upload_file_to_container(container, file_path)
-                self.blob_task_files.append(f)
+            uploader = self.create_uploader()
+            self.blob_task_files.extend(uploader.upload(container, file_paths))
+            self.save_upload_cache()
         else:
             print('no task files to upload!')
 
     def upload_local_input_files(self, container, file_paths):
         if len(file_paths) > 0:
-            for file_path in file_paths:
-                f = self.upload_file_to_container(container, file_path)
-                self.blob_input_files.append(f)
+            uploader = self.create_uploader()
+            self.blob_input_files.extend(uploader.upload(container, file_paths))
+            self.save_upload_cache()
         else:
             print('no input files specified for upload')
 
+    def save_upload_cache(self):
+        if self.upload_cache:
+            self.upload_cache.save()
+            self.upload_cache.report()
+
     def upload_file_to_container(self, container_name, file_path):
         blob_name = os.path.basename(file_path)
-        print('Uploading file "{}" to container "{}"...'.format(file_path, container_name))
-
-        self.blob_client.create_blob_from_path(
-            container_name,
-            blob_name,
-            file_path)
-
+        with self.stages.stage('upload', blob=blob_name, container=container_name) as span:
+            cached = None
+            if self.upload_cache:
+                cached = self.upload_cache.lookup(self.blob_client, container_name, file_path, blob_name)
+            span.attrs['cached'] = bool(cached)
+
+            if cached:
+                print('Unchanged file "{}" already in container "{}"'.format(file_path, container_name))
+            else:
+                print('Uploading file "{}" to container "{}"...'.format(file_path, container_name))
+                props = self.blob_client.create_blob_from_path(
+                    container_name,
+                    blob_name,
+                    file_path)
+                stage_timer.record_bytes(os.path.getsize(file_path))
+                if self.upload_cache:
+                    self.upload_cache.record(container_name, file_path, blob_name, props.etag)
+
+        return self.blob_resource_file(container_name, blob_name)
+
+    def blob_resource_file(self, container_name, blob_name, permission=azureblob.BlobPermissions.READ):
         sas_token = self.blob_client.generate_blob_shared_access_signature(
             container_name,
             blob_name,
-            permission=azureblob.BlobPermissions.READ,
+            permission=permission,
             expiry=datetime.datetime.utcnow() + datetime.timedelta(hours=2))
 
         sas_url = self.blob_client.make_blob_url(
@@ -183,25 +427,118 @@ class BatchClient(object):
         # Other sizes: Basic_A4, Standard_DS3_v2, Standard_DS2_v2, etc
         # see list_vm_sizes.sh
 
+    def task_profile(self):
+        # subclasses can override this method; the cores and memory one task uses
+        return node_slots.TaskProfile(cores=1, memory_mb=512)
+
+    def configure_task_slots(self):
+        # the concurrent tasks per node, from the VM size and task profile unless given explicitly
+        task_slots = str(getattr(self.args, 'taskslots', 'auto')).lower()
+        if task_slots == 'auto':
+            self.TASK_SLOTS, reason = node_slots.slots_per_node(self.POOL_VM_SIZE, self.task_profile())
+        else:
+            self.TASK_SLOTS, reason = max(1, int(task_slots)), 'given'
+        node_fill = str(getattr(self.args, 'nodefill', 'auto')).lower()
+        if node_fill == 'auto':
+            node_fill = node_slots.node_fill_type(self.autoscale is not None)
+        if node_fill not in [node_slots.FILL_SPREAD, node_slots.FILL_PACK]:
+            raise ValueError('invalid nodefill: {}'.format(node_fill))
+        self.NODE_FILL_TYPE = node_fill
+        if self.autoscale:
+            self.autoscale.tasks_per_node = self.TASK_SLOTS
+        print('task slots: {} per {} node ({}), {} fill'.format(
+            self.TASK_SLOTS, self.POOL_VM_SIZE, reason, self.NODE_FILL_TYPE))
+
     def use_windows_server(self):
         pass  # implement similarly to 'use_canonical_ubuntu'
 
+    def start_task_commands(self):
+        commands = ['cp -p {} $AZ_BATCH_NODE_SHARED_DIR'.format(self.TASK_FILE)]
+        for file_path in self.local_task_files:
+            # the modules the task script imports, e.g. cosmos_bulk.py, and node_worker.py
+            name = os.path.basename(file_path)
+            if name != os.path.basename(self.TASK_FILE):
+                commands.append('cp -p {} $AZ_BATCH_NODE_SHARED_DIR'.format(name))
+        if self.wheelhouse:
+            commands.extend(self.wheelhouse.install_commands())
+        else:
+            commands.append('curl -fSsL https://bootstrap.pypa.io/get-pip.py | python')
+            for requirement in wheelhouse.read_requirements(wheelhouse.DEFAULT_REQUIREMENTS_FILE):
+                commands.append('pip install {}'.format(requirement))
+        return commands
+
+    def task_module(self):
+        return os.path.splitext(os.path.basename(self.TASK_FILE))[0]
+
+    def task_command(self):
+        # the start of each task command line; the task script, or the same script run on the node worker
+        if self.NODE_WORKER:
+            # the first task on the node starts the worker, as the tasks' user
+            return 'python $AZ_BATCH_NODE_SHARED_DIR/node_worker.py --func run --module {} --'.format(self.task_module())
+        return 'python $AZ_BATCH_NODE_SHARED_DIR/{}'.format(self.TASK_FILE)
+
+    def stage_wheelhouse(self):
+        # builds the node wheelhouse, if not already built, and stages it as a start task resource file
+        if self.wheelhouse:
+            return self.wheelhouse
+        self.wheelhouse = wheelhouse.build(wheelhouse.DEFAULT_REQUIREMENTS_FILE)
+        self.blob_task_files.append(
+            self.upload_file_to_container(self.args.ctask, self.wheelhouse.tarball))
+        self.save_upload_cache()
+        return self.wheelhouse
+
+    def pool_fingerprint(self, sku_to_use, image_ref_to_use, task_commands):
+        file_hashes = [file_md5(f) for f in self.local_task_files]
+        scaling = self.autoscale.formula() if self.autoscale else 'fixed'
+        scaling = '{} slots {} {}'.format(scaling, self.TASK_SLOTS, self.NODE_FILL_TYPE)
+        return pool_fingerprint(
+            self.POOL_VM_SIZE, image_ref_to_use, sku_to_use, task_commands, file_hashes, scaling)
+
+    def set_pool_scaling(self, new_pool):
+        # either a fixed node count, or an autoscale formula driven by the task backlog; and the task slots per node
+        if self.autoscale:
+            formula = self.autoscale.formula()
+            print('autoscale formula:\n{}'.format(formula))
+            new_pool.target_dedicated_nodes = None
+            new_pool.enable_auto_scale = True
+            new_pool.auto_scale_formula = formula
+            new_pool.auto_scale_evaluation_interval = datetime.timedelta(minutes=EVALUATION_INTERVAL_MINUTES)
+        else:
+            new_pool.target_dedicated_nodes = self.POOL_NODE_COUNT
+            node_slots.print_savings(self.input_file_count(), self.POOL_NODE_COUNT, self.TASK_SLOTS)
+        new_pool.max_tasks_per_node = self.TASK_SLOTS
+        new_pool.task_scheduling_policy = batchmodels.TaskSchedulingPolicy(
+            node_fill_type=getattr(batchmodels.ComputeNodeFillType, self.NODE_FILL_TYPE))
+        return new_pool
+
     def create_pool(self, opts={}):
-        print('Creating pool "{}"...'.format(self.POOL_ID))
-        task_commands = [
-            'cp -p {} $AZ_BATCH_NODE_SHARED_DIR'.format(self.TASK_FILE),
-            'curl -fSsL https://bootstrap.pypa.io/get-pip.py | python',
-            'pip install azure-storage==0.36.0',
-            'pip install pydocumentdb==2.3.3',
-            'pip install pandas==0.23.4'
-        ]
-
-        sku_to_use, image_ref_to_use = \
-            self.select_latest_verified_vm_image_with_node_agent_sku(
-                self.batch_client, self.NODE_OS_PUBLISHER, self.NODE_OS_OFFER, self.NODE_OS_SKU)
+        if self.WHEELHOUSE:
+            self.stage_wheelhouse()
+        task_commands = self.start_task_commands()
+
+        with self.stages.stage('resolve image'):
+            sku_to_use, image_ref_to_use = \
+                self.select_latest_verified_vm_image_with_node_agent_sku(
+                    self.batch_client, self.NODE_OS_PUBLISHER, self.NODE_OS_OFFER, self.NODE_OS_SKU)
         print('sku:   {}'.format(sku_to_use))
         print('image: {}'.format(image_ref_to_use))
 
+        fingerprint = None
+        if self.REUSE_POOL:
+            with self.stages.stage('acquire pool') as span:
+                started = span.start
+                self.pool_manager = PoolManager(self.batch_client, self.POOL_IDLE_TTL)
+                self.pool_manager.reap_idle_pools()
+                fingerprint = self.pool_fingerprint(sku_to_use, image_ref_to_use, task_commands)
+                pool_id = self.pool_manager.acquire(fingerprint, self.JOB_ID, self.POOL_NODE_COUNT)
+                span.attrs['reused'] = pool_id is not None
+            if pool_id:
+                self.POOL_ID = pool_id
+                self.pool_leased = True
+                self.watch_first_node(started)
+                return
+
+        print('Creating pool "{}"...'.format(self.POOL_ID))
         user = batchmodels.AutoUserSpecification(
             scope=batchmodels.AutoUserScope.pool,
             elevation_level=batchmodels.ElevationLevel.admin)
@@ -212,101 +549,224 @@ class BatchClient(object):
                 image_reference=image_ref_to_use,
                 node_agent_sku_id=sku_to_use),
             vm_size=self.POOL_VM_SIZE,
-            target_dedicated_nodes=self.POOL_NODE_COUNT,
             start_task=batch.models.StartTask(
                 command_line=self.wrap_commands_in_shell('linux', task_commands),
                 user_identity=batchmodels.UserIdentity(auto_user=user),
                 wait_for_success=True,
                 resource_files=self.blob_task_files),
         )
+        self.set_pool_scaling(new_pool)
+        if self.pool_manager:
+            self.pool_manager.add_metadata(new_pool, fingerprint, self.JOB_ID)
         try:
-            self.batch_client.pool.add(new_pool)
+            with self.stages.stage('pool add', pool=self.POOL_ID) as span:
+                self.batch_client.pool.add(new_pool)
+            self.pool_leased = self.pool_manager is not None
         except batchmodels.batch_error.BatchErrorException as err:
             self.print_batch_exception(err)
             raise
+        self.watch_first_node(span.start)
+
+    def watch_first_node(self, started):
+        # a 'first node idle' span from the pool add, or acquire, until a node of the pool can run tasks
+        stop = self.first_node_stop = threading.Event()
+        pool_id = self.POOL_ID
+        options = batchmodels.ComputeNodeListOptions(
+            filter="state eq 'idle' or state eq 'running'", select='id,state', max_results=1)
+
+        def watch():
+            with self.stages.stage('first node idle', pool=pool_id) as span:
+                span.start = started
+                span.attrs['node_id'] = None
+                while not stop.is_set():
+                    try:
+                        node = first_listed(self.batch_client.compute_node, 'list', pool_id,
+                                            compute_node_list_options=options)
+                    except batchmodels.batch_error.BatchErrorException:
+                        node = None
+                    if node:
+                        span.attrs['node_id'] = node.id
+                        return
+                    stop.wait(FIRST_NODE_POLL_SECONDS)
+
+        self.first_node_thread = threading.Thread(target=watch, name='first-node')
+        self.first_node_thread.daemon = True
+        self.first_node_thread.start()
+
+    def stop_watching_nodes(self):
+        # before the spans are reported; a node which is not yet idle leaves the span's node_id None
+        if self.first_node_stop:
+            self.first_node_stop.set()
+            self.first_node_thread.join(FIRST_NODE_POLL_SECONDS)
 
     def create_job(self):
         print('Creating job "{}"...'.format(self.JOB_ID))
         job = batch.models.JobAddParameter(
             self.JOB_ID, batch.models.PoolInformation(pool_id=self.POOL_ID))
         try:
-            self.batch_client.job.add(job)
+            with self.stages.stage('job add', job=self.JOB_ID):
+                self.batch_client.job.add(job)
         except batchmodels.batch_error.BatchErrorException as err:
             self.print_batch_exception(err)
             raise
+        if self.CHECKPOINT:
+            self.create_container(self.JOB_CONTAINER)
+            if self.manifest is None:
+                self.manifest = job_manifest.JobManifest(self.JOB_ID, self.POOL_ID)
+            self.manifest.pool_id = self.POOL_ID
+            for input_file in self.blob_input_files:
+                self.manifest.add_input(self.input_name(input_file))
+            self.checkpoint()
 
     def add_tasks(self):
-        # subclasses should generally override this method, except for simple cases
-        tasks = list()
+        # subclasses should generally override generate_tasks, except for simple cases
+        results = self.submit_tasks(self.checkpointed_tasks(self.node_worker_tasks(self.generate_tasks())))
+        self.checkpoint()
+        return results
+
+    def node_worker_tasks(self, tasks):
+        # with --nodeworker y, the tasks share the pool-wide non-admin auto-user, which runs the node worker
+        for task in tasks:
+            if self.NODE_WORKER and task.user_identity is None:
+                task.user_identity = batchmodels.UserIdentity(auto_user=batchmodels.AutoUserSpecification(
+                    scope=batchmodels.AutoUserScope.pool, elevation_level=batchmodels.ElevationLevel.non_admin))
+            yield task
+
+    def checkpointed_tasks(self, tasks):
+        # records the inputs of each task in the job manifest
+        for task in tasks:
+            if self.manifest:
+                self.manifest.record_task(task.id, self.task_input_names(task))
+            yield task
+
+    def task_input_names(self, task):
+        # a task's inputs are its resource files; subclasses whose tasks read their inputs otherwise override this
+        return [rf.file_path for rf in (task.resource_files or list()) if rf.file_path in self.manifest.inputs]
+
+    def submit_tasks(self, tasks):
+        # tasks may be any iterable of TaskAddParameter, preferably a generator
+        # the submitter retries add_collection itself, per task, so it is given the unwrapped client
+        submitter = TaskSubmitter(
+            unwrapped(self.batch_client), self.JOB_ID, concurrency=self.SUBMIT_CONCURRENCY,
+            max_attempts=self.retry_policy.max_attempts, retry_policy=self.retry_policy)
+        return submitter.submit(tasks)
+
+    def packing_enabled(self):
+        return self.PACK_KB > 0 or self.PACK_SECONDS > 0
+
+    def input_size(self, input_file):
+        # a listed Blob has its size; an uploaded ResourceFile has the size of its local file
+        properties = getattr(input_file, 'properties', None)
+        if properties is not None:
+            return properties.content_length or 0
+        for file_path in self.local_input_files:
+            if os.path.basename(file_path) == input_file.file_path:
+                return os.path.getsize(file_path)
+        return 0
+
+    def input_groups(self):
+        # the blob_input_files of each task; one file per task unless packing is enabled
+        if not self.packing_enabled():
+            if self.uploaded_inputs is not None:
+                return self.streamed_input_groups()
+            return [[input_file] for input_file in self.blob_input_files]
+        self.wait_for_input_upload()  # packing needs the sizes of all the inputs
+        if self.PACK_SECONDS > 0:
+            weight = lambda f: task_packing.expected_seconds(self.input_size(f))
+            groups = task_packing.pack(self.blob_input_files, weight, self.PACK_SECONDS)
+            task_packing.print_report(groups, weight, 'expected seconds')
+        else:
+            weight = self.input_size
+            groups = task_packing.pack(self.blob_input_files, weight, self.PACK_KB * 1024)
+            task_packing.print_report(groups, weight, 'bytes')
+        return groups
+
+    def streamed_input_groups(self):
+        # the inputs already in blob storage, then each pipelined upload as soon as it completes
+        for input_file in list(self.blob_input_files):
+            yield [input_file]
+        for input_file in self.uploaded_input_files():
+            yield [input_file]
+
+    def input_file_args(self, task_id, file_names):
+        """
+        The task script arguments naming its input files: --filepath for a
+        single file, otherwise --manifest, with the manifest staged in the
+        task container.  Returns (arguments, extra resource files).
+        """
+        if len(file_names) == 1:
+            return '--filepath {}'.format(file_names[0]), []
+        manifest_name = 'manifest-{}-{}.txt'.format(self.JOB_ID, task_id)
+        self.blob_client.create_blob_from_text(
+            self.args.ctask, manifest_name, task_packing.manifest_text(file_names))
+        return '--manifest {}'.format(manifest_name), [self.blob_resource_file(self.args.ctask, manifest_name)]
+
+    def generate_tasks(self):
         sas_token_cout = self.get_container_sas_token(self.args.cout)  # output container sas token
         sas_token_clog = self.get_container_sas_token(self.args.clog)  # logging container sas token
 
-        for idx, input_file in enumerate(self.blob_input_files):
-            template = 'python $AZ_BATCH_NODE_SHARED_DIR/{} --filepath {} --storageaccount {} --outputcontainer {} --outputtoken "{}" --loggingcontainer {} --loggingtoken "{}" --dev false'
+        for idx, input_files in enumerate(self.input_groups()):
+            task_id = 'task{}'.format(idx)
+            file_args, manifest_files = self.input_file_args(task_id, [f.file_path for f in input_files])
+            template = '{} {} --storageaccount {} --outputcontainer {} --outputtoken "{}" --loggingcontainer {} --loggingtoken "{}" --dev false'
             command  = [
                 template.format(
-                    self.TASK_FILE,
-                    input_file.file_path,
+                    self.task_command(),
+                    file_args,
                     self.STORAGE_ACCOUNT_NAME,
                     self.args.cout,
                     sas_token_cout,
                     self.args.clog,
                     sas_token_clog)]
-            print('add_tasks, command: {}'.format(command))
-            tasks.append(batch.models.TaskAddParameter(
-                'task{}'.format(idx),
+            print('generate_tasks, command: {}'.format(command))
+            yield batch.models.TaskAddParameter(
+                task_id,
                 self.wrap_commands_in_shell('linux', command),
-                resource_files=[input_file]))
-
-        self.batch_client.task.add_collection(self.JOB_ID, tasks)
+                resource_files=input_files + manifest_files)
 
     def execute_tasks(self, timeout_minutes):
         timeout = datetime.timedelta(minutes=timeout_minutes)
-        timeout_expiration = datetime.datetime.now() + timeout
-        print("Monitoring all tasks for 'Completed' state, timeout in {}...".format(timeout), end='')
-
-        while datetime.datetime.now() < timeout_expiration:
-            print('.', end='')
-            sys.stdout.flush()
-            tasks = self.batch_client.task.list(self.JOB_ID)
-
-            incomplete_tasks = [task for task in tasks if
-                                task.state != batchmodels.TaskState.completed]
-            if not incomplete_tasks:
-                print()
-                return True
-            else:
-                time.sleep(10)
+        print("Monitoring all tasks for 'Completed' state, timeout in {}...".format(timeout))
+        monitor = JobMonitor(
+            self.batch_client, self.JOB_ID, on_task_completed=self.on_task_completed)
+        completed = monitor.wait(timeout)
+        monitor.print_report()
+        if completed:
+            return True
         print("ERROR: Tasks did not reach 'Completed' state within timeout period of " + str(timeout))
 
+    def on_task_completed(self, task):
+        # subclasses can override this method to react to each task as it completes
+        exit_code = task.execution_info.exit_code if task.execution_info else None
+        print('task completed: {}  exit_code: {}'.format(task.id, exit_code))
+        if self.manifest:
+            failure_info = getattr(task.execution_info, 'failure_info', None)
+            succeeded = exit_code == 0 and failure_info is None
+            input_names = self.manifest.task_inputs.get(task.id, list())
+            self.manifest.record_completion(
+                task.id, succeeded, exit_code, self.task_output_blobs(task.id, input_names))
+            self.checkpoint(force=False)
+
+    def task_output_blobs(self, task_id, input_names):
+        # subclasses can override this method; a dict of input name to the output blob names of its task
+        return dict()
+
     def capture_stdout_stderr_streams(self, encoding=None):
+        # the streams are written to tmp/ as the raw bytes from the node, or with an encoding as utf-8 text
         print('capture_stdout_stderr_streams...')
-
-        tasks = self.batch_client.task.list(self.JOB_ID)
-        for task in tasks:
-            node_id = self.batch_client.task.get(self.JOB_ID, task.id).node_info.node_id
-            print("Task: {}".format(task.id))
-            print("Node: {}".format(node_id))
-            stream_names = [STANDARD_OUT_FILE_NAME, STANDARD_ERR_FILE_NAME]
-            for stream_name in stream_names:
-                output_file = 'tmp/{}-{}-{}-{}'.format(self.JOB_ID, task.id, self.epoch, stream_name)
-                stream = self.batch_client.file.get_from_task(self.JOB_ID, task.id, stream_name)
-                stream_text = self.read_stream_as_string(stream, encoding)
-                with open(output_file, 'w') as f:
-                    f.write(stream_text)
-                    print("stream file written {}:".format(output_file))
-
-    def read_stream_as_string(self, stream, encoding):
-        output = io.BytesIO()
-        try:
-            for data in stream:
-                output.write(data)
-            if encoding is None:
-                encoding = 'utf-8'
-            return output.getvalue().decode(encoding)
-        finally:
-            output.close()
-        raise RuntimeError('RuntimeError in read_stream_as_string on {}'.format(stream))
+        tail_bytes = None
+        if self.OUTPUT_TAIL_KB:
+            tail_bytes = int(self.OUTPUT_TAIL_KB) * 1024
+        collector = TaskOutputCollector(
+            self.batch_client,
+            self.JOB_ID,
+            output_dir='tmp',
+            concurrency=self.OUTPUT_CONCURRENCY,
+            tail_bytes=tail_bytes,
+            stream_names=[STANDARD_OUT_FILE_NAME, STANDARD_ERR_FILE_NAME],
+            file_name_template='{job_id}-{task_id}-' + str(self.epoch) + '-{stream_name}',
+            encoding=encoding)
+        return collector.collect()
 
     def create_container(self, container_name, fail_on_exist=False):
         print(f'create_container: {container_name}')
@@ -316,22 +776,26 @@ class BatchClient(object):
         print(f'delete_container: {container_name}')
         self.blob_client.delete_container(container_name)
 
-    def get_blobs(self, container_name):
-        return self.blob_client.list_blobs(container_name)
+    def create_downloader(self):
+        # the proxy does not retry get_blob_to_stream, so the downloader's attempts are the only retries of a fetch
+        return ParallelDownloader(
+            self.blob_client,
+            concurrency=self.DOWNLOAD_CONCURRENCY)
+
+    def get_blobs(self, container_name, prefix=None):
+        # every page of the listing, optionally filtered by a blob name prefix
+        return list(self.create_downloader().list_blobs(container_name, prefix))
 
-    def list_blobs(self, container_name):
-        blobs = self.blob_client.list_blobs(container_name)
-        for blob in blobs.items:
+    def list_blobs(self, container_name, prefix=None):
+        for blob in self.create_downloader().list_blobs(container_name, prefix):
             print(f'container: {container_name}  blob: {blob.name}')
 
-    def download_blobs_from_container(self, container_name, directory_path):
+    def download_blobs_from_container(self, container_name, directory_path, prefix=None):
+        # unchanged local files are skipped, and interrupted downloads resume
         print(f'Downloading all files from container {container_name}')
-        blobs = self.blob_client.list_blobs(container_name)
-        for blob in blobs.items:
-            destination_file_path = os.path.join(directory_path, blob.name)
-            self.blob_client.get_blob_to_path(container_name, blob.name, destination_file_path)
-            print(f'Downloaded blob {blob.name} from container {container_name} to {destination_file_path}')
+        results = self.create_downloader().download(container_name, directory_path, prefix)
         print('Blob download complete')
+        return results
 
     def delete_job(self, job_id=None):
         if job_id == None:
@@ -340,6 +804,11 @@ class BatchClient(object):
 
     def delete_pool(self, pool_id=None):
         if pool_id == None:
+            if self.pool_leased:
+                # a warm pool is kept for reuse, and deleted once idle longer than its ttl
+                self.pool_manager.release(self.POOL_ID)
+                self.pool_leased = False
+                return
             pool_id = self.POOL_ID
         self.batch_client.pool.delete(pool_id)
 
@@ -358,19 +827,8 @@ class BatchClient(object):
 
     def select_latest_verified_vm_image_with_node_agent_sku(
             self, batch_client, publisher, offer, sku_starts_with):
-        # get verified vm image list and node agent sku ids from service
-        node_agent_skus = batch_client.account.list_node_agent_skus()
-        # pick the latest supported sku
-        skus_to_use = [
-            (sku, image_ref) for sku in node_agent_skus for image_ref in sorted(
-                sku.verified_image_references, key=lambda item: item.sku)
-            if image_ref.publisher.lower() == publisher.lower() and
-            image_ref.offer.lower() == offer.lower() and
-            image_ref.sku.startswith(sku_starts_with)
-        ]
-        # skus are listed in reverse order, pick first for latest
-        sku_to_use, image_ref_to_use = skus_to_use[0]
-        return (sku_to_use.id, image_ref_to_use)
+        # resolved from the image_resolver cache; the node agent skus are listed only when it expires
+        return image_resolver.resolve(batch_client, publisher, offer, sku_starts_with)
 
     def wrap_commands_in_shell(self, ostype, commands):
         if ostype.lower() == 'linux':
@@ -393,13 +851,33 @@ class BatchClient(object):
 
         state['POOL_ID']            = self.POOL_ID
         state['POOL_NODE_COUNT']    = self.POOL_NODE_COUNT
+        state['REUSE_POOL']         = self.REUSE_POOL
+        state['POOL_IDLE_TTL']      = self.POOL_IDLE_TTL
+        state['wheelhouse']         = self.wheelhouse.to_dict() if self.wheelhouse else None
+        state['autoscale_formula']  = self.autoscale.formula() if self.autoscale else None
         state['POOL_VM_SIZE']       = self.POOL_VM_SIZE
+        state['TASK_SLOTS']         = self.TASK_SLOTS
+        state['NODE_FILL_TYPE']     = self.NODE_FILL_TYPE
         state['NODE_OS_PUBLISHER']  = self.NODE_OS_PUBLISHER
         state['NODE_OS_OFFER']      = self.NODE_OS_OFFER
         state['NODE_OS_SKU']        = self.NODE_OS_SKU
         state['TASK_FILE']          = self.TASK_FILE
         state['JOB_ID']             = self.JOB_ID
         state['JOB_CONTAINER']      = self.JOB_CONTAINER
+        state['RESUME_JOB_ID']      = self.RESUME_JOB_ID
+        state['PIPELINE']           = self.PIPELINE
+        state['NODE_WORKER']        = self.NODE_WORKER
+        state['stages']             = self.stages.to_list()
+        state['SPANS_FILE']         = self.SPANS_FILE
+        state['manifest_file']      = self.manifest.manifest_file if self.manifest else None
+        state['UPLOAD_CONCURRENCY'] = self.UPLOAD_CONCURRENCY
+        state['SUBMIT_CONCURRENCY'] = self.SUBMIT_CONCURRENCY
+        state['OUTPUT_CONCURRENCY'] = self.OUTPUT_CONCURRENCY
+        state['OUTPUT_TAIL_KB']     = self.OUTPUT_TAIL_KB
+        state['DOWNLOAD_CONCURRENCY'] = self.DOWNLOAD_CONCURRENCY
+        state['PACK_KB']            = self.PACK_KB
+        state['PACK_SECONDS']       = self.PACK_SECONDS
+        state['upload_cache']       = self.upload_cache.manifest_file if self.upload_cache else None
         state['epoch']              = self.epoch
         state['blob_client']        = str(self.blob_client)
         state['batch_client']       = str(self.batch_client)
@@ -0,0 +1,1087 @@
+from __future__ import print_function
+import argparse
+import atexit
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+sys.path.append('.')
+import fakes
+import image_resolver
+
+# Local benchmarks for the BatchClient submit path, run against the in-process
+# stand-ins in fakes.py rather than the real Azure services.
+#
+# python benchmarks.py --func upload
+# python benchmarks.py --func upload --files 200 --kb 256 --latency 0.05
+# python benchmarks.py --func upload_cache
+# python benchmarks.py --func submit --tasks 20000
+# python benchmarks.py --func monitor --tasks 5000
+# python benchmarks.py --func output --tasks 500 --kb 256
+# python benchmarks.py --func pool_reuse --runs 5 --allocation 3
+# python benchmarks.py --func download --files 2000 --kb 16
+# python benchmarks.py --func resume --files 10000 --failrate 0.03
+# python benchmarks.py --func retry --tasks 2000 --busyrate 0.05 --runs 10
+# python benchmarks.py --func async --files 500 --kb 64 --latency 0.05
+# python benchmarks.py --func pipeline --files 500 --kb 64 --allocation 3
+# python benchmarks.py --func node_worker --tasks 20 --importseconds 1.5
+# python benchmarks.py --func cosmos_bulk --docs 5000 --cities 200 --latency 0.01 --ruthroughput 10000
+# python benchmarks.py --func cosmos_scheduler --tasks 8 --docs 2000 --ruthroughput 5000
+# python benchmarks.py --func idempotent --docs 5000 --failrate 0.6
+# python benchmarks.py --func stream --docs 500000 --latency 0.02 --secpermb 0.02
+# python benchmarks.py --func shards --docs 1000000 --shards 1,2,4
+# python benchmarks.py --func split --docs 500000 --ranges 1,4,8 --secpermb 0.2
+# python benchmarks.py --func transform --docs 2000000
+
+# the fake node agent sku is cached here, never in the real tmp/node_agent_sku_cache.json
+FAKE_IMAGE_CACHE = os.path.join(tempfile.gettempdir(), 'bench-node-agent-skus-{}.json'.format(os.getpid()))
+# the fake runs' spans are appended here, never to the real tmp/spans.jsonl
+FAKE_SPANS_FILE = os.path.join(tempfile.gettempdir(), 'bench-spans-{}.jsonl'.format(os.getpid()))
+
+
+def remove_fake_files():
+    image_resolver.clear(FAKE_IMAGE_CACHE)
+    if os.path.isfile(FAKE_SPANS_FILE):
+        os.remove(FAKE_SPANS_FILE)
+
+atexit.register(remove_fake_files)
+
+
+def fake_client_args(**kwargs):
+    # the arguments the client scripts pass to BatchClient, plus any overrides
+    args = types.SimpleNamespace(
+        pool='benchpool', job='benchjob', task='hello_task.py', nodecount='2',
+        ctask='batchtask', cin='batchcsv', cout='batchcsv', clog='batchlog',
+        timeout='30', uploadconcurrency='8', uploadcache='n', outputtailkb=None,
+        reusepool='n', poolidlettl='30', spansfile=FAKE_SPANS_FILE)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+def fake_batch_client(args, blob_service, batch_service, client_class=None):
+    # a BatchClient, or subclass, which talks to the in-process fakes
+    for name in ['AZURE_BATCH_ACCOUNT', 'AZURE_BATCH_KEY', 'AZURE_BATCH_URL',
+                 'AZURE_STORAGE_ACCOUNT', 'AZURE_STORAGE_KEY']:
+        os.environ.setdefault(name, 'fake')
+    if client_class is None:
+        from batch_client import BatchClient
+        client_class = BatchClient
+
+    class FakeServiceBatchClient(client_class):
+
+        def create_blob_client(self):
+            self.blob_client = self.retry_policy.wrap(blob_service, 'blob')
+            return self.blob_client
+
+        def create_batch_service_client(self):
+            self.batch_client = self.retry_policy.wrap(batch_service)
+            return self.batch_client
+
+        def select_latest_verified_vm_image_with_node_agent_sku(
+                self, batch_client, publisher, offer, sku_starts_with):
+            return image_resolver.resolve(batch_client, publisher, offer, sku_starts_with, cache_file=FAKE_IMAGE_CACHE)
+
+    return FakeServiceBatchClient(args)
+
+def create_temp_files(count, kb):
+    tmpdir = tempfile.mkdtemp(prefix='bench-')
+    data = os.urandom(kb * 1024)
+    file_paths = list()
+    for idx in range(count):
+        file_path = os.path.join(tmpdir, 'split{}.csv'.format(idx))
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        file_paths.append(file_path)
+    return tmpdir, file_paths
+
+def fake_upload_func(blob_service):
+    # mirrors BatchClient.upload_file_to_container, without the ResourceFile
+    def upload(container_name, file_path):
+        blob_name = os.path.basename(file_path)
+        blob_service.create_blob_from_path(container_name, blob_name, file_path)
+        sas_token = blob_service.generate_blob_shared_access_signature(container_name, blob_name)
+        return blob_service.make_blob_url(container_name, blob_name, sas_token=sas_token)
+    return upload
+
+def print_row(cols, widths):
+    print('  '.join(str(c).rjust(w) for c, w in zip(cols, widths)))
+
+def bench_upload(args):
+    from upload_engine import ParallelUploader
+
+    tmpdir, file_paths = create_temp_files(int(args.files), int(args.kb))
+    total_mb = sum(os.path.getsize(p) for p in file_paths) / (1024.0 * 1024.0)
+    print('uploading {} files, {:.1f} MB, latency {}s/request, {}s/MB'.format(
+        len(file_paths), total_mb, args.latency, args.secpermb))
+    widths = [11, 9, 9, 9]
+    print_row(['concurrency', 'seconds', 'files/s', 'MB/s'], widths)
+    try:
+        baseline = None
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            blob_service = fakes.FakeBlobService(
+                request_latency=float(args.latency), seconds_per_mb=float(args.secpermb))
+            uploader = ParallelUploader(
+                fake_upload_func(blob_service), concurrency=concurrency, verbose=False)
+            t1 = time.time()
+            urls = uploader.upload('batchcsv', file_paths)
+            elapsed = time.time() - t1
+            assert len(urls) == len(file_paths)
+            assert urls[0].split('?')[0].endswith(os.path.basename(file_paths[0]))
+            if baseline is None:
+                baseline = elapsed
+            print_row([concurrency, '{:.2f}'.format(elapsed),
+                       '{:.1f}'.format(len(file_paths) / elapsed),
+                       '{:.2f}'.format(total_mb / elapsed)], widths)
+        print('speedup at max concurrency: {:.1f}x'.format(baseline / elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_upload_cache(args):
+    from upload_cache import UploadCache
+    from upload_engine import ParallelUploader
+
+    tmpdir, file_paths = create_temp_files(int(args.files), int(args.kb))
+    blob_service = fakes.FakeBlobService(
+        request_latency=float(args.latency), seconds_per_mb=float(args.secpermb))
+    cache = UploadCache(os.path.join(tmpdir, 'upload_cache.json'))
+
+    def cached_upload(container_name, file_path):
+        # mirrors the cache logic in BatchClient.upload_file_to_container
+        blob_name = os.path.basename(file_path)
+        if not cache.lookup(blob_service, container_name, file_path, blob_name):
+            props = blob_service.create_blob_from_path(container_name, blob_name, file_path)
+            cache.record(container_name, file_path, blob_name, props.etag)
+        return blob_service.make_blob_url(container_name, blob_name)
+
+    try:
+        uploader = ParallelUploader(cached_upload, concurrency=int(args.concurrency.split(',')[-1]), verbose=False)
+        for run in ['cold', 'warm', 'one file changed']:
+            if run == 'one file changed':
+                with open(file_paths[0], 'ab') as f:
+                    f.write(b'x')
+            cache.hits, cache.misses = list(), list()
+            t1 = time.time()
+            uploader.upload('batchcsv', file_paths)
+            cache.save()
+            print('{:>16}: {:.2f}s  {} hits  {} misses'.format(
+                run, time.time() - t1, len(cache.hits), len(cache.misses)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def generate_fake_tasks(count):
+    import azure.batch.models as batchmodels
+    for idx in range(count):
+        command = 'python $AZ_BATCH_NODE_SHARED_DIR/csv_etl_task.py --filepath split{}.csv --idx {}'.format(idx, idx)
+        yield batchmodels.TaskAddParameter(
+            id='task{}'.format(idx),
+            command_line="/bin/bash -c 'set -e; set -o pipefail; {}; wait'".format(command))
+
+def bench_submit(args):
+    from task_submitter import TaskSubmitter
+
+    count = int(args.tasks)
+    print('submitting {} tasks, latency {}s/request'.format(count, args.latency))
+    service = fakes.FakeBatchServiceClient(request_latency=float(args.latency))
+    service.job.add(types.SimpleNamespace(id='single'))
+    try:
+        service.task.add_collection('single', list(generate_fake_tasks(count)))
+        print('single add_collection: ok')
+    except Exception as e:
+        print('single add_collection: failed, {}'.format(e))
+
+    widths = [11, 9, 9, 8, 7]
+    print_row(['concurrency', 'seconds', 'tasks/s', 'requests', 'retries'], widths)
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        service = fakes.FakeBatchServiceClient(
+            request_latency=float(args.latency), busy_rate=float(args.busyrate),
+            server_error_rate=float(args.busyrate), seed=42)
+        job_id = 'bench{}'.format(concurrency)
+        service.job.add(types.SimpleNamespace(id=job_id))
+        submitter = TaskSubmitter(service, job_id, concurrency=concurrency, backoff_seconds=0.01)
+        counters = submitter.submit(generate_fake_tasks(count))
+        assert len(service.tasks[job_id]) == count
+        print_row([concurrency, '{:.2f}'.format(counters['elapsed']),
+                   '{:.0f}'.format(submitter.tasks_per_second()),
+                   counters['requests'], counters['retries']], widths)
+
+def bench_monitor(args):
+    import azure.batch.models as batchmodels
+    from job_monitor import JobMonitor
+    from task_submitter import TaskSubmitter
+
+    count, duration = int(args.tasks), float(args.duration)
+    print('monitoring {} tasks completing within {}s'.format(count, duration))
+
+    def new_job(job_id):
+        service = fakes.FakeBatchServiceClient(task_duration=(duration / 10.0, duration), seed=42)
+        service.job.add(types.SimpleNamespace(id=job_id))
+        TaskSubmitter(service, job_id, concurrency=8).submit(generate_fake_tasks(count))
+        service.call_counts, service.bytes_transferred = dict(), 0
+        return service
+
+    # the previous loop: list every task, every poll interval, until none are incomplete
+    service = new_job('polling')
+    t1, polls = time.time(), 0
+    while True:
+        polls += 1
+        tasks = service.task.list('polling')
+        if not [t for t in tasks if t.state != batchmodels.TaskState.completed]:
+            break
+        time.sleep(float(args.pollinterval))
+    results = [('list all tasks', time.time() - t1, polls, service.total_calls(), service.bytes_transferred)]
+
+    for name, callback in [('JobMonitor', None), ('with callback', list())]:
+        service = new_job('monitor')
+        monitor = JobMonitor(service, 'monitor', on_task_completed=callback.append if callback is not None else None,
+                             min_interval=float(args.pollinterval) / 5, max_interval=float(args.pollinterval) * 2)
+        t1 = time.time()
+        monitor.wait(datetime.timedelta(minutes=10))
+        assert callback is None or len(callback) == count
+        results.append((name, time.time() - t1, monitor.counters['polls'], service.total_calls(), service.bytes_transferred))
+
+    widths = [14, 8, 6, 6, 12, 12]
+    print_row(['monitor', 'seconds', 'polls', 'calls', 'bytes', 'bytes/poll'], widths)
+    for name, elapsed, polls, calls, nbytes in results:
+        print_row([name, '{:.1f}'.format(elapsed), polls, calls, nbytes, nbytes // polls], widths)
+
+def bench_output(args):
+    import io
+    from task_output import TaskOutputCollector
+    from task_submitter import TaskSubmitter
+
+    count = int(args.tasks)
+    service = fakes.FakeBatchServiceClient(
+        request_latency=float(args.latency), seconds_per_mb=float(args.secpermb),
+        task_duration=(0, 0), output_kb=int(args.kb), seed=42)
+    service.job.add(types.SimpleNamespace(id='output'))
+    TaskSubmitter(service, 'output', concurrency=8).submit(generate_fake_tasks(count))
+    print('collecting stdout/stderr of {} tasks, {} KB each, latency {}s/request'.format(count, args.kb, args.latency))
+    tmpdir = tempfile.mkdtemp(prefix='bench-')
+    widths = [22, 8, 6, 12]
+    print_row(['collector', 'seconds', 'calls', 'bytes'], widths)
+    try:
+        # the previous approach: serial, a task.get per task, and each stream buffered in memory
+        service.call_counts, service.bytes_transferred = dict(), 0
+        t1 = time.time()
+        for task in service.task.list('output'):
+            service.task.get('output', task.id)  # the node lookup it made per task
+            for stream_name in ['stdout.txt', 'stderr.txt']:
+                output = io.BytesIO()
+                for data in service.file.get_from_task('output', task.id, stream_name):
+                    output.write(data)
+                with open(os.path.join(tmpdir, '{}-{}'.format(task.id, stream_name)), 'w') as f:
+                    f.write(output.getvalue().decode('utf-8'))
+        print_row(['serial, buffered', '{:.2f}'.format(time.time() - t1), service.total_calls(), service.bytes_transferred], widths)
+
+        for concurrency, tail_kb in [(8, None), (32, None), (32, 16)]:
+            service.call_counts, service.bytes_transferred = dict(), 0
+            collector = TaskOutputCollector(
+                service, 'output', output_dir=tmpdir, concurrency=concurrency,
+                tail_bytes=tail_kb * 1024 if tail_kb else None)
+            t1 = time.time()
+            stdout = sys.stdout
+            sys.stdout = io.StringIO()
+            try:
+                collector.collect()
+            finally:
+                sys.stdout = stdout
+            name = 'parallel x{}'.format(concurrency) + (', tail {}KB'.format(tail_kb) if tail_kb else '')
+            print_row([name, '{:.2f}'.format(time.time() - t1), service.total_calls(), service.bytes_transferred], widths)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_pool_reuse(args):
+    import io
+
+    runs, allocation = int(args.runs), float(args.allocation)
+    print('{} consecutive short jobs, {}s simulated pool allocation + start task'.format(runs, allocation))
+    widths = [16, 6, 22]
+    print_row(['mode', 'run', 'time to first node (s)'], widths)
+    for reuse in ['n', 'y']:
+        batch_service = fakes.FakeBatchServiceClient(pool_allocation_seconds=allocation, seed=42)
+        blob_service = fakes.FakeBlobService()
+        for run in range(runs):
+            client_args = fake_client_args(reusepool=reuse, job='benchjob{}'.format(run))
+            stdout = sys.stdout
+            sys.stdout = io.StringIO()
+            try:
+                client = fake_batch_client(client_args, blob_service, batch_service)
+                client.epoch = client.epoch + run
+                client.POOL_ID = '{}_{}'.format(client_args.pool, client.epoch)
+                client.JOB_ID = '{}-{}'.format(client_args.job, client.epoch)
+                client.add_task_file(os.path.realpath('hello_task.py'))
+                client.upload_task_files(client_args.ctask, client.local_task_files)
+                t1 = time.time()
+                client.create_pool()
+                client.create_job()
+                while batch_service.pool.get(client.POOL_ID).current_dedicated_nodes == 0:
+                    time.sleep(0.05)
+                elapsed = time.time() - t1
+                batch_service.job.delete(client.JOB_ID)
+                client.delete_pool()
+            finally:
+                sys.stdout = stdout
+            if client.manifest and os.path.isfile(client.manifest.manifest_file):
+                os.remove(client.manifest.manifest_file)
+            print_row(['reuse' if reuse == 'y' else 'pool per job', run + 1, '{:.2f}'.format(elapsed)], widths)
+
+def bench_download(args):
+    import io
+    from download_engine import ParallelDownloader, PART_SUFFIX
+
+    count, kb = int(args.files), int(args.kb)
+    blob_service = fakes.FakeBlobService(
+        request_latency=float(args.latency), seconds_per_mb=float(args.secpermb))
+    data = os.urandom(kb * 1024)
+    for idx in range(count):
+        blob_service.create_blob_from_bytes('batchcsv', 'results-{:06d}.csv'.format(idx), data)
+    print('downloading {} blobs of {} KB, listed in pages of 1000, latency {}s/request'.format(count, kb, args.latency))
+    tmpdir = tempfile.mkdtemp(prefix='bench-')
+    widths = [26, 8, 8, 10]
+    print_row(['download', 'seconds', 'files', 'bytes'], widths)
+    try:
+        # the previous approach: serial, and only the first page of the listing
+        serial_dir = os.path.join(tmpdir, 'serial')
+        os.makedirs(serial_dir)
+        blob_service.call_counts = dict()
+        t1 = time.time()
+        for blob in blob_service.list_blobs('batchcsv', num_results=1000).items:
+            with open(os.path.join(serial_dir, blob.name), 'wb') as f:
+                blob_service.get_blob_to_stream('batchcsv', blob.name, f)
+        print_row(['serial, first page', '{:.2f}'.format(time.time() - t1),
+                   blob_service.call_counts.get('get_blob', 0), '-'], widths)
+
+        parallel_dir = os.path.join(tmpdir, 'parallel')
+        concurrency = int(args.concurrency.split(',')[-1])
+        for run in ['parallel, all pages', 'rerun, unchanged', 'resume after interrupt']:
+            if run == 'resume after interrupt':
+                # a quarter of the files were partially written when the download stopped
+                for name in sorted(os.listdir(parallel_dir))[:count // 4]:
+                    file_path = os.path.join(parallel_dir, name)
+                    os.rename(file_path, file_path + PART_SUFFIX)
+                    with open(file_path + PART_SUFFIX, 'r+b') as f:
+                        f.truncate(len(data) // 2)
+            downloader = ParallelDownloader(blob_service, concurrency=concurrency, page_size=1000, verbose=False)
+            blob_service.call_counts = dict()
+            stdout = sys.stdout
+            sys.stdout = io.StringIO()
+            try:
+                t1 = time.time()
+                downloader.download('batchcsv', parallel_dir)
+                elapsed = time.time() - t1
+            finally:
+                sys.stdout = stdout
+            c = downloader.counters
+            print_row([run, '{:.2f}'.format(elapsed), c['downloaded'] + c['resumed'], c['bytes']], widths)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_resume(args):
+    import io
+    import azure.batch.models as batchmodels
+    from batch_client import BatchClient
+
+    class QuietBatchClient(BatchClient):
+
+        def capture_stdout_stderr_streams(self, encoding=None):
+            pass  # not part of what is measured
+
+    count = int(args.files)
+    manifest_files = list()
+    print('{} inputs, {:.0%} of tasks fail, latency {}s/request'.format(count, float(args.failrate), args.latency))
+    widths = [24, 8, 8, 10]
+    print_row(['run', 'seconds', 'tasks', 'completed'], widths)
+    try:
+        batch_service = fakes.FakeBatchServiceClient(
+            request_latency=float(args.latency), task_duration=(0, 0),
+            task_failure_rate=float(args.failrate), seed=42)
+        blob_service = fakes.FakeBlobService()
+        previous_job_id = None
+        for run, resume in [('full job', False), ('rerun everything', False), ('resume', True)]:
+            client_args = fake_client_args(job='benchjob', timeout='5', taskslots='1')
+            if resume:
+                client_args.resume = previous_job_id
+            stdout = sys.stdout
+            sys.stdout = io.StringIO()
+            try:
+                client = fake_batch_client(client_args, blob_service, batch_service, QuietBatchClient)
+                client.JOB_ID = '{}-{}'.format(client_args.job, run.replace(' ', ''))
+                client.POOL_ID = '{}_{}'.format(client_args.pool, run.replace(' ', ''))
+                client.JOB_CONTAINER = 'job-' + client.JOB_ID
+                for idx in range(count):
+                    client.add_storage_input_blob(batchmodels.ResourceFile(
+                        file_path='split{}.csv'.format(idx), blob_source='https://fake/split{}.csv'.format(idx)))
+                t1 = time.time()
+                client.execute()
+                elapsed = time.time() - t1
+            finally:
+                sys.stdout = stdout
+            manifest_files.append(client.manifest.manifest_file)
+            counts = client.manifest.counts()
+            print_row([run, '{:.2f}'.format(elapsed), len(client.manifest.task_inputs), counts['completed']], widths)
+            if run == 'full job':
+                previous_job_id = client.JOB_ID
+    finally:
+        for manifest_file in manifest_files:
+            os.remove(manifest_file)
+
+def bench_retry(args):
+    import io
+    import azure.batch.models as batchmodels
+    from batch_client import BatchClient
+
+    class QuietBatchClient(BatchClient):
+
+        def capture_stdout_stderr_streams(self, encoding=None):
+            pass  # not part of what is measured
+
+    count, busy_rate, runs = int(args.tasks), float(args.busyrate), int(args.runs)
+    print('{} runs of a {}-task job with {:.0%} of Batch and Blob calls failing with Server Busy'.format(
+        runs, count, busy_rate))
+    widths = [18, 10, 8, 8, 10, 9]
+    print_row(['retry policy', 'completed', 'seconds', 'calls', 'retries', 'backoff'], widths)
+    manifest_files = list()
+    try:
+        for name, max_attempts in [('none', 1), ('shared policy', 6)]:
+            completed_runs, elapsed, calls, retries, backoff = 0, 0.0, 0, 0, 0.0
+            for seed in range(runs):
+                batch_service = fakes.FakeBatchServiceClient(
+                    busy_rate=busy_rate, task_duration=(0, 0), retry_after=0.05, seed=seed)
+                blob_service = fakes.FakeBlobService(busy_rate=busy_rate, seed=seed)
+                client_args = fake_client_args(
+                    job='benchretry{}'.format(seed), timeout='5', taskslots='1', maxattempts=max_attempts)
+                stdout = sys.stdout
+                sys.stdout = io.StringIO()
+                try:
+                    t1 = time.time()
+                    client = fake_batch_client(client_args, blob_service, batch_service, QuietBatchClient)
+                    client.retry_policy.base_seconds = 0.05
+                    for idx in range(count):
+                        client.add_storage_input_blob(batchmodels.ResourceFile(
+                            file_path='split{}.csv'.format(idx), blob_source='https://fake/split{}.csv'.format(idx)))
+                    try:
+                        client.execute()
+                    except Exception:
+                        pass  # a call which failed without a retry; the run is not completed
+                    elapsed += time.time() - t1
+                finally:
+                    sys.stdout = stdout
+                if client.manifest:
+                    manifest_files.append(client.manifest.manifest_file)
+                    if client.manifest.counts()['completed'] == count:
+                        completed_runs += 1
+                t = client.retry_policy.totals()
+                calls, retries, backoff = calls + t['calls'], retries + t['retries'], backoff + t['backoff_seconds']
+            print_row([name, '{}/{}'.format(completed_runs, runs), '{:.2f}'.format(elapsed / runs),
+                       calls // runs, retries // runs, '{:.1f}s'.format(backoff / runs)], widths)
+    finally:
+        for manifest_file in manifest_files:
+            if os.path.isfile(manifest_file):
+                os.remove(manifest_file)
+
+def bench_async(args):
+    import io
+    from async_batch_client import async_variant
+    from batch_client import BatchClient
+
+    class QuietBatchClient(BatchClient):
+
+        def add_tasks(self):
+            results = BatchClient.add_tasks(self)
+            self.submitted_at = time.time()
+            return results
+
+        def capture_stdout_stderr_streams(self, encoding=None):
+            pass  # not part of what is measured
+
+    count, latency = int(args.files), float(args.latency)
+    tmpdir, file_paths = create_temp_files(count, int(args.kb))
+    print('{} local input files of {} KB, latency {}s/request, {}s/MB'.format(count, args.kb, latency, args.secpermb))
+    widths = [26, 14, 10]
+    print_row(['client', 'submitted (s)', 'total (s)'], widths)
+    manifest_files = list()
+    # the clients resolve the node image from the warm in-process memo; cached in tmpdir, not the real tmp/
+    image_cache = os.path.join(tmpdir, 'node_agent_sku_cache.json')
+    image_resolver.resolve(fakes.FakeBatchServiceClient(), 'Canonical', 'UbuntuServer', '16', cache_file=image_cache)
+    clients = [('BatchClient, --pipeline n', QuietBatchClient, 'n'), ('BatchClient', QuietBatchClient, 'y'),
+               ('AsyncBatchClient', async_variant(QuietBatchClient), 'y')]
+    try:
+        for name, client_class, pipeline in clients:
+            batch_service = fakes.FakeBatchServiceClient(
+                request_latency=latency, task_duration=(0.5, 2.0), seed=42)
+            blob_service = fakes.FakeBlobService(request_latency=latency, seconds_per_mb=float(args.secpermb))
+            client_args = fake_client_args(job='benchasync', timeout='5', taskslots='1', pipeline=pipeline)
+            stdout = sys.stdout
+            sys.stdout = io.StringIO()
+            try:
+                client = fake_batch_client(client_args, blob_service, batch_service, client_class)
+                client.JOB_ID = 'benchasync-{}-{}'.format(client_class.__name__.lower(), pipeline)
+                client.JOB_CONTAINER = 'job-' + client.JOB_ID
+                client.add_task_file(os.path.realpath('hello_task.py'))
+                for file_path in file_paths:
+                    client.add_local_input_file(file_path)
+                t1 = time.time()
+                client.execute()
+                elapsed = time.time() - t1
+            finally:
+                sys.stdout = stdout
+            if client.manifest:
+                manifest_files.append(client.manifest.manifest_file)
+            print_row([name, '{:.2f}'.format(client.submitted_at - t1), '{:.2f}'.format(elapsed)], widths)
+    finally:
+        image_resolver.clear(image_cache)
+        shutil.rmtree(tmpdir)
+        for manifest_file in manifest_files:
+            if os.path.isfile(manifest_file):
+                os.remove(manifest_file)
+
+def bench_pipeline(args):
+    import io
+    from batch_client import BatchClient
+
+    class QuietBatchClient(BatchClient):
+
+        def add_tasks(self):
+            results = BatchClient.add_tasks(self)
+            self.submitted_at = time.time()
+            return results
+
+        def capture_stdout_stderr_streams(self, encoding=None):
+            pass  # not part of what is measured
+
+    count, latency, allocation = int(args.files), float(args.latency), float(args.allocation)
+    tmpdir, file_paths = create_temp_files(count, int(args.kb))
+    print('{} local input files of {} KB, latency {}s/request, {}s/MB, {}s pool allocation'.format(
+        count, args.kb, latency, args.secpermb, allocation))
+    # the clients resolve the node image from the warm in-process memo; cached in tmpdir, not the real tmp/
+    image_cache = os.path.join(tmpdir, 'node_agent_sku_cache.json')
+    image_resolver.resolve(fakes.FakeBatchServiceClient(), 'Canonical', 'UbuntuServer', '16', cache_file=image_cache)
+    reports = list()
+    widths = [12, 14, 16, 10]
+    print_row(['execute', 'pool ready (s)', 'tasks added (s)', 'total (s)'], widths)
+    manifest_files = list()
+    try:
+        for pipeline in ['n', 'y']:
+            batch_service = fakes.FakeBatchServiceClient(
+                request_latency=latency, task_duration=(0.5, 2.0), pool_allocation_seconds=allocation, seed=42)
+            blob_service = fakes.FakeBlobService(request_latency=latency, seconds_per_mb=float(args.secpermb))
+            client_args = fake_client_args(job='benchpipeline', timeout='5', taskslots='1', pipeline=pipeline)
+            stdout = sys.stdout
+            sys.stdout = io.StringIO()
+            try:
+                client = fake_batch_client(client_args, blob_service, batch_service, QuietBatchClient)
+                client.JOB_ID = 'benchpipeline-{}'.format(pipeline)
+                client.JOB_CONTAINER = 'job-' + client.JOB_ID
+                client.add_task_file(os.path.realpath('hello_task.py'))
+                for file_path in file_paths:
+                    client.add_local_input_file(file_path)
+                t1 = time.time()
+                client.execute()
+                elapsed = time.time() - t1
+            finally:
+                report, sys.stdout = sys.stdout.getvalue(), stdout
+            reports.append(report[report.rindex('stages:'):])
+            if client.manifest:
+                manifest_files.append(client.manifest.manifest_file)
+            assert len(batch_service.tasks[client.JOB_ID]) == count
+            pool_ready = batch_service.pools[client.POOL_ID].ready_at - t1
+            print_row(['pipelined' if pipeline == 'y' else 'sequential', '{:.2f}'.format(pool_ready),
+                       '{:.2f}'.format(client.submitted_at - t1), '{:.2f}'.format(elapsed)], widths)
+        for report in reports:
+            print(report.rstrip())
+    finally:
+        image_resolver.clear(image_cache)
+        shutil.rmtree(tmpdir)
+        for manifest_file in manifest_files:
+            if os.path.isfile(manifest_file):
+                os.remove(manifest_file)
+
+STAND_IN_TASK = '''
+import time
+time.sleep({})  # stands in for the azure, pandas and pydocumentdb imports
+
+def main(argv=None):
+    return 0
+
+if __name__ == '__main__':
+    main()
+'''
+
+def bench_node_worker(args):
+    # task start-up on a node: a python process per task, vs a unit on the warm node worker
+    import subprocess
+    import node_worker
+    count, import_seconds = int(args.tasks), float(args.importseconds)
+    tmpdir = tempfile.mkdtemp(prefix='bench-')
+    with open(os.path.join(tmpdir, 'stand_in_task.py'), 'wt') as f:
+        f.write(STAND_IN_TASK.format(import_seconds))
+    shutil.copy('node_worker.py', tmpdir)
+    env = dict(os.environ, AZ_BATCH_NODE_SHARED_DIR=tmpdir)
+    print('{} tasks, {}s of imports per cold start'.format(count, import_seconds))
+    widths = [12, 10, 14]
+    print_row(['tasks run', 'total (s)', 'per task (s)'], widths)
+    worker = None
+    try:
+        t1 = time.time()
+        for idx in range(count):
+            subprocess.check_call([sys.executable, 'stand_in_task.py'], cwd=tmpdir, env=env)
+        elapsed = time.time() - t1
+        print_row(['cold', '{:.2f}'.format(elapsed), '{:.3f}'.format(elapsed / count)], widths)
+
+        worker = subprocess.Popen(
+            [sys.executable, 'node_worker.py', '--func', 'serve', '--modules', 'stand_in_task'],
+            cwd=tmpdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        while not os.path.exists(node_worker.socket_path(tmpdir)):
+            time.sleep(0.1)
+        time.sleep(0.2)  # bound after the preload, listening just after
+        t1 = time.time()
+        for idx in range(count):
+            subprocess.check_call(
+                [sys.executable, 'node_worker.py', '--func', 'run', '--module', 'stand_in_task'],
+                cwd=tmpdir, env=env, stdout=subprocess.DEVNULL)
+        elapsed = time.time() - t1
+        print_row(['node worker', '{:.2f}'.format(elapsed), '{:.3f}'.format(elapsed / count)], widths)
+    finally:
+        if worker:
+            worker.terminate()
+            worker.wait()
+        shutil.rmtree(tmpdir)
+
+def postal_code_docs(count, cities, seed=42):
+    # documents as csv_etl_task.py builds them from the postal code csv rows
+    import random
+    from csv_etl_task import row_doc
+    rng = random.Random(seed)
+    header = ['id', 'postal_cd', 'country_cd', 'city_name', 'state_abbrv', 'latitude', 'longitude']
+    for idx in range(count):
+        city = 'City{}'.format(rng.randrange(cities))
+        yield row_doc(header, [str(idx), str(27000 + idx), 'US', city, 'NC',
+                               str(35.0 + rng.random()), str(-80.0 - rng.random())])
+
+def bench_cosmos_bulk(args):
+    # csv_etl_task.py's one CreateDocument per row, vs BulkWriter batches per partition key
+    from cosmos_bulk import BulkWriter
+    from cosmos_scheduler import WriteScheduler
+    count, cities, latency = int(args.docs), int(args.cities), float(args.latency)
+    print('{} documents in {} partitions, latency {}s/request, {} RU/s'.format(
+        count, cities, latency, args.ruthroughput))
+    coll_link = 'dbs/dev/colls/zipdata'
+    widths = [16, 10, 10, 10, 12, 10]
+    print_row(['ingest', 'seconds', 'docs/s', 'requests', 'RU', 'throttled'], widths)
+    for mode, concurrency in [('create', 1), ('upsert', 4), ('sproc', 1), ('sproc', 4), ('sproc', 8)]:
+        service = fakes.FakeCosmosService(request_latency=latency, seconds_per_doc=0.0002,
+                                          ru_per_second=float(args.ruthroughput), seed=42)
+        t1 = time.time()
+        if mode == 'create':
+            client, scheduler = service.client(), WriteScheduler(max_concurrency=1)
+            for doc in postal_code_docs(count, cities):
+                scheduler.call(client, client.CreateDocument, coll_link, doc)
+            requests = scheduler.report()['requests']
+        else:
+            writer = BulkWriter(service.client, coll_link, mode=mode, concurrency=concurrency)
+            with writer:
+                for doc in postal_code_docs(count, cities):
+                    writer.write(doc)
+            requests = writer.report()['requests']
+        elapsed = time.time() - t1
+        assert service.count(coll_link) == count
+        print_row(['{} x{}'.format(mode, concurrency), '{:.2f}'.format(elapsed), '{:.0f}'.format(count / elapsed),
+                   requests, '{:.0f}'.format(service.request_charge), service.throttles], widths)
+
+def bench_cosmos_scheduler(args):
+    # concurrent tasks sharing one collection: retrying 429s only, vs each within its share of the RU/s
+    import threading
+    from cosmos_bulk import BulkWriter
+    from cosmos_scheduler import WriteScheduler
+    tasks, count, latency = int(args.tasks), int(args.docs), float(args.latency)
+    ru_throughput = float(args.ruthroughput)
+    print('{} tasks of {} documents, {} RU/s collection, latency {}s/request'.format(
+        tasks, count, ru_throughput, latency))
+    coll_link = 'dbs/dev/colls/zipdata'
+    widths = [14, 10, 10, 10, 12, 14]
+    print_row(['tasks', 'seconds', 'docs/s', 'requests', 'throttled', 'effective RU/s'], widths)
+    for budget in ['none', 'share']:
+        service = fakes.FakeCosmosService(request_latency=latency, seconds_per_doc=0.0002,
+                                          ru_per_second=ru_throughput, seed=42)
+        writers = list()
+
+        def run_task(idx):
+            share = ru_throughput / tasks if budget == 'share' else 0
+            writer = BulkWriter(service.client, coll_link, mode='sproc', concurrency=4,
+                                scheduler=WriteScheduler(share, max_concurrency=4))
+            writers.append(writer)
+            with writer:
+                for doc in postal_code_docs(count, int(args.cities), seed=idx):
+                    doc['id'] = '{}-{}'.format(idx, doc['seq'])
+                    writer.write(doc)
+
+        t1 = time.time()
+        threads = [threading.Thread(target=run_task, args=(idx,)) for idx in range(tasks)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - t1
+        assert service.count(coll_link) == tasks * count
+        requests = sum(w.report()['requests'] for w in writers)
+        print_row(['{} x{}'.format(budget, tasks), '{:.2f}'.format(elapsed), '{:.0f}'.format(tasks * count / elapsed),
+                   requests, service.throttles, '{:.0f}'.format(service.request_charge / elapsed)], widths)
+
+def write_postal_code_csv(file_path, count, cities):
+    import csv
+    header = ['id', 'postal_cd', 'country_cd', 'city_name', 'state_abbrv', 'latitude', 'longitude']
+    with open(file_path, 'wt') as f:
+        w = csv.writer(f)
+        w.writerow(header)
+        for doc in postal_code_docs(count, cities):
+            w.writerow([doc['seq'], doc['postal_cd'], 'US', doc['city_name'], 'NC',
+                        doc['location']['coordinates'][1], doc['location']['coordinates'][0]])
+
+def bench_stream(args):
+    # parsing a csv blob staged to local disk first, as a resource file is, vs with ranged reads
+    import blob_stream
+    from csv_etl_task import csv_docs
+    count = int(args.docs)
+    tmpdir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        source = os.path.join(tmpdir, 'postal_codes.csv')
+        write_postal_code_csv(source, count, int(args.cities))
+        size = os.path.getsize(source)
+        blob_service = fakes.FakeBlobService(request_latency=float(args.latency), seconds_per_mb=float(args.secpermb))
+        blob_service.create_blob_from_path('batchcsv', 'postal_codes.csv', source)
+        print('{} rows, {:.1f} MB blob, latency {}s/request, {}s/MB'.format(
+            count, size / (1024.0 * 1024.0), args.latency, args.secpermb))
+        widths = [18, 10, 12, 14, 14, 12]
+        print_row(['read', 'seconds', 'rows/s', 'local MB', 'buffered MB', 'waiting (s)'], widths)
+
+        t1 = time.time()
+        staged = os.path.join(tmpdir, 'staged.csv')
+        with open(staged, 'wb') as f:
+            blob_service.get_blob_to_stream('batchcsv', 'postal_codes.csv', f)
+        rows = sum(1 for _ in csv_docs(staged))
+        elapsed = time.time() - t1
+        assert rows == count
+        print_row(['staged', '{:.2f}'.format(elapsed), '{:.0f}'.format(rows / elapsed),
+                   '{:.1f}'.format(size / (1024.0 * 1024.0)), '-', '-'], widths)
+        os.remove(staged)
+
+        for chunk_kb, read_ahead in [(1024, 1), (1024, 4), (4096, 4)]:
+            readers = list()
+
+            def opener(blob_name):
+                f = blob_stream.open_text(blob_service, 'batchcsv', blob_name,
+                                          chunk_bytes=chunk_kb * 1024, read_ahead=read_ahead)
+                readers.append(f.buffer.raw if hasattr(f, 'buffer') else f.raw)
+                return f
+
+            t1 = time.time()
+            rows = sum(1 for _ in csv_docs('postal_codes.csv', opener=opener))
+            elapsed = time.time() - t1
+            assert rows == count
+            r = readers[0].report()
+            print_row(['stream {}KB x{}'.format(chunk_kb, read_ahead), '{:.2f}'.format(elapsed),
+                       '{:.0f}'.format(rows / elapsed), '0.0', '{:.1f}'.format(r['max_buffered'] / (1024.0 * 1024.0)),
+                       '{:.2f}'.format(r['wait_seconds'])], widths)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_idempotent(args):
+    # a task which fails part way through its csv file, and is retried
+    from cosmos_bulk import BulkWriter
+    from csv_etl_task import csv_docs, idempotent_doc
+    from ingest_progress import ProgressWatermark
+    count, fail_at = int(args.docs), int(int(args.docs) * float(args.failrate))
+    tmpdir = tempfile.mkdtemp(prefix='bench-')
+    input_file = os.path.join(tmpdir, 'postal_codes.csv')
+    write_postal_code_csv(input_file, count, int(args.cities))
+    print('{} rows, the first attempt fails after row {}'.format(count, fail_at))
+    coll_link = 'dbs/dev/colls/zipdata'
+    widths = [12, 12, 14, 12, 10]
+    print_row(['ingest', 'docs', 'duplicates', 'rows sent', 'seconds'], widths)
+    try:
+        for idempotent in [False, True]:
+            service = fakes.FakeCosmosService(request_latency=float(args.latency), seed=42)
+            saved = dict()
+            rows_sent, t1 = 0, time.time()
+            for attempt in range(2):
+                progress = None
+                if idempotent:
+                    progress = ProgressWatermark.loads(saved.get('text'), lambda text: saved.update(text=text), 0.5)
+                writer = BulkWriter(service.client, coll_link, mode='sproc', concurrency=4)
+                if progress:
+                    writer.upsert, writer.on_written = True, progress.mark
+                try:
+                    with writer:
+                        start_row = progress.committed('postal_codes.csv') if progress else 0
+                        for row, doc in csv_docs(input_file, start_row):
+                            if attempt == 0 and row == fail_at:
+                                raise RuntimeError('task failed')
+                            rows_sent += 1
+                            if progress:
+                                writer.write(idempotent_doc(doc), ('postal_codes.csv', row))
+                            else:
+                                writer.write(doc)
+                    if progress:
+                        progress.finish('postal_codes.csv')
+                except RuntimeError:
+                    pass  # the retry resumes from the last periodic save of the watermark
+            elapsed = time.time() - t1
+            docs = service.count(coll_link)
+            print_row(['idempotent' if idempotent else 'create', docs, docs - count, rows_sent,
+                       '{:.2f}'.format(elapsed)], widths)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_shards(args):
+    # one process parsing a large csv file, vs shard processes parsing byte ranges of it, into one BulkWriter
+    import multiprocessing
+    from cosmos_bulk import BulkWriter
+    from csv_blocks import block_docs
+    from csv_etl_task import csv_docs
+    from csv_shards import ShardedReader
+    count = int(args.docs)
+    tmpdir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        input_file = os.path.join(tmpdir, 'postal_codes.csv')
+        write_postal_code_csv(input_file, count, int(args.cities))
+        size = os.path.getsize(input_file)
+
+        def open_at(offset):
+            f = open(input_file, 'rb')
+            f.seek(offset)
+            return f
+
+        print('{} rows, {:.1f} MB, {} cores'.format(count, size / (1024.0 * 1024.0), multiprocessing.cpu_count()))
+        widths = [10, 10, 12, 10, 22]
+        print_row(['shards', 'seconds', 'rows/s', 'speedup', 'shard rows/s'], widths)
+        baseline = None
+        for shards in [int(n) for n in args.shards.split(',')]:
+            service = fakes.FakeCosmosService(request_latency=0.0, seed=42)
+            writer = BulkWriter(service.client, 'dbs/dev/colls/zipdata', mode='sproc', concurrency=4)
+            t1, shard_rates = time.time(), '-'
+            with writer:
+                if shards < 2:
+                    for row, doc in csv_docs(input_file):
+                        writer.write(doc)
+                else:
+                    reader = ShardedReader(open_at, size, shards, block_docs)
+                    for start, row, doc in reader:
+                        writer.write(doc)
+                    rates = [s['rows_per_second'] for s in reader.report()['shards']]
+                    shard_rates = '{:.0f}-{:.0f}'.format(min(rates), max(rates))
+            elapsed = time.time() - t1
+            assert service.count('dbs/dev/colls/zipdata') == count
+            baseline = baseline or elapsed
+            print_row([shards, '{:.2f}'.format(elapsed), '{:.0f}'.format(count / elapsed),
+                       '{:.2f}x'.format(baseline / elapsed), shard_rates], widths)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_split(args):
+    # one task loading a large csv blob, vs byte-range tasks on separate nodes each loading its range
+    import io
+    import threading
+    import blob_stream
+    from csv_blocks import block_docs
+    from csv_shards import byte_ranges, parse_range, read_header
+    count = int(args.docs)
+    tmpdir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        source = os.path.join(tmpdir, 'postal_codes.csv')
+        write_postal_code_csv(source, count, int(args.cities))
+        size = os.path.getsize(source)
+        blob_service = fakes.FakeBlobService(request_latency=float(args.latency), seconds_per_mb=float(args.secpermb))
+        blob_service.create_blob_from_path('batchcsv', 'postal_codes.csv', source)
+
+        def open_at(offset):
+            reader = blob_stream.BlobRangeReader(blob_service, 'batchcsv', 'postal_codes.csv', start=offset,
+                                                 chunk_bytes=1024 * 1024, read_ahead=4)
+            return io.BufferedReader(reader, 1024 * 1024)
+
+        print('{} rows, {:.1f} MB blob, latency {}s/request, {}s/MB'.format(
+            count, size / (1024.0 * 1024.0), args.latency, args.secpermb))
+        widths = [8, 10, 12, 10, 16]
+        print_row(['tasks', 'seconds', 'rows/s', 'speedup', 'task rows'], widths)
+        baseline = None
+        for tasks in [int(n) for n in args.ranges.split(',')]:
+            ranges = byte_ranges(0, size, tasks)
+            rows = [list() for _ in ranges]
+
+            def run_task(idx):
+                # each task reads the header from the start of the blob, then aligns its range
+                start, end = ranges[idx]
+                header, data_start = read_header(open_at)
+                for row, doc in parse_range(open_at, header, max(start, data_start), end, block_docs):
+                    rows[idx].append(doc['seq'])
+
+            t1 = time.time()
+            threads = [threading.Thread(target=run_task, args=(idx,)) for idx in range(len(ranges))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.time() - t1
+            seqs = [seq for task_rows in rows for seq in task_rows]
+            assert len(seqs) == count and len(set(seqs)) == count
+            baseline = baseline or elapsed
+            print_row([tasks, '{:.2f}'.format(elapsed), '{:.0f}'.format(count / elapsed),
+                       '{:.2f}x'.format(baseline / elapsed),
+                       '{}-{}'.format(min(len(r) for r in rows), max(len(r) for r in rows))], widths)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def bench_transform(args):
+    # csv_etl_task.py's previous row_doc per row, vs csv_blocks.py's BlockTransformer per block of rows,
+    # with the coordinates converted in python or numpy, or the blocks parsed columnar by pandas
+    import csv
+    import itertools
+    from csv_blocks import DEFAULT_BLOCK_ROWS, BlockTransformer, python_floats
+    from csv_etl_task import row_doc
+    count, block_rows = int(args.docs), DEFAULT_BLOCK_ROWS
+    tmpdir = tempfile.mkdtemp(prefix='bench-')
+
+    def csv_blocks():
+        with open(input_file, 'rt') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            while True:
+                rows = list(itertools.islice(reader, block_rows))
+                if not rows:
+                    break
+                yield header, rows
+
+    def csv_only():
+        for header, rows in csv_blocks():
+            yield rows
+
+    def row_docs():
+        for header, rows in csv_blocks():
+            yield [row_doc(header, row) for row in rows]
+
+    def block_docs(float_column):
+        transformer = None
+        for header, rows in csv_blocks():
+            transformer = transformer or BlockTransformer(header, float_column)
+            yield transformer.docs(rows)
+
+    def pandas_docs():
+        # read_csv parses each chunk in C; the fields stay strings, as in the documents, and
+        # the coordinates are converted by numpy (to_numeric is not correctly rounded)
+        transformer = None
+        for chunk in pandas.read_csv(input_file, chunksize=block_rows, dtype=str, na_filter=False):
+            header = list(chunk.columns)
+            transformer = transformer or BlockTransformer(header)
+            rows = list(zip(*[chunk[field].tolist() for field in header]))
+            yield transformer.docs(rows, chunk['latitude'].astype(numpy.float64).tolist(),
+                                   chunk['longitude'].astype(numpy.float64).tolist())
+
+    def numpy_floats(values):
+        return numpy.array(values, dtype=numpy.float64).tolist()
+
+    transforms = [('csv only', csv_only), ('row_doc', row_docs),
+                  ('block, python floats', lambda: block_docs(python_floats))]
+    try:
+        import numpy
+        transforms.append(('block, numpy floats', lambda: block_docs(numpy_floats)))
+    except ImportError:
+        print('numpy is not installed; no numpy column conversion')
+    try:
+        import numpy
+        import pandas
+        transforms.append(('pandas read_csv chunks', pandas_docs))
+    except ImportError:
+        print('pandas is not installed; no columnar csv parse')
+
+    try:
+        input_file = os.path.join(tmpdir, 'postal_codes.csv')
+        write_postal_code_csv(input_file, count, int(args.cities))
+        expected = next(row_docs())
+        for name, transform in transforms[2:]:
+            assert next(transform()) == expected, name
+        print('{} rows, {:.1f} MB, blocks of {} rows; the best of 2 runs'.format(
+            count, os.path.getsize(input_file) / (1024.0 * 1024.0), block_rows))
+        widths = [24, 10, 12, 12]
+        print_row(['transform', 'seconds', 'rows/s', 'vs row_doc'], widths)
+        baseline = None
+        for name, transform in transforms:
+            elapsed = None
+            for attempt in range(2):
+                t1, rows = time.time(), 0
+                for docs in transform():
+                    rows += len(docs)  # each block is kept until the next, as the writer keeps its batches
+                assert rows == count
+                elapsed = min(elapsed or float('inf'), time.time() - t1)
+            if transform == row_docs:
+                baseline = elapsed
+            print_row([name, '{:.2f}'.format(elapsed), '{:.0f}'.format(count / elapsed),
+                       '{:.2f}x'.format(baseline / elapsed) if baseline else '-'], widths)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--func',        required=True,  help='The benchmark to run')
+    parser.add_argument('--files',       required=False, help='Number of files to upload', default='100')
+    parser.add_argument('--kb',          required=False, help='Size of each file in KB', default='64')
+    parser.add_argument('--latency',     required=False, help='Simulated seconds per service request', default='0.02')
+    parser.add_argument('--secpermb',    required=False, help='Simulated seconds per MB transferred', default='0.05')
+    parser.add_argument('--concurrency', required=False, help='Comma-separated concurrency levels', default='1,2,4,8,16,32')
+    parser.add_argument('--tasks',       required=False, help='Number of tasks to submit', default='10000')
+    parser.add_argument('--busyrate',    required=False, help='Simulated fraction of throttled requests', default='0.02')
+    parser.add_argument('--duration',    required=False, help='Maximum simulated task duration in seconds', default='10')
+    parser.add_argument('--pollinterval', required=False, help='Polling interval in seconds of the previous monitor loop', default='1')
+    parser.add_argument('--runs',        required=False, help='Number of consecutive jobs', default='5')
+    parser.add_argument('--allocation',  required=False, help='Simulated pool allocation seconds', default='3')
+    parser.add_argument('--failrate',    required=False, help='Simulated fraction of failed tasks', default='0.03')
+    parser.add_argument('--docs',        required=False, help='Number of CosmosDB documents to write', default='5000')
+    parser.add_argument('--cities',      required=False, help='Number of distinct partition keys', default='200')
+    parser.add_argument('--ruthroughput', required=False, help='Simulated provisioned CosmosDB RU/s; 0 for unlimited', default='10000')
+    parser.add_argument('--shards',      required=False, help='Comma-separated numbers of csv parsing processes', default='1,2,4')
+    parser.add_argument('--ranges',      required=False, help='Comma-separated numbers of byte-range tasks of one blob', default='1,4,8')
+    parser.add_argument('--importseconds', required=False, help='Simulated seconds of imports at task start-up', default='1.5')
+    args = parser.parse_args()
+
+    if args.func == 'upload':
+        bench_upload(args)
+    elif args.func == 'upload_cache':
+        bench_upload_cache(args)
+    elif args.func == 'submit':
+        bench_submit(args)
+    elif args.func == 'monitor':
+        bench_monitor(args)
+    elif args.func == 'output':
+        bench_output(args)
+    elif args.func == 'pool_reuse':
+        bench_pool_reuse(args)
+    elif args.func == 'download':
+        bench_download(args)
+    elif args.func == 'resume':
+        bench_resume(args)
+    elif args.func == 'retry':
+        bench_retry(args)
+    elif args.func == 'async':
+        bench_async(args)
+    elif args.func == 'pipeline':
+        bench_pipeline(args)
+    elif args.func == 'node_worker':
+        bench_node_worker(args)
+    elif args.func == 'cosmos_bulk':
+        bench_cosmos_bulk(args)
+    elif args.func == 'cosmos_scheduler':
+        bench_cosmos_scheduler(args)
+    elif args.func == 'idempotent':
+        bench_idempotent(args)
+    elif args.func == 'stream':
+        bench_stream(args)
+    elif args.func == 'shards':
+        bench_shards(args)
+    elif args.func == 'split':
+        bench_split(args)
+    elif args.func == 'transform':
+        bench_transform(args)
+    else:
+        print('invalid function: {}'.format(args.func))
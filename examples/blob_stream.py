@@ -0,0 +1,157 @@
+from __future__ import division, print_function
+import io
+import sys
+import threading
+import time
+
+# Streaming reads of a blob, or a byte range of it, with ranged GETs, so that
+# a task can parse a large csv blob without first staging it to local disk
+# as a Batch resource file.
+#
+# BlobRangeReader is a raw, read-only file object over the blob.  It is read
+# in chunks of chunk_bytes; read_ahead fetcher threads fetch the chunks in
+# order, at most read_ahead chunks ahead of the reader, so memory stays
+# within about (read_ahead + 1) * chunk_bytes however large the blob is.
+# open_text() wraps it for csv.reader, and open_binary() for pandas.
+#
+# The blob service is a BlockBlobService, e.g. created with the container's
+# SAS token, which needs read permission.
+
+DEFAULT_CHUNK_BYTES = 4 * 1024 * 1024
+DEFAULT_READ_AHEAD = 4
+MAX_ATTEMPTS = 4
+
+
+def blob_size(blob_service, container_name, blob_name):
+    return blob_service.get_blob_properties(container_name, blob_name).properties.content_length
+
+
+class BlobRangeReader(io.RawIOBase):
+
+    def __init__(self, blob_service, container_name, blob_name, start=0, end=None,
+                 chunk_bytes=DEFAULT_CHUNK_BYTES, read_ahead=DEFAULT_READ_AHEAD):
+        # reads bytes start to end, exclusive; end None for the end of the blob
+        io.RawIOBase.__init__(self)
+        self.blob_service = blob_service
+        self.container_name = container_name
+        self.blob_name = blob_name
+        if end is None:
+            end = blob_size(blob_service, container_name, blob_name)
+        self.start = int(start)
+        self.end = max(self.start, int(end))
+        self.chunk_bytes = max(1, int(chunk_bytes))
+        self.read_ahead = max(1, int(read_ahead))
+        self.chunk_count = (self.end - self.start + self.chunk_bytes - 1) // self.chunk_bytes
+        self.next_fetch = 0
+        self.next_read = 0
+        self.chunks = dict()   # chunk index -> bytes, or the exception which failed its fetch
+        self.current = b''
+        self.offset = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.counters = dict()
+        self.counters['bytes'] = 0
+        self.counters['requests'] = 0
+        self.counters['retries'] = 0
+        self.counters['wait_seconds'] = 0.0   # the reader waiting on the network
+        self.counters['max_buffered'] = 0
+        self.threads = list()
+        for idx in range(min(self.read_ahead, self.chunk_count)):
+            t = threading.Thread(target=self.fetcher, name='blob-stream-{}'.format(idx))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def readable(self):
+        return True
+
+    def fetcher(self):
+        while True:
+            with self.condition:
+                while not self.stopped and self.next_fetch < self.chunk_count and \
+                        self.next_fetch >= self.next_read + self.read_ahead:
+                    self.condition.wait()
+                if self.stopped or self.next_fetch >= self.chunk_count:
+                    return
+                idx = self.next_fetch
+                self.next_fetch += 1
+            try:
+                data = self.fetch(idx)
+            except Exception as e:
+                data = e
+            with self.condition:
+                self.chunks[idx] = data
+                if not isinstance(data, Exception):
+                    buffered = sum(len(c) for c in self.chunks.values() if not isinstance(c, Exception))
+                    self.counters['max_buffered'] = max(self.counters['max_buffered'], buffered)
+                self.condition.notify_all()
+
+    def fetch(self, idx):
+        # the bytes of the chunk, retried a few times; end_range is inclusive
+        start = self.start + idx * self.chunk_bytes
+        end = min(self.end, start + self.chunk_bytes) - 1
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                blob = self.blob_service.get_blob_to_bytes(
+                    self.container_name, self.blob_name, start_range=start, end_range=end, max_connections=1)
+                with self.condition:
+                    self.counters['requests'] += 1
+                    self.counters['bytes'] += len(blob.content)
+                return blob.content
+            except Exception:
+                if attempt >= MAX_ATTEMPTS or self.stopped:
+                    raise
+                with self.condition:
+                    self.counters['retries'] += 1
+                time.sleep(0.5 * (2 ** attempt))
+
+    def next_chunk(self):
+        with self.condition:
+            t1 = time.time()
+            while self.next_read not in self.chunks:
+                self.condition.wait()
+            self.counters['wait_seconds'] += time.time() - t1
+            data = self.chunks.pop(self.next_read)
+            self.next_read += 1
+            self.condition.notify_all()
+        if isinstance(data, Exception):
+            raise data
+        return data
+
+    def readinto(self, b):
+        if self.offset >= len(self.current):
+            if self.next_read >= self.chunk_count:
+                return 0
+            self.current, self.offset = self.next_chunk(), 0
+        n = min(len(b), len(self.current) - self.offset)
+        b[:n] = self.current[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        io.RawIOBase.close(self)
+
+    def report(self):
+        with self.condition:
+            r = dict(self.counters)
+        r['blob'] = self.blob_name
+        r['range'] = [self.start, self.end]
+        r['wait_seconds'] = round(r['wait_seconds'], 3)
+        return r
+
+
+def open_binary(blob_service, container_name, blob_name, **kwargs):
+    # a buffered binary file object, e.g. for pandas.read_csv
+    return io.BufferedReader(BlobRangeReader(blob_service, container_name, blob_name, **kwargs), 1024 * 1024)
+
+def open_text(blob_service, container_name, blob_name, **kwargs):
+    # lines for csv.reader: str lines, which are bytes on python 2.7
+    binary = open_binary(blob_service, container_name, blob_name, **kwargs)
+    if sys.version_info[0] < 3:
+        return binary
+    return io.TextIOWrapper(binary, encoding='utf-8', newline='')
@@ -0,0 +1,251 @@
+from __future__ import division, print_function
+import json
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # python 2.7, the node's python
+
+import pydocumentdb.errors as errors
+
+from cosmos_scheduler import WriteScheduler
+
+# Bulk ingestion of documents into a partitioned CosmosDB collection, used by
+# csv_etl_task.py in place of one synchronous CreateDocument per csv row.
+#
+# BulkWriter groups the documents by partition key into batches, and a
+# bounded number of writer threads write the batches concurrently; write()
+# blocks while the queue of batches is full, so the whole file is never held
+# in memory.  A batch is either a single execution of the bulkImport stored
+# procedure (mode 'sproc'), which runs within one partition, or a sequence of
+# UpsertDocument calls (mode 'upsert').  Each writer thread has its own
+# DocumentClient, so the request charge of each response can be read from
+# its last_response_headers.  The requests go through a WriteScheduler (see
+# cosmos_scheduler.py), which keeps the writers within the task's share of
+# the collection's RU/s and retries throttled (429) requests.
+
+MODES = ['sproc', 'upsert']
+BULK_IMPORT_SPROC_ID = 'bulkImport'
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_MAX_BATCH_KB = 1024  # well below the 2MB stored procedure request limit
+
+# Creates, or with upsert true upserts, the documents in order until the
+# execution is out of time; returns the number written, and the caller
+# re-submits the rest.  Throwing rolls back the whole execution.
+BULK_IMPORT_SPROC_BODY = """
+function bulkImport(docs, upsert) {
+    var collection = getContext().getCollection();
+    var link = collection.getSelfLink();
+    var count = 0;
+    if (!docs || docs.length == 0) {
+        getContext().getResponse().setBody(0);
+        return;
+    }
+    write(docs[count]);
+
+    function write(doc) {
+        var accepted = upsert ?
+            collection.upsertDocument(link, doc, written) :
+            collection.createDocument(link, doc, written);
+        if (!accepted) {
+            getContext().getResponse().setBody(count);
+        }
+    }
+
+    function written(err, doc, options) {
+        if (err) throw err;
+        count++;
+        if (count >= docs.length) {
+            getContext().getResponse().setBody(count);
+        } else {
+            write(docs[count]);
+        }
+    }
+}
+"""
+
+
+def sproc_link(coll_link, sproc_id=BULK_IMPORT_SPROC_ID):
+    return '{}/sprocs/{}'.format(coll_link, sproc_id)
+
+def ensure_bulk_import_sproc(client, coll_link):
+    # created by the first task to need it; concurrent tasks may race to create it
+    try:
+        client.ReadStoredProcedure(sproc_link(coll_link))
+        return
+    except errors.HTTPFailure as e:
+        if e.status_code != 404:
+            raise
+    try:
+        client.CreateStoredProcedure(coll_link, {'id': BULK_IMPORT_SPROC_ID, 'body': BULK_IMPORT_SPROC_BODY})
+    except errors.HTTPFailure as e:
+        if e.status_code != 409:
+            raise
+
+def doc_size(doc):
+    return len(json.dumps(doc))
+
+def has_ids(docs):
+    # an upsert of documents with their own ids replaces them if repeated; without, it creates new ones
+    return all('id' in doc for doc in docs)
+
+
+class BulkWriter(object):
+
+    def __init__(self, client_factory, coll_link, mode='sproc', concurrency=4, batch_size=DEFAULT_BATCH_SIZE,
+                 max_batch_kb=DEFAULT_MAX_BATCH_KB, max_retries=20, pk_field='pk', scheduler=None):
+        # client_factory is called once per writer thread, and returns a DocumentClient
+        if mode not in MODES:
+            raise ValueError('invalid bulk ingestion mode: {}'.format(mode))
+        self.client_factory = client_factory
+        self.coll_link = coll_link
+        self.mode = mode
+        self.concurrency = max(1, int(concurrency))
+        self.batch_size = max(1, int(batch_size))
+        self.max_batch_bytes = int(max_batch_kb) * 1024
+        self.max_retries = int(max_retries)
+        self.pk_field = pk_field
+        self.scheduler = scheduler or WriteScheduler(max_concurrency=self.concurrency, max_retries=max_retries)
+        self.upsert = False        # with mode sproc, create rather than upsert
+        self.batches = queue.Queue(maxsize=self.concurrency * 2)
+        self.buffers = dict()      # partition key -> [list of documents, bytes, list of tokens]
+        self.buffered = 0
+        self.max_buffered = self.batch_size * self.concurrency * 4
+        self.threads = list()
+        self.error = None
+        self.on_written = None     # if set, called with the tokens of each written batch
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.counters['docs'] = 0
+        self.counters['batches'] = 0
+        self.counters['min_batch'] = None
+        self.counters['max_batch'] = 0
+        self.counters['max_queue_depth'] = 0
+        self.counters['queue_depth_total'] = 0
+        self.counters['elapsed'] = 0.0
+        self.started = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close(raise_error=exc_type is None)
+
+    def start(self):
+        self.started = time.time()
+        if self.mode == 'sproc':
+            ensure_bulk_import_sproc(self.client_factory(), self.coll_link)
+        for idx in range(self.concurrency):
+            t = threading.Thread(target=self.writer, name='bulk-writer-{}'.format(idx))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def write(self, doc, token=None):
+        # the token, e.g. the document's row, is passed to on_written once the document is written
+        if self.error:
+            raise self.error
+        pk = doc[self.pk_field]
+        buf = self.buffers.setdefault(pk, [list(), 0, list()])
+        buf[0].append(doc)
+        buf[1] += doc_size(doc)
+        if token is not None:
+            buf[2].append(token)
+        self.buffered += 1
+        if len(buf[0]) >= self.batch_size or buf[1] >= self.max_batch_bytes:
+            self.submit(pk)
+        elif self.buffered > self.max_buffered:
+            # many partition keys with few documents each; the largest partial batch goes first
+            self.submit(max(self.buffers, key=lambda k: len(self.buffers[k][0])))
+
+    def submit(self, pk):
+        docs, nbytes, tokens = self.buffers.pop(pk)
+        self.buffered -= len(docs)
+        depth = self.batches.qsize()
+        with self.lock:
+            self.counters['max_queue_depth'] = max(self.counters['max_queue_depth'], depth)
+            self.counters['queue_depth_total'] += depth
+        self.batches.put((pk, docs, tokens))  # blocks while concurrency * 2 batches are waiting
+
+    def close(self, raise_error=True):
+        """
+        Write the partly filled batches and wait for the writers; raises the
+        first write error, after which the remaining batches were skipped.
+        """
+        for pk in list(self.buffers.keys()):
+            self.submit(pk)
+        for t in self.threads:
+            self.batches.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = list()
+        if self.started:
+            self.counters['elapsed'] = time.time() - self.started
+        if self.error and raise_error:
+            raise self.error
+
+    def writer(self):
+        client = None
+        while True:
+            item = self.batches.get()
+            if item is None:
+                return
+            if self.error:
+                continue  # drained, so that write() and close() do not block
+            try:
+                if client is None:
+                    client = self.client_factory()
+                self.write_batch(client, item[0], item[1])
+                if self.on_written and item[2]:
+                    self.on_written(item[2])
+            except Exception as e:
+                with self.lock:
+                    self.error = self.error or e
+
+    def write_batch(self, client, pk, docs):
+        if self.mode == 'sproc':
+            link = sproc_link(self.coll_link)
+            remaining, stalled = docs, 0
+            while remaining:
+                count = int(self.scheduler.call(client, client.ExecuteStoredProcedure,
+                                                link, [remaining, self.upsert], {'partitionKey': pk},
+                                                ndocs=len(remaining), idempotent=self.upsert and has_ids(remaining)) or 0)
+                stalled = 0 if count else stalled + 1
+                if stalled > self.max_retries:
+                    raise RuntimeError('bulkImport wrote none of {} documents for {}'.format(len(remaining), pk))
+                remaining = remaining[count:]
+        else:
+            for doc in docs:
+                self.scheduler.call(client, client.UpsertDocument, self.coll_link, doc, idempotent=has_ids([doc]))
+        with self.lock:
+            self.counters['docs'] += len(docs)
+            self.counters['batches'] += 1
+            self.counters['max_batch'] = max(self.counters['max_batch'], len(docs))
+            if self.counters['min_batch'] is None or len(docs) < self.counters['min_batch']:
+                self.counters['min_batch'] = len(docs)
+
+    def report(self):
+        # the writer's counters, and the scheduler's
+        with self.lock:
+            r = dict(self.counters)
+        r.update(self.scheduler.report())
+        r['mode'] = self.mode
+        r['concurrency'] = self.concurrency
+        elapsed = r['elapsed'] or (time.time() - self.started if self.started else 0.0)
+        r['docs_per_second'] = round(r['docs'] / elapsed, 1) if elapsed > 0 else 0.0
+        r['mean_batch'] = round(r['docs'] / r['batches'], 1) if r['batches'] else 0.0
+        r['mean_queue_depth'] = round(r.pop('queue_depth_total') / r['batches'], 2) if r['batches'] else 0.0
+        r['elapsed'] = round(elapsed, 3)
+        return r
+
+    def print_report(self):
+        r = self.report()
+        print('bulk {}: {} docs in {:.1f}s, {} docs/s; {} batches of {}-{} docs (mean {}); '
+              'queue depth mean {}, max {}'.format(
+                  r['mode'], r['docs'], r['elapsed'], r['docs_per_second'], r['batches'],
+                  r['min_batch'] or 0, r['max_batch'], r['mean_batch'], r['mean_queue_depth'],
+                  r['max_queue_depth']))
+        self.scheduler.print_report()
@@ -0,0 +1,252 @@
+from __future__ import division, print_function
+import math
+import sys
+import threading
+import time
+
+import pydocumentdb.errors as errors
+
+# Request unit aware scheduling of CosmosDB writes, shared by the concurrent
+# writers of one task.
+#
+# A collection's provisioned throughput is shared by every Batch task which
+# writes to it, so each task is given a share in request units per second,
+# e.g. csv_etl_client.py divides the collection's RU/s by the number of task
+# slots in the pool.  WriteScheduler.call() runs a CosmosDB request:
+#
+# - under a token bucket of that many RU/s; the charge of a request is not
+#   known until it returns, so tokens for an estimate are taken before it,
+#   from the mean charge observed per document, and settled after it
+# - within a concurrency limit, which grows by one per round of requests
+#   without throttling, up to what the RU/s share can keep busy at the
+#   observed charge and latency, and is halved on a 429
+# - with 429s retried after the service's x-ms-retry-after-ms, during which
+#   all the writers of the task pause rather than each stampeding back
+# - with 408 and 503, after which the write may have been applied, retried
+#   only for an idempotent request: an upsert of documents whose ids are
+#   derived from their rows.  Retrying a create with a server-assigned id
+#   could duplicate the document, so its 408 or 503 is raised.
+#
+# The report has the throttle rate, the effective RU/s, the concurrency and
+# the time spent waiting.
+
+RETRIABLE_STATUS_CODES = [429, 449]             # the write was not applied
+IDEMPOTENT_RETRIABLE_STATUS_CODES = [408, 503]  # the write may have been applied
+DEFAULT_CHARGE_PER_DOC = 6.0   # about a 1KB document write
+EWMA_WEIGHT = 0.2
+
+
+def retry_after_seconds(err, default=1.0):
+    headers = getattr(err, 'headers', None) or dict()
+    value = headers.get('x-ms-retry-after-ms')
+    try:
+        return float(value) / 1000.0 if value is not None else default
+    except ValueError:
+        return default
+
+def request_charge(client):
+    headers = getattr(client, 'last_response_headers', None) or dict()
+    try:
+        return float(headers.get('x-ms-request-charge', 0))
+    except ValueError:
+        return 0.0
+
+
+class RequestUnitBucket(object):
+    """
+    A token bucket of ru_per_second request units, holding at most one
+    second's worth; 0 is unlimited.  take() may overdraw, for a request
+    larger than the bucket, and the debt is repaid before the next take.
+    """
+
+    def __init__(self, ru_per_second=0.0, sleep=time.sleep):
+        self.rate = float(ru_per_second or 0)
+        self.capacity = self.rate
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.paused_until = 0.0
+        self.sleep = sleep
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, ru):
+        # the seconds waited for the tokens, or for a pause after a 429
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.time()
+                delay = self.paused_until - now
+                if delay <= 0 and self.rate > 0:
+                    self.refill(now)
+                    needed = min(ru, self.capacity)
+                    if self.tokens >= needed:
+                        self.tokens -= ru
+                        return waited
+                    delay = (needed - self.tokens) / self.rate
+                elif delay <= 0:
+                    return waited
+            self.sleep(delay)
+            waited += delay
+
+    def settle(self, estimate, actual):
+        if self.rate > 0:
+            with self.lock:
+                self.tokens = min(self.capacity, self.tokens + estimate - actual)
+
+    def pause(self, seconds):
+        # the service's retry-after; nothing more is sent until then
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+            self.tokens = min(self.tokens, 0.0)
+            self.updated = time.time()
+
+
+class WriteScheduler(object):
+
+    def __init__(self, ru_per_second=0.0, max_concurrency=8, max_retries=20, sleep=time.sleep):
+        self.bucket = RequestUnitBucket(ru_per_second, sleep)
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_retries = int(max_retries)
+        self.sleep = sleep
+        self.limit = self.max_concurrency if not self.bucket.rate else 1  # with a budget, start slow
+        self.in_flight = 0
+        self.waiting = 0
+        self.successes = 0
+        self.last_decrease = 0.0
+        self.charge_per_doc = DEFAULT_CHARGE_PER_DOC
+        self.seconds_per_doc = None
+        self.condition = threading.Condition()
+        self.started = time.time()
+        self.counters = dict()
+        self.counters['requests'] = 0
+        self.counters['throttles'] = 0
+        self.counters['throttle_seconds'] = 0.0
+        self.counters['token_wait_seconds'] = 0.0
+        self.counters['slot_wait_seconds'] = 0.0
+        self.counters['request_charge'] = 0.0
+        self.counters['max_waiting'] = 0
+        self.counters['min_limit'] = self.limit
+        self.counters['max_limit'] = self.limit
+
+    def call(self, client, func, *args, **kwargs):
+        """
+        func(*args) on the client, a DocumentClient whose last_response_headers
+        give the request charge; ndocs, the documents written by the request,
+        sizes the estimate.  Retriable failures are retried after the
+        retry-after; others are raised.  idempotent, true when repeating the
+        request cannot duplicate a document, also retries 408 and 503.
+        """
+        ndocs = kwargs.get('ndocs', 1)
+        retriable = RETRIABLE_STATUS_CODES
+        if kwargs.get('idempotent', False):
+            retriable = RETRIABLE_STATUS_CODES + IDEMPOTENT_RETRIABLE_STATUS_CODES
+        attempt = 0
+        while True:
+            attempt += 1
+            estimate = self.charge_per_doc * max(1, ndocs)
+            self.enter()
+            try:
+                self.count('token_wait_seconds', self.bucket.take(estimate))
+                t1 = time.time()
+                result = func(*args)
+                self.succeeded(estimate, request_charge(client), ndocs, time.time() - t1)
+                return result
+            except errors.HTTPFailure as e:
+                self.bucket.settle(estimate, 0.0)
+                if e.status_code not in retriable or attempt > self.max_retries:
+                    self.count('requests')
+                    raise
+                retry_after = self.throttled(retry_after_seconds(e))
+            finally:
+                self.exit()
+            self.sleep(retry_after)  # outside the slot
+
+    def enter(self):
+        with self.condition:
+            if self.in_flight >= self.limit:
+                t1 = time.time()
+                self.waiting += 1
+                self.counters['max_waiting'] = max(self.counters['max_waiting'], self.waiting)
+                while self.in_flight >= self.limit:
+                    self.condition.wait()
+                self.waiting -= 1
+                self.counters['slot_wait_seconds'] += time.time() - t1
+            self.in_flight += 1
+
+    def exit(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def count(self, key, value=1):
+        with self.condition:
+            self.counters[key] += value
+
+    def set_limit(self, limit):
+        # called with the condition held
+        self.limit = max(1, min(self.max_concurrency, limit))
+        self.counters['min_limit'] = min(self.counters['min_limit'], self.limit)
+        self.counters['max_limit'] = max(self.counters['max_limit'], self.limit)
+        self.condition.notify_all()
+
+    def ceiling(self):
+        # the concurrency which keeps the RU/s share busy at the observed charge and latency, with headroom
+        if not self.bucket.rate or self.seconds_per_doc is None:
+            return self.max_concurrency
+        return int(math.ceil(1.5 * self.bucket.rate * self.seconds_per_doc / max(self.charge_per_doc, 1.0)))
+
+    def succeeded(self, estimate, charge, ndocs, seconds):
+        self.bucket.settle(estimate, charge)
+        with self.condition:
+            self.counters['requests'] += 1
+            self.counters['request_charge'] += charge
+            if charge > 0:
+                per_doc = charge / max(1, ndocs)
+                self.charge_per_doc += EWMA_WEIGHT * (per_doc - self.charge_per_doc)
+            per_doc_seconds = seconds / max(1, ndocs)
+            self.seconds_per_doc = per_doc_seconds if self.seconds_per_doc is None else \
+                self.seconds_per_doc + EWMA_WEIGHT * (per_doc_seconds - self.seconds_per_doc)
+            self.successes += 1
+            if self.successes >= self.limit:
+                self.successes = 0
+                self.set_limit(min(self.limit + 1, max(1, self.ceiling())))
+
+    def throttled(self, retry_after):
+        self.bucket.pause(retry_after)
+        with self.condition:
+            self.counters['requests'] += 1
+            self.counters['throttles'] += 1
+            self.counters['throttle_seconds'] += retry_after
+            now = time.time()
+            if now >= self.last_decrease + retry_after:
+                # once per retry-after, as the writers in flight are throttled together
+                self.last_decrease = now
+                self.successes = 0
+                self.set_limit(self.limit // 2)
+        return retry_after
+
+    def report(self):
+        with self.condition:
+            r = dict(self.counters)
+            r['limit'] = self.limit
+            r['waiting'] = self.waiting
+            r['charge_per_doc'] = round(self.charge_per_doc, 2)
+        elapsed = time.time() - self.started
+        r['ru_per_second'] = self.bucket.rate
+        r['effective_ru_per_second'] = round(r['request_charge'] / elapsed, 1) if elapsed > 0 else 0.0
+        r['throttle_rate'] = round(r['throttles'] / r['requests'], 4) if r['requests'] else 0.0
+        for key in ['request_charge', 'throttle_seconds', 'token_wait_seconds', 'slot_wait_seconds']:
+            r[key] = round(r[key], 2)
+        return r
+
+    def print_report(self):
+        r = self.report()
+        print('cosmos writes: {} requests, {} RU, {} RU/s effective of {}; {} throttled ({:.1%}), {:.1f}s; '
+              'concurrency {} ({}-{}), {:.1f}s waiting for RU, {:.1f}s for a slot, at most {} waiting'.format(
+                  r['requests'], r['request_charge'], r['effective_ru_per_second'], r['ru_per_second'] or 'unlimited',
+                  r['throttles'], r['throttle_rate'], r['throttle_seconds'], r['limit'], r['min_limit'],
+                  r['max_limit'], r['token_wait_seconds'], r['slot_wait_seconds'], r['max_waiting']))
+        sys.stdout.flush()
@@ -16,6 +16,8 @@ import pydocumentdb.documents as documents
 import pydocumentdb.document_client as document_client
 import pydocumentdb.errors as errors
 
+from cosmos_scheduler import WriteScheduler
+
 # https://github.com/Azure/azure-documentdb-python
 # db: dev  collection: zipdata with /pk
 # Chris Joakim, Microsoft, 2018/09/13
@@ -60,8 +62,10 @@ if __name__ == '__main__':
         data = dict()
         data['pk'] = '1'
         data['epoch'] = int(time.time())
-        doc = client.CreateDocument(coll_link, data)
+        scheduler = WriteScheduler()  # retries a 429 after its retry-after
+        doc = scheduler.call(client, client.CreateDocument, coll_link, data)
         print(doc)
+        scheduler.print_report()
 
     elif args.func == 'query_all_zipdata_docs':
         client = create_client()
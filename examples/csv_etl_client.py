@@ -1,6 +1,5 @@
 from __future__ import print_function
 import argparse
-import datetime
 import os
 import sys
 import time
@@ -8,11 +7,13 @@ import time
 import azure.storage.blob as azureblob
 import azure.batch.batch_service_client as batch
 import azure.batch.batch_auth as batchauth
-import azure.batch.models as batchmodels
 
 sys.path.append('.')
 import helpers
+from async_batch_client import async_variant
 from batch_client import BatchClient
+import csv_shards
+import node_slots
 
 # Azure Batch client program which submits a job.
 # Chris Joakim, Microsoft, 2018/09/13
@@ -24,48 +25,114 @@ class CsvEtlBatchClient(BatchClient):
 
     def __init__(self, args):
         BatchClient.__init__(self, args)
-
-    def add_tasks(self):
-        tasks = list()
+        self.task_inputs = dict()  # task id -> the input names of the task, for the job manifest
+
+    def task_profile(self):
+        # the task mostly waits on CosmosDB writes, unless it parses its files in several processes
+        shards = int(self.args.shards)
+        if shards > 1:
+            return node_slots.TaskProfile(cores=shards, memory_mb=256 + 64 * shards)
+        return node_slots.TaskProfile(cores=0.5, memory_mb=256)
+
+    def task_output_blobs(self, task_id, input_names):
+        # csv_etl_task.py writes one log blob per task; the documents go to CosmosDB
+        return dict((name, ['{}-{}-log_data.json'.format(self.JOB_ID, task_id)]) for name in input_names)
+
+    def ru_per_task(self):
+        # an equal share of the collection's throughput for each task which may run at once
+        nodes = self.autoscale.max_nodes if self.autoscale else self.POOL_NODE_COUNT
+        return round(float(self.args.ruthroughput) / max(1, nodes * self.TASK_SLOTS), 1)
+
+    def byte_ranges(self, blob):
+        # [start, end) ranges of a blob larger than --splitmb, one per task; None for a whole-file task
+        split_bytes = int(float(self.args.splitmb) * 1024 * 1024)
+        size = self.input_size(blob)
+        if split_bytes <= 0 or size <= split_bytes:
+            return None
+        if self.args.ingest == 'create':
+            print('{} is not split into byte ranges; that requires --ingest sproc or upsert'.format(blob.name))
+            return None
+        return csv_shards.byte_ranges(0, size, (size + split_bytes - 1) // split_bytes)
+
+    def range_input_name(self, blob_name, start, end):
+        return '{}@{}-{}'.format(blob_name, start, end)
+
+    def generate_tasks(self):
         cin_container_sas_token  = self.get_container_sas_token(self.args.cin)
+        # a task which reads its input blobs, and writes its log blob, uses this token
+        stream_sas_token = self.get_container_sas_token(
+            self.args.cin, permission=azureblob.ContainerPermissions(read=True, write=True))
         cout_container_sas_token = self.get_container_sas_token(self.args.cout)
         permission = azureblob.models.BlobPermissions(read=True, add=True, create=True, write=True, delete=True)
         # permission=azureblob.BlobPermissions.READ
         docdbhost = os.environ["AZURE_COSMOSDB_DOCDB_URI"]
         docdbkey  = os.environ["AZURE_COSMOSDB_DOCDB_KEY"]
+        constraints = self.task_constraints()
+        stream = self.args.stream.lower() == 'y'
 
-        for idx, blob in enumerate(self.blob_input_files):
-            sas_token = self.blob_client.generate_blob_shared_access_signature(
-                self.args.cin,
-                blob.name,
-                permission=permission,
-                expiry=datetime.datetime.utcnow() + datetime.timedelta(hours=2))
-
-            sas_url = self.blob_client.make_blob_url(
-                self.args.cin,
-                blob.name,
-                sas_token=sas_token)
-
-            template = 'python $AZ_BATCH_NODE_SHARED_DIR/{} --filepath {} --storageaccount {} --storagecontainer {} --sastoken "{}" --idx {} --docdbhost {} --docdbkey {} --dev false'
+        def task(idx, task_id, input_names, file_args, resource_files, stream, range_args=''):
+            self.task_inputs[task_id] = input_names
+            template = '{} {}{} --storageaccount {} --storagecontainer {} --sastoken "{}" --idx {} --docdbhost {} --docdbkey {} --ingest {} --writeconcurrency {} --batchsize {} --rupersecond {} --idempotent {} --stream {} --chunkkb {} --readahead {} --shards {} --dev false'
             command  = [
                 template.format(
-                    self.TASK_FILE,
-                    blob.name,
+                    self.task_command(),
+                    file_args,
+                    range_args,
                     self.STORAGE_ACCOUNT_NAME,
                     self.args.cin,
-                    cin_container_sas_token,
+                    stream_sas_token if stream else cin_container_sas_token,
                     str(idx),
                     docdbhost,
-                    docdbkey)]
+                    docdbkey,
+                    self.args.ingest,
+                    self.args.writeconcurrency,
+                    self.args.batchsize,
+                    self.ru_per_task(),
+                    self.args.idempotent,
+                    'y' if stream else 'n',
+                    self.args.chunkkb,
+                    self.args.readahead,
+                    self.args.shards)]
             #print(f'command: {command}')
-            tasks.append(batch.models.TaskAddParameter(
-                'task{}'.format(idx),
+            return batch.models.TaskAddParameter(
+                task_id,
                 helpers.wrap_commands_in_shell('linux', command),
-                resource_files=[batchmodels.ResourceFile(
-                                file_path=blob.name,
-                                blob_source=sas_url)]))
-
-        self.batch_client.task.add_collection(self.JOB_ID, tasks)
+                resource_files=resource_files,
+                constraints=constraints)
+
+        for idx, blobs in enumerate(self.input_groups()):
+            task_id = 'task{}'.format(idx)
+            ranges = self.byte_ranges(blobs[0]) if len(blobs) == 1 else None
+            if ranges:
+                # one task per byte range of the blob, each reading its range with ranged reads
+                blob = blobs[0]
+                names = [self.range_input_name(blob.name, start, end) for start, end in ranges]
+                if self.manifest:
+                    self.manifest.split_input(blob.name, names)
+                print('{} is split into {} byte-range tasks of at most {} MB'.format(blob.name, len(ranges), self.args.splitmb))
+                for ridx, (start, end) in enumerate(ranges):
+                    if self.manifest and not self.manifest.needs_run(names[ridx]):
+                        continue  # completed in the job being resumed
+                    yield task(idx, '{}-{}'.format(task_id, ridx), [names[ridx]], '--filepath {}'.format(blob.name),
+                               list(), True, ' --offset {} --length {}'.format(start, end - start))
+                continue
+            file_args, manifest_files = self.input_file_args(task_id, [blob.name for blob in blobs])
+            resource_files = [self.blob_resource_file(self.args.cin, blob.name, permission=permission) for blob in blobs]
+            if stream:
+                resource_files = list()  # the task reads the blobs itself
+            yield task(idx, task_id, [blob.name for blob in blobs], file_args, resource_files + manifest_files, stream)
+
+    def task_input_names(self, task):
+        # with --stream y, or a byte range, the task has no input resource files
+        return self.task_inputs.get(task.id, list())
+
+    def task_constraints(self):
+        # automatic retries are only safe when a retried task does not duplicate documents
+        retries = int(self.args.taskretries)
+        if retries and self.args.idempotent.lower() != 'y':
+            print('--taskretries {} ignored; it requires --idempotent y'.format(retries))
+            retries = 0
+        return batch.models.TaskConstraints(max_task_retry_count=retries) if retries else None
 
 
 if __name__ == '__main__':
@@ -78,15 +145,57 @@ if __name__ == '__main__':
     parser.add_argument('--cin',       required=False, help='The name of the Input Blob Container', default='batchcsv')
     parser.add_argument('--cout',      required=False, help='The name of the Output Blob Container', default='batchlog')
     parser.add_argument('--timeout',   required=False, help='Batch job timeout period in minutes', default='30')
+    parser.add_argument('--uploadconcurrency', required=False, help='The maximum number of concurrent file uploads', default='8')
+    parser.add_argument('--uploadcache', required=False, help='Specify n to disable skipping unchanged file uploads', default='y')
+    parser.add_argument('--outputtailkb', required=False, help='Optionally collect only the last N KB of each task stdout/stderr file')
+    parser.add_argument('--reusepool', required=False, help='Specify y to reuse an idle compatible pool, and keep the pool for reuse', default='n')
+    parser.add_argument('--poolidlettl', required=False, help='Minutes a reused pool may sit idle before it is deleted', default='30')
+    parser.add_argument('--autoscale', required=False, help='Specify y to size the pool with an autoscale formula driven by pending tasks', default='n')
+    parser.add_argument('--minnodes', required=False, help='With autoscale, the minimum number of nodes', default='0')
+    parser.add_argument('--maxnodes', required=False, help='With autoscale, the maximum number of nodes; defaults to nodecount')
+    parser.add_argument('--lowpriorityshare', required=False, help='With autoscale, the fraction of nodes which may be low-priority', default='0')
+    parser.add_argument('--scaledowngrace', required=False, help='With autoscale, the minutes the backlog must stay low before the pool scales down', default='10')
+    parser.add_argument('--wheelhouse', required=False, help='Specify y to install the node packages offline from a prebuilt wheelhouse', default='n')
+    parser.add_argument('--taskslots', required=False, help='Concurrent tasks per node, or auto to size from the VM cores and memory', default='auto')
+    parser.add_argument('--nodefill', required=False, help='spread or pack tasks across nodes, or auto', default='auto')
+    parser.add_argument('--checkpoint', required=False, help='Specify n to not keep a job manifest of the state of each input', default='y')
+    parser.add_argument('--resume', required=False, help='A previous job id to resume; reattach if still running, else rerun only its failed and unfinished inputs')
+    parser.add_argument('--packkb', required=False, help='Optionally pack small input files into tasks of about N KB of input', default='0')
+    parser.add_argument('--packseconds', required=False, help='Optionally pack small input files into tasks of about N expected seconds', default='0')
+    parser.add_argument('--maxattempts', required=False, help='Attempts of each throttled or transient-failing Batch and Blob call', default='6')
+    parser.add_argument('--asyncio', required=False, help='Specify y to overlap the uploads, pool, job and task submission with asyncio', default='n')
+    parser.add_argument('--pipeline', required=False, help='Specify n to upload all input files before creating the pool and job', default='y')
+    parser.add_argument('--spansfile', required=False, help='The JSON lines file the timing spans of each run are appended to', default='tmp/spans.jsonl')
+    parser.add_argument('--nodeworker', required=False, help='Specify y to run the tasks on a warm worker process started on each node', default='n')
+    parser.add_argument('--ingest', required=False, help='create, one CosmosDB write per row; or sproc or upsert, in concurrent batches per partition key', default='create')
+    parser.add_argument('--writeconcurrency', required=False, help='With sproc or upsert, the concurrent CosmosDB batch writers per task', default='4')
+    parser.add_argument('--batchsize', required=False, help='With sproc or upsert, the documents per batch', default='100')
+    parser.add_argument('--stream', required=False, help='Specify y for the tasks to read the csv blobs with ranged reads, rather than staging them as resource files', default='n')
+    parser.add_argument('--chunkkb', required=False, help='With stream, the KB of each ranged blob read', default='4096')
+    parser.add_argument('--readahead', required=False, help='With stream, the chunks read ahead of the parsing', default='4')
+    parser.add_argument('--splitmb', required=False, help='With sproc or upsert, split each csv blob larger than N MB into byte ranges of at most N MB, one task each', default='0')
+    parser.add_argument('--shards', required=False, help='With sproc or upsert, the processes of each task parsing byte ranges of its csv files', default='1')
+    parser.add_argument('--idempotent', required=False, help='Specify y to upsert documents with ids derived from the rows, so task retries never duplicate them', default='n')
+    parser.add_argument('--taskretries', required=False, help='With idempotent, the number of times Batch retries a failed task', default='3')
+    parser.add_argument('--ruthroughput', required=False, help='The RU/s of the CosmosDB collection, shared by the tasks; 0 for no limit', default='0')
     args = parser.parse_args()
 
-    util = CsvEtlBatchClient(args)
+    client_class = CsvEtlBatchClient
+    if args.asyncio.lower() == 'y':
+        client_class = async_variant(CsvEtlBatchClient)
+    util = client_class(args)
 
     # Add the (Python) Task script that will be executed on the Azure Batch nodes.
     util.add_task_file(os.path.realpath(args.task))
+    util.add_task_file(os.path.realpath('cosmos_bulk.py'))  # imported by csv_etl_task.py
+    util.add_task_file(os.path.realpath('cosmos_scheduler.py'))
+    util.add_task_file(os.path.realpath('ingest_progress.py'))
+    util.add_task_file(os.path.realpath('blob_stream.py'))
+    util.add_task_file(os.path.realpath('csv_shards.py'))
+    util.add_task_file(os.path.realpath('csv_blocks.py'))
 
     blobs = util.get_blobs(args.cin)
-    for blob in blobs.items:
+    for blob in blobs:
         if (blob.name).endswith('.csv'):
             print(f'blob: {blob.name}')
             util.add_storage_input_blob(blob)
@@ -2,18 +2,30 @@ from __future__ import print_function
 import argparse
 import collections
 import csv
+import io
+import itertools
 import json
+import multiprocessing
 import os
 import string
+import sys
 import time
 import zipfile
 
 import azure.storage.blob as azureblob
+from azure.common import AzureMissingResourceHttpError
 
 import pydocumentdb.documents as documents
 import pydocumentdb.document_client as document_client
 import pydocumentdb.errors as errors
 
+import blob_stream
+from cosmos_bulk import BulkWriter
+from cosmos_scheduler import WriteScheduler
+from csv_blocks import block_docs
+from csv_shards import ShardedReader, parse_range, read_header
+from ingest_progress import ProgressWatermark, document_id
+
 # Azure Batch Task which will be executed on the Azure Batch nodes.
 # It parses the given csv file and inserts the data into Azure CosmosDB.
 # Chris Joakim, Microsoft, 2018/09/13
@@ -33,6 +45,177 @@ def is_azure_env(args):
 def create_docdb_client(args):
     return document_client.DocumentClient(args.docdbhost, {'masterKey': args.docdbkey})
 
+def input_file_paths(args):
+    # the files of a packed task are listed in a manifest, one per line
+    file_paths = list(args.filepath or list())
+    if args.manifest:
+        with open(args.manifest, 'rt') as f:
+            file_paths.extend([line.strip() for line in f if line.strip()])
+    return file_paths
+
+# the document of a row; the files are transformed a block of rows at a time
+# into the same documents, by csv_blocks.block_docs
+def row_doc(header, row):
+    data = dict()
+    for fidx, field in enumerate(header):
+        data[field] = row[fidx]  # add each field of the csv to the data dict
+
+    data['pk'] = data['city_name']  # use city as the CosmosDB partition key
+    data['seq'] = data['id']        # unset the 'id' from the csv, CosmosDB will populate it
+    del data['id']
+
+    # Add GPS info in GeoJSON format
+    location, lat, lng = dict(), float(data['latitude']), float(data['longitude'])
+    coordinates = [ lng, lat ]
+    location['type'] = 'Point'
+    location['coordinates'] = coordinates
+    data['location'] = location
+    return data
+
+def open_local(input_file):
+    return open(input_file, 'rt')
+
+def blob_opener(args):
+    # with --stream y, the input files are read from their blobs in the storage container
+    blob_client = azureblob.BlockBlobService(account_name=args.storageaccount, sas_token=args.sastoken)
+
+    def open_blob(blob_name):
+        return blob_stream.open_text(blob_client, args.storagecontainer, blob_name,
+                                     chunk_bytes=args.chunkkb * 1024, read_ahead=args.readahead)
+    return open_blob
+
+def range_opener(args, input_file):
+    # open_at(offset) for the shards of the file, and its size; called in the shard processes
+    if args.stream.lower() != 'y':
+        def open_local_at(offset):
+            f = open(input_file, 'rb')
+            f.seek(offset)
+            return f
+        return open_local_at, os.path.getsize(input_file)
+
+    def open_blob_at(offset):
+        # each shard process has its own blob service, rather than sharing the parent's connections
+        blob_client = azureblob.BlockBlobService(account_name=args.storageaccount, sas_token=args.sastoken)
+        reader = blob_stream.BlobRangeReader(blob_client, args.storagecontainer, input_file, start=offset,
+                                             chunk_bytes=args.chunkkb * 1024, read_ahead=args.readahead)
+        return io.BufferedReader(reader, 1024 * 1024)
+    blob_client = azureblob.BlockBlobService(account_name=args.storageaccount, sas_token=args.sastoken)
+    return open_blob_at, blob_stream.blob_size(blob_client, args.storagecontainer, input_file)
+
+def shard_count(args):
+    return args.shards if args.shards > 0 else multiprocessing.cpu_count()
+
+def shard_progress_name(name, start):
+    # the progress of a sharded file is kept per shard, the rows of which are numbered from its range start
+    return '{}@{}'.format(name, start)
+
+def csv_docs(input_file, start_row=0, opener=open_local):
+    # (row, doc) of each data row from start_row on; row 0 is the first after the header
+    with opener(input_file) as csvfile:
+        reader = csv.reader(csvfile, delimiter=',')
+        header = next(reader, None)  # id,postal_cd,country_cd,city_name,state_abbrv,latitude,longitude
+        if header is None:
+            return
+        for row, doc in block_docs(header, itertools.islice(reader, start_row, None), start_row):
+            yield row, doc
+
+def idempotent_doc(doc):
+    # a retried task replaces, rather than duplicates, the documents it already wrote
+    doc['id'] = document_id(doc)
+    return doc
+
+def load_csv_file(docdb_client, coll_link, input_file, scheduler, progress=None, opener=open_local):
+    name, start_row, count = os.path.basename(input_file), 0, 0
+    if progress:
+        start_row = progress.committed(name)
+    for row, data in csv_docs(input_file, start_row, opener):
+        if progress:
+            scheduler.call(docdb_client, docdb_client.UpsertDocument, coll_link, idempotent_doc(data), idempotent=True)
+            progress.mark([(name, row)])
+        else:
+            scheduler.call(docdb_client, docdb_client.CreateDocument, coll_link, data)
+        count += 1
+    print('{} documents written from {}'.format(count, name))
+    if progress:
+        progress.finish(name)
+
+def task_range(args):
+    # with --offset, the task loads the lines of its file which start within [offset, offset + length)
+    if args.offset is None:
+        return None, None
+    return args.offset, args.offset + args.length
+
+def file_docs(args, input_file, progress=None, opener=open_local, shard_reports=None):
+    # (progress name, row, doc) of the rows of the file, parsed in args.shards processes if more than 1
+    name = os.path.basename(input_file)
+    start, end = task_range(args)
+    if shard_count(args) < 2 and start is None:
+        start_row = progress.committed(name) if progress else 0
+        for row, doc in csv_docs(input_file, start_row, opener):
+            yield name, row, doc
+        return
+    open_at, size = range_opener(args, input_file)
+    if shard_count(args) < 2:
+        header, data_start = read_header(open_at)
+        start = max(start, data_start)
+        name = shard_progress_name(name, start)
+        start_row = progress.committed(name) if progress else 0
+        for row, doc in parse_range(open_at, header, start, min(end, size), block_docs, start_row):
+            yield name, row, doc
+        return
+    skip_rows = None
+    if progress:
+        skip_rows = lambda start: progress.committed(shard_progress_name(name, start))
+    reader = ShardedReader(open_at, size, shard_count(args), block_docs, start=start, end=end, skip_rows=skip_rows)
+    for start, row, doc in reader:
+        yield shard_progress_name(name, start), row, doc
+    reader.print_report()
+    if shard_reports is not None:
+        report = reader.report()
+        report['input_file'] = input_file
+        shard_reports.append(report)
+
+def bulk_load_csv_files(args, coll_link, input_files, scheduler, progress=None, opener=open_local, shard_reports=None):
+    # the documents of all the files, batched by partition key across files
+    writer = BulkWriter(lambda: create_docdb_client(args), coll_link, mode=args.ingest,
+                        concurrency=args.writeconcurrency, batch_size=args.batchsize, scheduler=scheduler)
+    if progress:
+        writer.upsert = True
+        writer.on_written = progress.mark
+    names = set()
+    with writer:
+        for input_file in input_files:
+            for name, row, doc in file_docs(args, input_file, progress, opener, shard_reports):
+                if progress:
+                    writer.write(idempotent_doc(doc), (name, row))
+                else:
+                    writer.write(doc)
+                names.add(name)
+    if progress:
+        for name in names:
+            progress.finish(name)
+    writer.print_report()
+    return writer.report()
+
+def progress_blob_name():
+    job_id  = str(os.environ.get('AZ_BATCH_JOB_ID'))
+    task_id = str(os.environ.get('AZ_BATCH_TASK_ID'))
+    return '{}-{}-progress.json'.format(job_id, task_id)
+
+def load_progress(blob_client, container):
+    # the watermark saved by a previous attempt of this task, if any
+    blob_name = progress_blob_name()
+
+    def save(text):
+        blob_client.create_blob_from_text(container, blob_name, text)
+
+    try:
+        text = blob_client.get_blob_to_text(container, blob_name).content
+        print('resuming from progress blob: {}'.format(blob_name))
+    except AzureMissingResourceHttpError:
+        text = None
+    return ProgressWatermark.loads(text, save)
+
 def write_log_data(blob_client, container, args, log_data):
     try:
         # see https://docs.microsoft.com/en-us/azure/batch/batch-compute-node-environment-variables
@@ -51,9 +234,12 @@ def write_log_data(blob_client, container, args, log_data):
         app_events.append('ERROR in write_log_data')
 
 
-if __name__ == '__main__':
+def main(argv=None):
+    # also called by node_worker.py, in a process forked from a warm worker
+    global app_events
     parser = argparse.ArgumentParser()
-    parser.add_argument('--filepath', required=True, help='The path to the zip file to process')
+    parser.add_argument('--filepath', required=False, action='append', help='The path to a csv file to process; may be repeated')
+    parser.add_argument('--manifest', required=False, help='The path to a file listing the csv files to process, one per line')
     parser.add_argument('--storageaccount', required=True, help='The name the Azure Storage account for results.')
     parser.add_argument('--storagecontainer', required=True, help='The Azure Blob storage container for results.')
     parser.add_argument('--sastoken', required=True, help='The SAS token providing write access to the Storage container.')
@@ -61,10 +247,30 @@ if __name__ == '__main__':
     parser.add_argument('--docdbhost', required=True, help='CosmosDB host, AZURE_COSMOSDB_DOCDB_URI')
     parser.add_argument('--docdbkey', required=True, help='CosmosDB key, AZURE_COSMOSDB_DOCDB_KEY')
     parser.add_argument('--dev', required=True, help='Specify True if local development on macOS/Windows')
-    args = parser.parse_args()
+    parser.add_argument('--ingest', required=False, help='create, one CreateDocument per row; or sproc or upsert, in concurrent batches per partition key', default='create')
+    parser.add_argument('--writeconcurrency', required=False, help='With sproc or upsert, the number of concurrent batch writers', type=int, default=4)
+    parser.add_argument('--batchsize', required=False, help='With sproc or upsert, the documents per batch', type=int, default=100)
+    parser.add_argument('--rupersecond', required=False, help="This task's share of the collection's RU/s; 0 for no limit", type=float, default=0)
+    parser.add_argument('--stream', required=False, help='Specify y to read the csv blobs from the storage container, rather than local files', default='n')
+    parser.add_argument('--chunkkb', required=False, help='With stream, the KB of each ranged blob read', type=int, default=4096)
+    parser.add_argument('--readahead', required=False, help='With stream, the chunks read ahead of the parsing', type=int, default=4)
+    parser.add_argument('--shards', required=False, help='With sproc or upsert, the processes parsing byte ranges of each csv file; 0 for one per core', type=int, default=1)
+    parser.add_argument('--offset', required=False, help='With --filepath, the byte offset of the range of the file to load; the header is read from the start of the file', type=int)
+    parser.add_argument('--length', required=False, help='With --offset, the byte length of the range', type=int)
+    parser.add_argument('--idempotent', required=False, help='Specify y to upsert documents with ids derived from the rows, and resume a retried task after its progress watermark', default='n')
+    args = parser.parse_args(argv)
     epoch = int(time.time())
+    file_paths = input_file_paths(args)
+    if not file_paths:
+        parser.error('one of --filepath or --manifest is required')
+    if args.ingest == 'create' and args.shards != 1:
+        parser.error('--shards requires --ingest sproc or upsert')
+    if args.offset is not None and (args.length is None or len(file_paths) != 1 or args.ingest == 'create'):
+        parser.error('--offset requires --length, a single --filepath, and --ingest sproc or upsert')
 
     print('args.filepath:  {}'.format(args.filepath))
+    print('args.manifest:  {}'.format(args.manifest))
+    print('file_paths:     {}'.format(file_paths))
     print('args.storageaccount: {}'.format(args.storageaccount))
     print('args.storagecontainer: {}'.format(args.storagecontainer))
     print('args.sastoken:  {}'.format(args.sastoken))
@@ -72,6 +278,13 @@ if __name__ == '__main__':
     print('args.docdbhost: {}'.format(args.docdbhost))
     print('args.docdbkey:  {}'.format(args.docdbkey))
     print('args.dev:       {}'.format(args.dev))
+    print('args.ingest:    {}'.format(args.ingest))
+    print('args.rupersecond: {}'.format(args.rupersecond))
+    print('args.idempotent: {}'.format(args.idempotent))
+    print('args.stream:    {}'.format(args.stream))
+    print('args.shards:    {}'.format(args.shards))
+    print('args.offset:    {}'.format(args.offset))
+    print('args.length:    {}'.format(args.length))
     print('is_dev_env:     {}'.format(is_dev_env(args)))
     print('is_azure_env:   {}'.format(is_azure_env(args)))
     print('epoch:          {}'.format(epoch))
@@ -87,47 +300,47 @@ if __name__ == '__main__':
         log_data['sastoken'] = args.sastoken
         log_data['docdbhost'] = args.docdbhost
         log_data['docdbkey'] = args.docdbkey
-        log_data['filepath'] = args.filepath
+        log_data['filepath'] = file_paths
+        log_data['range'] = [args.offset, args.length]
         log_data['dev'] = args.dev
 
         docdb_client = create_docdb_client(args)
-        input_file = os.path.realpath(args.filepath)
         db_link    = 'dbs/dev'
         coll_link  = db_link + '/colls/zipdata'
-
-        print('input_file: {}'.format(input_file))
-        log_data['input_file'] = input_file
+        log_data['input_files'] = list()
         log_data['coll_link']  = coll_link
-
-        with open(input_file, 'rt') as csvfile:
-            reader = csv.reader(csvfile, delimiter=',')
-            header = None  # id,postal_cd,country_cd,city_name,state_abbrv,latitude,longitude
-            for idx, row in enumerate(reader):
-                if idx < 1:
-                    header = row
-                else:
-                    data = dict()
-                    for fidx, field in enumerate(header):
-                        data[field] = row[fidx]  # add each field of the csv to the data dict
-
-                    data['pk'] = data['city_name']  # use city as the CosmosDB partition key
-                    data['seq'] = data['id']        # unset the 'id' from the csv, CosmosDB will populate it
-                    del data['id']
-
-                    # Add GPS info in GeoJSON format
-                    location, lat, lng = dict(), float(data['latitude']), float(data['longitude'])
-                    coordinates = [ lng, lat ]
-                    location['type'] = 'Point'
-                    location['coordinates'] = coordinates
-                    data['location'] = location
-
-                    doc = docdb_client.CreateDocument(coll_link, data)
-                    print(json.dumps(doc, sort_keys=False, indent=2))
+        writers = 1 if args.ingest == 'create' else args.writeconcurrency
+        scheduler = WriteScheduler(args.rupersecond, max_concurrency=writers)
 
         blob_client = azureblob.BlockBlobService(
             account_name=args.storageaccount,
             sas_token=args.sastoken)
-        
+        opener = open_local
+        if args.stream.lower() == 'y':
+            opener = blob_opener(args)
+        progress = None
+        if args.idempotent.lower() == 'y':
+            progress = load_progress(blob_client, args.storagecontainer)
+            log_data['resumed_from'] = dict((name, p['committed']) for name, p in progress.files.items())
+
+        for file_path in file_paths:
+            input_file = file_path if opener is not open_local else os.path.realpath(file_path)
+            print('input_file: {}'.format(input_file))
+            log_data['input_files'].append(input_file)
+            if args.ingest == 'create':
+                load_csv_file(docdb_client, coll_link, input_file, scheduler, progress, opener)
+        if args.ingest != 'create':
+            log_data['shards'] = list()
+            log_data['ingest'] = bulk_load_csv_files(
+                args, coll_link, log_data['input_files'], scheduler, progress, opener, log_data['shards'])
+        else:
+            scheduler.print_report()
+            log_data['ingest'] = scheduler.report()
+
         write_log_data(blob_client, args.storagecontainer, args, log_data)
     else:
         print('dev mode; no result blob processing')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
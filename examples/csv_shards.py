@@ -0,0 +1,184 @@
+from __future__ import division, print_function
+import csv
+import itertools
+import multiprocessing
+import sys
+import time
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # python 2.7, the node's python
+
+# Splitting a csv file into newline-aligned byte ranges, and parsing the
+# ranges in parallel processes.
+#
+# A byte range [start, end) owns each line which starts within it, so that
+# every line belongs to exactly one range wherever the boundaries fall: a
+# range's first line is the first to start at or after start, and its last
+# line is the last to start before end, read to its newline even beyond end.
+# The header line is read once and given to every shard.  A quoted field
+# containing a newline would break this; the postal code files have none.
+# csv_etl_client.py splits a large blob across tasks in the same way, giving
+# each task an --offset and --length, and csv_etl_task.py aligns them here.
+#
+# ShardedReader runs one process per shard.  Each parses its range and
+# transforms the rows into documents, with a docs function such as
+# csv_blocks.block_docs, and sends them, in messages of
+# message_docs documents, through one bounded queue to the parent process,
+# which writes them through its single write pipeline (BulkWriter).  The
+# files are read through an open_at(offset) function returning a binary file
+# object positioned at the offset, so a shard reads either a local file or,
+# with blob_stream, a blob.
+
+DEFAULT_MESSAGE_DOCS = 500
+QUEUE_MESSAGES_PER_SHARD = 4
+
+
+def decode(line):
+    return line.decode('utf-8') if sys.version_info[0] >= 3 else line
+
+def read_header(open_at):
+    # the header fields, and the offset of the first data line
+    f = open_at(0)
+    try:
+        line = f.readline()
+    finally:
+        f.close()
+    return next(csv.reader([decode(line)], delimiter=',')), len(line)
+
+def byte_ranges(start, end, shards):
+    # shards equal [start, end) ranges; the lines are aligned as they are read
+    shards = max(1, min(int(shards), end - start)) if end > start else 1
+    bounds = [start + (end - start) * idx // shards for idx in range(shards + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def range_lines(open_at, start, end):
+    """
+    The lines which start within [start, end).  Reading from start - 1
+    tells whether a line starts at start: it does if that byte is a newline.
+    """
+    if start >= end:
+        return
+    position = max(0, start - 1)
+    f = open_at(position)
+    try:
+        if start > 0:
+            position += len(f.readline())  # the end of the line in progress at start - 1
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+    finally:
+        f.close()
+
+def parse_range(open_at, header, start, end, docs, skip_rows=0):
+    """
+    (row, doc) of the rows of the range; row 0 is the range's first line.
+    docs(header, rows, first_row) transforms the rows, as (row, doc) of the
+    non-empty ones.
+    """
+    lines = (decode(line) for line in range_lines(open_at, start, end))
+    rows = itertools.islice(csv.reader(lines, delimiter=','), skip_rows, None)
+    return docs(header, rows, skip_rows)
+
+
+def shard_process(idx, open_at, header, start, end, docs, skip_rows, message_docs, messages):
+    # runs in the child process of the shard
+    t1, rows, batch = time.time(), 0, list()
+    try:
+        for row, doc in parse_range(open_at, header, start, end, docs, skip_rows):
+            rows += 1
+            batch.append((row, doc))
+            if len(batch) >= message_docs:
+                messages.put(('docs', idx, batch))
+                batch = list()
+        if batch:
+            messages.put(('docs', idx, batch))
+        messages.put(('done', idx, {'rows': rows, 'seconds': time.time() - t1}))
+    except Exception:
+        messages.put(('error', idx, traceback.format_exc()))
+
+
+class ShardedReader(object):
+
+    def __init__(self, open_at, size, shards, docs, start=None, end=None,
+                 skip_rows=None, message_docs=DEFAULT_MESSAGE_DOCS):
+        """
+        Parses the data lines of [start, end) of a file of size bytes, by
+        default the whole file, in shards processes.  docs(header, rows,
+        first_row) returns (row, doc) of the rows, as parse_range; skip_rows(start),
+        if given, returns the rows already written of the shard whose range
+        starts at start.
+        """
+        self.open_at = open_at
+        self.docs = docs
+        self.message_docs = int(message_docs)
+        self.header, data_start = read_header(open_at)
+        start = data_start if start is None else max(data_start, int(start))
+        end = size if end is None else min(size, int(end))
+        self.ranges = byte_ranges(start, end, shards)
+        self.skip_rows = skip_rows or (lambda start: 0)
+        self.stats = dict()  # shard index -> dict of start, end, rows, seconds, rows_per_second
+        self.started = None
+        self.elapsed = 0.0
+
+    def __iter__(self):
+        # (range start, row, doc) of every row, in the order the shards produce them
+        self.started = time.time()
+        messages = multiprocessing.Queue(maxsize=QUEUE_MESSAGES_PER_SHARD * len(self.ranges))
+        processes = list()
+        for idx, (start, end) in enumerate(self.ranges):
+            p = multiprocessing.Process(target=shard_process, args=(
+                idx, self.open_at, self.header, start, end, self.docs,
+                self.skip_rows(start), self.message_docs, messages))
+            p.daemon = True
+            p.start()
+            processes.append(p)
+        try:
+            running = len(processes)
+            while running:
+                try:
+                    kind, idx, value = messages.get(timeout=5)
+                except queue.Empty:
+                    if not any(p.is_alive() for p in processes):
+                        raise RuntimeError('csv shard processes exited without completing')
+                    continue
+                start = self.ranges[idx][0]
+                if kind == 'docs':
+                    for row, doc in value:
+                        yield start, row, doc
+                elif kind == 'done':
+                    running -= 1
+                    value.update({'start': start, 'end': self.ranges[idx][1]})
+                    value['rows_per_second'] = round(value['rows'] / value['seconds'], 1) if value['seconds'] else 0.0
+                    self.stats[idx] = value
+                else:
+                    raise RuntimeError('csv shard {} failed:\n{}'.format(idx, value))
+        finally:
+            for p in processes:
+                if p.is_alive():
+                    p.terminate()
+                p.join()
+            self.elapsed = time.time() - self.started
+
+    def report(self):
+        shard_seconds = sum(s['seconds'] for s in self.stats.values())
+        rows = sum(s['rows'] for s in self.stats.values())
+        return {'shards': [self.stats[idx] for idx in sorted(self.stats)],
+                'rows': rows,
+                'elapsed': round(self.elapsed, 3),
+                'rows_per_second': round(rows / self.elapsed, 1) if self.elapsed else 0.0,
+                'parallelism': round(shard_seconds / self.elapsed, 2) if self.elapsed else 0.0}
+
+    def print_report(self):
+        r = self.report()
+        print('{} shards: {} rows in {:.1f}s, {} rows/s; the shards were busy {}x the elapsed time'.format(
+            len(r['shards']), r['rows'], r['elapsed'], r['rows_per_second'], r['parallelism']))
+        for s in r['shards']:
+            print('  bytes {:>12}-{:<12} {:>9} rows {:>7.1f}s {:>10} rows/s'.format(
+                s['start'], s['end'], s['rows'], s['seconds'], s['rows_per_second']))
+        sys.stdout.flush()
@@ -0,0 +1,215 @@
+from __future__ import print_function
+import base64
+import concurrent.futures
+import hashlib
+import os
+import sys
+import threading
+import time
+
+from azure.common import AzureHttpError
+
+# Parallel, resumable download of the blobs in a container, used by
+# BatchClient to pull job outputs.
+#
+# Every page of the listing is followed, optionally filtered server-side by
+# a blob name prefix.  A blob whose local file already has the same size and
+# Content-MD5 is skipped.  Downloads are written to a .part file and renamed
+# into place once complete and verified, so an interrupted download resumes
+# from the end of its .part file, provided the blob's ETag is unchanged.
+# The downloads are retried here, from the end of the .part file, rather
+# than by the RetryPolicy proxy, which cannot rewind the file it writes to.
+
+PART_SUFFIX = '.part'
+DEFAULT_PAGE_SIZE = 5000  # the service maximum
+
+
+def file_md5_base64(file_path):
+    # the encoding of the blob Content-MD5 property
+    h = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return base64.b64encode(h.digest()).decode('utf-8')
+
+def blob_md5(blob):
+    settings = getattr(blob.properties, 'content_settings', None)
+    return getattr(settings, 'content_md5', None)
+
+
+class DownloadResult(object):
+
+    def __init__(self, blob_name, file_path):
+        self.blob_name = blob_name
+        self.file_path = file_path
+        self.status = None     # downloaded, resumed, skipped or failed
+        self.attempts = 0
+        self.bytes = 0         # bytes transferred, not the file size
+        self.elapsed = 0.0
+        self.error = None
+
+    def succeeded(self):
+        return self.error is None
+
+
+class ParallelDownloader(object):
+
+    def __init__(self, blob_client, concurrency=8, max_attempts=3, backoff_seconds=1.0,
+                 page_size=DEFAULT_PAGE_SIZE, verbose=True):
+        self.blob_client = blob_client
+        self.concurrency = max(1, int(concurrency))
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff_seconds = float(backoff_seconds)
+        self.page_size = int(page_size)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.counters = dict()
+        self.counters['pages'] = 0
+        self.counters['listed'] = 0
+        self.counters['downloaded'] = 0
+        self.counters['resumed'] = 0
+        self.counters['skipped'] = 0
+        self.counters['failed'] = 0
+        self.counters['retries'] = 0
+        self.counters['bytes'] = 0
+        self.counters['elapsed'] = 0.0
+
+    def list_blobs(self, container_name, prefix=None):
+        # a generator over every page of the listing, not just the first page
+        marker = None
+        while True:
+            page = self.blob_client.list_blobs(
+                container_name, prefix=prefix, num_results=self.page_size, marker=marker)
+            with self.lock:
+                self.counters['pages'] += 1
+            for blob in page.items:
+                with self.lock:
+                    self.counters['listed'] += 1
+                yield blob
+            marker = page.next_marker
+            if not marker:
+                break
+
+    def download(self, container_name, directory_path, prefix=None):
+        """
+        Download the blobs in the container, optionally only those whose
+        names start with prefix, into directory_path, with at most
+        self.concurrency downloads in flight.  Downloads start while the
+        listing continues.  Returns the list of DownloadResults; raises
+        RuntimeError if any download failed.
+        """
+        results = list()
+        t1 = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = list()
+            for blob in self.list_blobs(container_name, prefix):
+                futures.append(executor.submit(self.download_one, container_name, blob, directory_path))
+            for future in concurrent.futures.as_completed(futures):
+                results.append(future.result())
+        with self.lock:
+            self.counters['elapsed'] += time.time() - t1
+        self.print_report()
+
+        failures = [r for r in results if not r.succeeded()]
+        if failures:
+            for r in failures:
+                print('download failed: {} -> {}'.format(r.blob_name, r.error))
+            raise RuntimeError('{} of {} downloads from container {} failed'.format(
+                len(failures), len(results), container_name))
+        return results
+
+    def download_one(self, container_name, blob, directory_path):
+        file_path = os.path.join(directory_path, blob.name)
+        result = DownloadResult(blob.name, file_path)
+        t1 = time.time()
+        if self.is_current(blob, file_path):
+            result.status = 'skipped'
+        else:
+            while result.attempts < self.max_attempts:
+                result.attempts += 1
+                try:
+                    self.fetch(container_name, blob, file_path, result)
+                    result.error = None
+                    break
+                except Exception as e:
+                    result.error = e
+                    if result.attempts < self.max_attempts:
+                        with self.lock:
+                            self.counters['retries'] += 1
+                        time.sleep(self.backoff_seconds * (2 ** (result.attempts - 1)))
+        result.elapsed = time.time() - t1
+
+        with self.lock:
+            if result.succeeded():
+                self.counters[result.status] += 1
+                self.counters['bytes'] += result.bytes
+            else:
+                result.status = 'failed'
+                self.counters['failed'] += 1
+        if self.verbose and result.status != 'skipped':
+            print('{} blob {} to {}'.format(result.status, blob.name, file_path))
+            sys.stdout.flush()
+        return result
+
+    def is_current(self, blob, file_path):
+        # an unchanged local copy has the same size and, where the blob has one, the same MD5
+        if not os.path.isfile(file_path):
+            return False
+        if os.path.getsize(file_path) != blob.properties.content_length:
+            return False
+        md5 = blob_md5(blob)
+        return md5 is not None and md5 == file_md5_base64(file_path)
+
+    def fetch(self, container_name, blob, file_path, result):
+        part_path = file_path + PART_SUFFIX
+        dirname = os.path.dirname(part_path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        length = blob.properties.content_length
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        if offset > length:
+            offset = 0
+        result.status = 'resumed' if offset > 0 else 'downloaded'
+
+        if offset < length or length == 0:
+            try:
+                # if_match fails the request if the blob has changed since the listing
+                with open(part_path, 'ab' if offset > 0 else 'wb') as f:
+                    self.blob_client.get_blob_to_stream(
+                        container_name, blob.name, f,
+                        start_range=offset if offset > 0 else None,
+                        end_range=length - 1 if offset > 0 else None,
+                        if_match=blob.properties.etag, max_connections=1)
+            except AzureHttpError as e:
+                if getattr(e, 'status_code', None) == 412:
+                    os.remove(part_path)  # the blob changed; start again on the next attempt
+                raise
+            result.bytes = length - offset
+
+        size = os.path.getsize(part_path)
+        if size != length:
+            os.remove(part_path)  # e.g. a range written twice; start again on the next attempt
+            raise ValueError('blob {} downloaded as {} bytes, not {}'.format(blob.name, size, length))
+        md5 = blob_md5(blob)
+        if md5 is not None and md5 != file_md5_base64(part_path):
+            os.remove(part_path)
+            raise ValueError('MD5 mismatch for blob {}'.format(blob.name))
+        os.replace(part_path, file_path)
+
+    def throughput(self):
+        # bytes per second, over the wall-clock time spent in download()
+        elapsed = self.counters['elapsed']
+        if elapsed > 0:
+            return self.counters['bytes'] / elapsed
+        return 0.0
+
+    def print_report(self):
+        c = self.counters
+        print('download: {} blobs in {} pages; {} downloaded, {} resumed, {} skipped, {} failed, {} retries, {} bytes in {:.1f}s'.format(
+            c['listed'], c['pages'], c['downloaded'], c['resumed'], c['skipped'], c['failed'],
+            c['retries'], c['bytes'], c['elapsed']))
+        sys.stdout.flush()
@@ -0,0 +1,638 @@
+from __future__ import print_function
+import base64
+import collections
+import datetime
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+import types
+import uuid
+
+import azure.batch.models as batchmodels
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+import pydocumentdb.errors as docdb_errors
+
+# In-process stand-ins for the Azure services used by these examples.
+# They implement just enough of the SDK interfaces for benchmarks.py and for
+# local experimentation, and can inject latency to approximate the real
+# services.  No network access or Azure credentials are required.
+
+
+class FakeBlobService(object):
+    """
+    Stand-in for azure.storage.blob.BlockBlobService; blobs are held in memory.
+    Each call sleeps request_latency seconds, plus seconds_per_mb for the
+    bytes transferred; busy_rate injects 503 Server Busy errors.
+    """
+
+    def __init__(self, request_latency=0.0, seconds_per_mb=0.0, account_name='fakeaccount',
+                 busy_rate=0.0, seed=None):
+        self.account_name = account_name
+        self.request_latency = float(request_latency)
+        self.seconds_per_mb = float(seconds_per_mb)
+        self.busy_rate = float(busy_rate)
+        self.random = random.Random(seed)
+        self.containers = dict()
+        self.lock = threading.Lock()
+        self.call_counts = dict()
+
+    def simulate(self, operation, nbytes=0):
+        with self.lock:
+            self.call_counts[operation] = self.call_counts.get(operation, 0) + 1
+            busy = self.random.random() < self.busy_rate
+        delay = self.request_latency + (self.seconds_per_mb * nbytes / (1024.0 * 1024.0))
+        if delay > 0:
+            time.sleep(delay)
+        if busy:
+            raise AzureHttpError('The server is busy.', 503)
+
+    def create_container(self, container_name, fail_on_exist=False):
+        self.simulate('create_container')
+        with self.lock:
+            if container_name in self.containers:
+                return False
+            self.containers[container_name] = dict()
+            return True
+
+    def delete_container(self, container_name):
+        self.simulate('delete_container')
+        with self.lock:
+            return self.containers.pop(container_name, None) is not None
+
+    def create_blob_from_bytes(self, container_name, blob_name, data):
+        self.simulate('put_blob', len(data))
+        md5 = base64.b64encode(hashlib.md5(data).digest()).decode('utf-8')
+        props = types.SimpleNamespace(
+            content_length=len(data),
+            etag='"0x{}"'.format(hashlib.sha1(data).hexdigest()[:16].upper()),
+            last_modified=time.time(),
+            content_settings=types.SimpleNamespace(content_md5=md5))
+        with self.lock:
+            container = self.containers.setdefault(container_name, dict())
+            container[blob_name] = (bytes(data), props)
+        return types.SimpleNamespace(etag=props.etag, last_modified=props.last_modified)
+
+    def create_blob_from_path(self, container_name, blob_name, file_path, **kwargs):
+        with open(file_path, 'rb') as f:
+            return self.create_blob_from_bytes(container_name, blob_name, f.read())
+
+    def create_blob_from_text(self, container_name, blob_name, text, encoding='utf-8', **kwargs):
+        return self.create_blob_from_bytes(container_name, blob_name, text.encode(encoding))
+
+    def get_blob_properties(self, container_name, blob_name, **kwargs):
+        self.simulate('get_blob_properties')
+        with self.lock:
+            entry = self.containers.get(container_name, dict()).get(blob_name)
+        if entry is None:
+            raise AzureMissingResourceHttpError('The specified blob does not exist.', 404)
+        return types.SimpleNamespace(name=blob_name, properties=entry[1])
+
+    def list_blobs(self, container_name, prefix=None, num_results=None, marker=None, **kwargs):
+        # one page; marker is the name of the first blob of the page, like the service's opaque marker
+        self.simulate('list_blobs')
+        with self.lock:
+            names = sorted(n for n in self.containers.get(container_name, dict())
+                           if not prefix or n.startswith(prefix))
+            if marker:
+                names = [n for n in names if n >= marker]
+            page_size = int(num_results or 5000)
+            items = [types.SimpleNamespace(name=n, properties=self.containers[container_name][n][1])
+                     for n in names[:page_size]]
+        next_marker = names[page_size] if len(names) > page_size else None
+        return types.SimpleNamespace(items=items, next_marker=next_marker)
+
+    def get_blob_to_stream(self, container_name, blob_name, stream, start_range=None, end_range=None,
+                           if_match=None, **kwargs):
+        with self.lock:
+            entry = self.containers.get(container_name, dict()).get(blob_name)
+        if entry is None:
+            raise AzureMissingResourceHttpError('The specified blob does not exist.', 404)
+        data, props = entry
+        if if_match and if_match != props.etag:
+            raise AzureHttpError('The condition specified using HTTP conditional header(s) is not met.', 412)
+        start = start_range or 0
+        end = len(data) - 1 if end_range is None else end_range
+        chunk = data[start:end + 1]
+        self.simulate('get_blob', len(chunk))
+        stream.write(chunk)
+        return types.SimpleNamespace(name=blob_name, properties=props)
+
+    def get_blob_to_bytes(self, container_name, blob_name, start_range=None, end_range=None, **kwargs):
+        stream = io.BytesIO()
+        blob = self.get_blob_to_stream(container_name, blob_name, stream, start_range, end_range, **kwargs)
+        return types.SimpleNamespace(name=blob_name, content=stream.getvalue(), properties=blob.properties)
+
+    def get_blob_to_text(self, container_name, blob_name, encoding='utf-8', **kwargs):
+        with self.lock:
+            entry = self.containers.get(container_name, dict()).get(blob_name)
+        if entry is None:
+            raise AzureMissingResourceHttpError('The specified blob does not exist.', 404)
+        self.simulate('get_blob', len(entry[0]))
+        return types.SimpleNamespace(name=blob_name, content=entry[0].decode(encoding), properties=entry[1])
+
+    def generate_blob_shared_access_signature(self, container_name, blob_name, permission=None, expiry=None, **kwargs):
+        return 'sv=fake&sr=b&sig={}'.format(hashlib.md5(blob_name.encode('utf-8')).hexdigest())
+
+    def generate_container_shared_access_signature(self, container_name, permission=None, expiry=None, **kwargs):
+        return 'sv=fake&sr=c&sig={}'.format(hashlib.md5(container_name.encode('utf-8')).hexdigest())
+
+    def make_blob_url(self, container_name, blob_name, sas_token=None, **kwargs):
+        url = 'https://{}.blob.core.windows.net/{}/{}'.format(self.account_name, container_name, blob_name)
+        if sas_token:
+            url = '{}?{}'.format(url, sas_token)
+        return url
+
+
+def batch_error(code, message, status_code=500, retry_after=None):
+    # builds a BatchErrorException without an HTTP response to deserialize
+    err = batchmodels.BatchErrorException.__new__(batchmodels.BatchErrorException)
+    Exception.__init__(err, message)
+    err.message = message
+    err.error = batchmodels.BatchError(code=code, message=batchmodels.ErrorMessage(value=message))
+    headers = dict()
+    if retry_after is not None:
+        headers['Retry-After'] = str(retry_after)
+    err.response = types.SimpleNamespace(status_code=status_code, headers=headers)
+    return err
+
+
+class FakeBatchServiceClient(object):
+    """
+    Stand-in for azure.batch.BatchServiceClient, exposing the operation groups
+    as attributes like the real client.  Each call sleeps request_latency
+    seconds; busy_rate and server_error_rate inject ServerBusy exceptions
+    and per-task serverError results.  Added tasks complete after a random
+    duration within task_duration seconds.  bytes_transferred approximates
+    the size of the JSON response bodies, honouring select clauses.
+    """
+
+    def __init__(self, request_latency=0.0, busy_rate=0.0, server_error_rate=0.0, seed=None,
+                 task_duration=(1.0, 5.0), output_kb=4, seconds_per_mb=0.0, pool_allocation_seconds=0.0,
+                 task_failure_rate=0.0, retry_after=1):
+        self.request_latency = float(request_latency)
+        self.pool_allocation_seconds = float(pool_allocation_seconds)  # time for new nodes to become idle
+        self.output_kb = int(output_kb)              # size of each task's stdout.txt and stderr.txt
+        self.seconds_per_mb = float(seconds_per_mb)  # simulated file download bandwidth
+        self.busy_rate = float(busy_rate)
+        self.server_error_rate = float(server_error_rate)
+        self.task_failure_rate = float(task_failure_rate)  # fraction of tasks which exit with code 1
+        self.retry_after = retry_after                     # the Retry-After seconds of a ServerBusy error
+        self.task_duration = task_duration
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.call_counts = dict()
+        self.bytes_transferred = 0
+        self.jobs = dict()
+        self.tasks = dict()  # job_id -> OrderedDict of task_id -> CloudTask-like objects
+        self.pools = collections.OrderedDict()
+        self.account = FakeAccountOperations(self)
+        self.pool = FakePoolOperations(self)
+        self.job = FakeJobOperations(self)
+        self.task = FakeTaskOperations(self)
+        self.file = FakeFileOperations(self)
+        self.compute_node = FakeComputeNodeOperations(self)
+
+    def simulate(self, operation, fail_busy=True):
+        with self.lock:
+            self.call_counts[operation] = self.call_counts.get(operation, 0) + 1
+            busy = fail_busy and self.random.random() < self.busy_rate
+        if self.request_latency > 0:
+            time.sleep(self.request_latency)
+        if busy:
+            raise batch_error('ServerBusy', 'The server is currently busy.', 503, retry_after=self.retry_after)
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.call_counts.values())
+
+    def add_transfer(self, nbytes):
+        with self.lock:
+            self.bytes_transferred += nbytes
+
+    def refresh_tasks(self, job_id):
+        # moves tasks whose simulated run time has elapsed to the completed state
+        now = time.time()
+        with self.lock:
+            for task in self.tasks.get(job_id, dict()).values():
+                if task.state != batchmodels.TaskState.completed and now >= task.complete_at:
+                    task.state = batchmodels.TaskState.completed
+                    task.state_transition_time = datetime.datetime.now(datetime.timezone.utc)
+                    exit_code = 1 if self.random.random() < self.task_failure_rate else 0
+                    task.execution_info = types.SimpleNamespace(exit_code=exit_code, retry_count=0, failure_info=None)
+                    task.node_info = types.SimpleNamespace(
+                        node_id='tvm-{}'.format(hash(task.id) % 8), pool_id='fakepool')
+
+
+class FakeAccountOperations(object):
+
+    def __init__(self, service):
+        self.service = service
+
+    def list_node_agent_skus(self, **kwargs):
+        self.service.simulate('account.list_node_agent_skus', fail_busy=False)
+        skus = list()
+        for sku_id, images in [
+                ('batch.node.ubuntu 16.04', [('Canonical', 'UbuntuServer', '16.04-LTS')]),
+                ('batch.node.ubuntu 14.04', [('Canonical', 'UbuntuServer', '14.04.5-LTS')]),
+                ('batch.node.centos 7', [('OpenLogic', 'CentOS', '7.5'), ('OpenLogic', 'CentOS-HPC', '7.4')]),
+                ('batch.node.windows amd64', [('MicrosoftWindowsServer', 'WindowsServer', '2016-Datacenter')])]:
+            refs = [types.SimpleNamespace(publisher=p, offer=o, sku=k, version='latest') for p, o, k in images]
+            skus.append(types.SimpleNamespace(id=sku_id, verified_image_references=refs, os_type='linux'))
+        return iter(skus)
+
+
+class FakePoolOperations(object):
+
+    def __init__(self, service):
+        self.service = service
+
+    def refresh(self):
+        now = time.time()
+        with self.service.lock:
+            for pool in self.service.pools.values():
+                if pool.allocation_state != batchmodels.AllocationState.steady and now >= pool.ready_at:
+                    pool.allocation_state = batchmodels.AllocationState.steady
+                    pool.current_dedicated_nodes = pool.target_dedicated_nodes
+
+    def new_etag(self):
+        return '0x{:016X}'.format(self.service.random.getrandbits(64))
+
+    def add(self, pool, **kwargs):
+        self.service.simulate('pool.add')
+        with self.service.lock:
+            if pool.id in self.service.pools:
+                raise batch_error('PoolExists', 'The specified pool already exists.', 409)
+            self.service.pools[pool.id] = types.SimpleNamespace(
+                id=pool.id, e_tag=self.new_etag(), state=batchmodels.PoolState.active,
+                allocation_state=batchmodels.AllocationState.resizing,
+                vm_size=pool.vm_size, enable_auto_scale=bool(getattr(pool, 'enable_auto_scale', False)),
+                auto_scale_formula=getattr(pool, 'auto_scale_formula', None),
+                target_dedicated_nodes=getattr(pool, 'target_dedicated_nodes', None) or 0,
+                current_dedicated_nodes=0, metadata=list(getattr(pool, 'metadata', None) or list()),
+                max_tasks_per_node=getattr(pool, 'max_tasks_per_node', None) or 1,
+                task_scheduling_policy=getattr(pool, 'task_scheduling_policy', None),
+                ready_at=time.time() + self.service.pool_allocation_seconds)
+
+    def get(self, pool_id, pool_get_options=None, **kwargs):
+        self.service.simulate('pool.get', fail_busy=False)
+        self.refresh()
+        with self.service.lock:
+            if pool_id not in self.service.pools:
+                raise batch_error('PoolNotFound', 'The specified pool does not exist.', 404)
+            return self.service.pools[pool_id]
+
+    def list(self, pool_list_options=None, **kwargs):
+        self.service.simulate('pool.list', fail_busy=False)
+        self.refresh()
+        with self.service.lock:
+            return list(self.service.pools.values())
+
+    def patch(self, pool_id, pool_patch_parameter, pool_patch_options=None, **kwargs):
+        self.service.simulate('pool.patch')
+        with self.service.lock:
+            pool = self.service.pools[pool_id]
+            if_match = getattr(pool_patch_options, 'if_match', None)
+            if if_match and if_match != pool.e_tag:
+                raise batch_error('ConditionNotMet', 'The condition specified was not met.', 412)
+            if pool_patch_parameter.metadata is not None:
+                pool.metadata = list(pool_patch_parameter.metadata)
+            pool.e_tag = self.new_etag()
+
+    def resize(self, pool_id, pool_resize_parameter, **kwargs):
+        self.service.simulate('pool.resize')
+        with self.service.lock:
+            pool = self.service.pools[pool_id]
+            pool.target_dedicated_nodes = pool_resize_parameter.target_dedicated_nodes
+            pool.allocation_state = batchmodels.AllocationState.resizing
+            pool.ready_at = time.time() + self.service.pool_allocation_seconds
+            pool.e_tag = self.new_etag()
+
+    def delete(self, pool_id, **kwargs):
+        self.service.simulate('pool.delete')
+        with self.service.lock:
+            self.service.pools.pop(pool_id, None)
+
+
+class FakeComputeNodeOperations(object):
+
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, pool_id, compute_node_list_options=None, **kwargs):
+        # the nodes are idle once the pool's allocation is steady; filters are ignored
+        self.service.simulate('compute_node.list', fail_busy=False)
+        self.service.pool.refresh()
+        with self.service.lock:
+            pool = self.service.pools.get(pool_id)
+            count = pool.current_dedicated_nodes if pool else 0
+        max_results = getattr(compute_node_list_options, 'max_results', None) or count
+        nodes = [types.SimpleNamespace(id='tvm-{}'.format(idx), state=batchmodels.ComputeNodeState.idle)
+                 for idx in range(min(count, max_results))]
+        self.service.add_transfer(200 * len(nodes))
+        return nodes
+
+
+class FakeJobOperations(object):
+
+    def __init__(self, service):
+        self.service = service
+
+    def add(self, job, **kwargs):
+        self.service.simulate('job.add')
+        with self.service.lock:
+            if job.id in self.service.jobs:
+                raise batch_error('JobExists', 'The specified job already exists.', 409)
+            self.service.jobs[job.id] = job
+            self.service.tasks[job.id] = collections.OrderedDict()
+
+    def get_task_counts(self, job_id, **kwargs):
+        self.service.simulate('job.get_task_counts', fail_busy=False)
+        self.service.refresh_tasks(job_id)
+        with self.service.lock:
+            states = [t.state for t in self.service.tasks.get(job_id, dict()).values()]
+        completed = states.count(batchmodels.TaskState.completed)
+        self.service.add_transfer(120)
+        return types.SimpleNamespace(
+            active=len(states) - completed, running=0, completed=completed,
+            succeeded=completed, failed=0)
+
+    def get(self, job_id, job_get_options=None, **kwargs):
+        self.service.simulate('job.get', fail_busy=False)
+        with self.service.lock:
+            if job_id not in self.service.jobs:
+                raise batch_error('JobNotFound', 'The specified job does not exist.', 404)
+            return types.SimpleNamespace(id=job_id, state=batchmodels.JobState.active)
+
+    def delete(self, job_id, **kwargs):
+        self.service.simulate('job.delete')
+        with self.service.lock:
+            self.service.jobs.pop(job_id, None)
+            self.service.tasks.pop(job_id, None)
+
+
+class FakeTaskOperations(object):
+
+    def __init__(self, service):
+        self.service = service
+
+    def add_collection(self, job_id, value, **kwargs):
+        self.service.simulate('task.add_collection')
+        if len(value) > 100:
+            raise batch_error('InvalidPropertyValue', 'A maximum of 100 tasks may be added per request.', 400)
+        body_size = sum(len(json.dumps(t.serialize())) for t in value)
+        if body_size > 1024 * 1024:
+            raise batch_error('RequestBodyTooLarge', 'The request body is too large.', 413)
+        results = list()
+        with self.service.lock:
+            job_tasks = self.service.tasks[job_id]
+            for t in value:
+                if self.service.random.random() < self.service.server_error_rate:
+                    status, error = batchmodels.TaskAddStatus.server_error, \
+                        batchmodels.BatchError(code='ServerBusy', message=None)
+                elif t.id in job_tasks:
+                    status, error = batchmodels.TaskAddStatus.client_error, \
+                        batchmodels.BatchError(code='TaskExists', message=None)
+                else:
+                    job_tasks[t.id] = self.new_task(t)
+                    status, error = batchmodels.TaskAddStatus.success, None
+                results.append(batchmodels.TaskAddResult(status=status, task_id=t.id, error=error))
+        return batchmodels.TaskAddCollectionResult(value=results)
+
+    def new_task(self, t):
+        low, high = self.service.task_duration
+        return types.SimpleNamespace(
+            id=t.id, state=batchmodels.TaskState.active, command_line=t.command_line,
+            state_transition_time=datetime.datetime.now(datetime.timezone.utc),
+            node_info=None, execution_info=None,
+            complete_at=time.time() + self.service.random.uniform(low, high))
+
+    def wire_size(self, task, select=None):
+        # approximate JSON size of a CloudTask, with or without a select clause
+        wire = collections.OrderedDict()
+        wire['id'] = task.id
+        wire['url'] = 'https://fakeaccount.eastus.batch.azure.com/jobs/job/tasks/{}'.format(task.id)
+        wire['eTag'] = '0x8D61C4F3E2B8A1C'
+        wire['creationTime'] = wire['lastModified'] = '2018-09-13T12:00:00.000000Z'
+        wire['state'] = task.state.value
+        wire['stateTransitionTime'] = str(task.state_transition_time)
+        wire['previousState'] = 'active'
+        wire['commandLine'] = task.command_line
+        wire['resourceFiles'] = [{'blobSource': 'https://fakeaccount.blob.core.windows.net/batchcsv/' +
+                                  'split.csv?se=2018-09-13T14%3A00%3A00Z&sp=racwd&sv=2017-04-17&sr=b&sig=' + 'x' * 44,
+                                  'filePath': 'split.csv'}]
+        wire['constraints'] = {'maxWallClockTime': 'P10675199DT2H48M5.4775807S', 'retentionTime': 'P7D', 'maxTaskRetryCount': 0}
+        wire['userIdentity'] = {'autoUser': {'scope': 'pool', 'elevationLevel': 'nonadmin'}}
+        wire['executionInfo'] = {'startTime': wire['creationTime'], 'endTime': wire['creationTime'],
+                                 'exitCode': 0, 'retryCount': 0, 'requeueCount': 0, 'result': 'success'}
+        wire['nodeInfo'] = {'affinityId': 'TVM:tvm-1234567890_1-20180913t120000z', 'nodeUrl': wire['url'],
+                            'poolId': 'fakepool', 'nodeId': 'tvm-1234567890_1-20180913t120000z',
+                            'taskRootDirectory': 'workitems/job/job-1/' + task.id,
+                            'taskRootDirectoryUrl': wire['url'] + '/files/workitems'}
+        wire['stats'] = {'url': wire['url'], 'userCPUTime': 'PT0S', 'kernelCPUTime': 'PT0S', 'wallClockTime': 'PT0S',
+                         'readIOps': 0, 'writeIOps': 0, 'readIOGiB': 0.0, 'writeIOGiB': 0.0, 'waitTime': 'PT0S'}
+        if select:
+            keys = [k.strip() for k in select.split(',')]
+            wire = dict((k, v) for k, v in wire.items() if k in keys)
+        return len(json.dumps(wire))
+
+    def matches(self, task, task_filter):
+        # supports the "state eq|ne '...'" and "stateTransitionTime ge datetime'...'" clauses
+        if not task_filter:
+            return True
+        for clause in task_filter.split(' and '):
+            prop, op, value = clause.strip().split(' ', 2)
+            if prop == 'state':
+                value = value.strip("'")
+                if (op == 'eq') != (task.state.value == value):
+                    return False
+            elif prop == 'stateTransitionTime':
+                since = datetime.datetime.strptime(value, "datetime'%Y-%m-%dT%H:%M:%S.%fZ'")
+                since = since.replace(tzinfo=datetime.timezone.utc)
+                if task.state_transition_time < since:
+                    return False
+        return True
+
+    def get(self, job_id, task_id, task_get_options=None, **kwargs):
+        self.service.simulate('task.get', fail_busy=False)
+        self.service.refresh_tasks(job_id)
+        with self.service.lock:
+            task = self.service.tasks[job_id][task_id]
+        self.service.add_transfer(self.wire_size(task, getattr(task_get_options, 'select', None)))
+        return task
+
+    def list(self, job_id, task_list_options=None, **kwargs):
+        self.service.simulate('task.list', fail_busy=False)
+        self.service.refresh_tasks(job_id)
+        task_filter = getattr(task_list_options, 'filter', None)
+        select = getattr(task_list_options, 'select', None)
+        max_results = getattr(task_list_options, 'max_results', None)
+        with self.service.lock:
+            tasks = [t for t in self.service.tasks.get(job_id, dict()).values() if self.matches(t, task_filter)]
+        if max_results:
+            tasks = tasks[:max_results]
+        self.service.add_transfer(sum(self.wire_size(t, select) for t in tasks))
+        return tasks
+
+
+class FakeFileOperations(object):
+
+    def __init__(self, service):
+        self.service = service
+
+    def content(self, task_id, file_path):
+        line = '{} {} output line\n'.format(task_id, file_path).encode('utf-8')
+        size = self.service.output_kb * 1024
+        return (line * (size // len(line) + 1))[:size]
+
+    def get_properties_from_task(self, job_id, task_id, file_path, raw=False, **kwargs):
+        self.service.simulate('file.get_properties_from_task', fail_busy=False)
+        headers = {'Content-Length': str(len(self.content(task_id, file_path)))}
+        return types.SimpleNamespace(output=None, headers=headers)
+
+    def get_from_task(self, job_id, task_id, file_path, file_get_from_task_options=None, **kwargs):
+        self.service.simulate('file.get_from_task', fail_busy=False)
+        data = self.content(task_id, file_path)
+        ocp_range = getattr(file_get_from_task_options, 'ocp_range', None)
+        if ocp_range:
+            start, end = ocp_range.split('=')[1].split('-')
+            data = data[int(start):int(end) + 1]
+        return self.stream(data)
+
+    def stream(self, data, chunk_size=4096):
+        # a generator of chunks, like the SDK's streamed file download
+        for idx in range(0, len(data), chunk_size):
+            chunk = data[idx:idx + chunk_size]
+            if self.service.seconds_per_mb > 0:
+                time.sleep(self.service.seconds_per_mb * len(chunk) / (1024.0 * 1024.0))
+            self.service.add_transfer(len(chunk))
+            yield chunk
+
+
+class FakeCosmosService(object):
+    """
+    Stand-in for a CosmosDB account with partitioned collections, shared by
+    the FakeDocumentClients of its client() method.  Each request sleeps
+    request_latency seconds, plus seconds_per_doc for each document written.
+    A write is charged about 5 RU plus 1 RU per KB, against ru_per_second of
+    provisioned throughput in one-second windows; a request over the budget
+    fails with 429 and the x-ms-retry-after-ms of the window's end, as does
+    a throttle_rate fraction of requests.  A bulkImport stored procedure
+    execution writes at most sproc_max_docs documents, as if out of time.
+    """
+
+    def __init__(self, request_latency=0.0, seconds_per_doc=0.0, ru_per_second=0.0,
+                 throttle_rate=0.0, sproc_max_docs=1000, seed=None):
+        self.request_latency = float(request_latency)
+        self.seconds_per_doc = float(seconds_per_doc)
+        self.ru_per_second = float(ru_per_second)  # 0 for unlimited
+        self.throttle_rate = float(throttle_rate)
+        self.sproc_max_docs = int(sproc_max_docs)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.docs = dict()     # coll_link -> dict of (pk, id) -> document
+        self.sprocs = dict()   # sproc link -> body
+        self.window_start = 0.0
+        self.window_charge = 0.0
+        self.call_counts = dict()
+        self.throttles = 0
+        self.request_charge = 0.0
+
+    def client(self, *args, **kwargs):
+        # accepts, and ignores, the DocumentClient arguments (host, {'masterKey': key})
+        return FakeDocumentClient(self)
+
+    def write_charge(self, doc):
+        return 5.0 + len(json.dumps(doc)) / 1024.0
+
+    def simulate(self, operation, charge=1.0, ndocs=0):
+        # the charge, or raises a 429 HTTPFailure
+        with self.lock:
+            self.call_counts[operation] = self.call_counts.get(operation, 0) + 1
+            now = time.time()
+            if now - self.window_start >= 1.0:
+                self.window_start, self.window_charge = now, 0.0
+            throttled = self.random.random() < self.throttle_rate
+            if self.ru_per_second > 0 and self.window_charge > 0 and \
+                    self.window_charge + charge > self.ru_per_second:
+                throttled = True
+            if throttled:
+                self.throttles += 1
+                retry_after_ms = max(1, int((self.window_start + 1.0 - now) * 1000))
+            else:
+                self.window_charge += charge
+                self.request_charge += charge
+        if self.request_latency > 0:
+            time.sleep(self.request_latency)
+        if throttled:
+            raise docdb_errors.HTTPFailure(
+                429, 'Request rate is large', {'x-ms-retry-after-ms': str(retry_after_ms)})
+        if ndocs and self.seconds_per_doc > 0:
+            time.sleep(self.seconds_per_doc * ndocs)
+        return charge
+
+    def store(self, coll_link, doc, upsert):
+        with self.lock:
+            collection = self.docs.setdefault(coll_link, dict())
+            doc = dict(doc)
+            doc.setdefault('id', str(uuid.uuid4()))
+            key = (doc.get('pk'), doc['id'])
+            if key in collection and not upsert:
+                raise docdb_errors.HTTPFailure(409, 'Resource with specified id already exists')
+            collection[key] = doc
+            return doc
+
+    def count(self, coll_link):
+        with self.lock:
+            return len(self.docs.get(coll_link, dict()))
+
+
+class FakeDocumentClient(object):
+    """
+    Stand-in for pydocumentdb.document_client.DocumentClient, for the
+    document and stored procedure calls of cosmos_bulk.py and csv_etl_task.py.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self.last_response_headers = dict()
+
+    def respond(self, charge):
+        self.last_response_headers = {'x-ms-request-charge': str(round(charge, 2))}
+
+    def CreateDocument(self, coll_link, document, options=None):
+        self.respond(self.service.simulate('CreateDocument', self.service.write_charge(document), 1))
+        return self.service.store(coll_link, document, upsert=False)
+
+    def UpsertDocument(self, coll_link, document, options=None):
+        self.respond(self.service.simulate('UpsertDocument', self.service.write_charge(document), 1))
+        return self.service.store(coll_link, document, upsert=True)
+
+    def ReadStoredProcedure(self, sproc_link, options=None):
+        self.respond(self.service.simulate('ReadStoredProcedure'))
+        with self.service.lock:
+            if sproc_link not in self.service.sprocs:
+                raise docdb_errors.HTTPFailure(404, 'Resource Not Found')
+            return {'id': sproc_link.split('/')[-1], 'body': self.service.sprocs[sproc_link]}
+
+    def CreateStoredProcedure(self, coll_link, sproc, options=None):
+        self.respond(self.service.simulate('CreateStoredProcedure'))
+        link = '{}/sprocs/{}'.format(coll_link, sproc['id'])
+        with self.service.lock:
+            if link in self.service.sprocs:
+                raise docdb_errors.HTTPFailure(409, 'Resource with specified id already exists')
+            self.service.sprocs[link] = sproc['body']
+        return sproc
+
+    def ExecuteStoredProcedure(self, sproc_link, params, options=None):
+        # the bulkImport procedure: params are [docs, upsert]
+        docs, upsert = params[0], bool(params[1]) if len(params) > 1 else False
+        docs = docs[:self.service.sproc_max_docs]
+        charge = 1.0 + sum(self.service.write_charge(d) for d in docs)
+        self.respond(self.service.simulate('ExecuteStoredProcedure', charge, len(docs)))
+        coll_link = sproc_link.split('/sprocs/')[0]
+        for doc in docs:
+            self.service.store(coll_link, doc, upsert)
+        return len(docs)
@@ -31,6 +31,9 @@ import time
 import azure.storage.blob as azureblob
 import azure.batch.models as batchmodels
 
+import image_resolver
+from job_monitor import JobMonitor
+
 
 _STANDARD_OUT_FILE_NAME = 'stdout.txt'
 _STANDARD_ERROR_FILE_NAME = 'stderr.txt'
@@ -65,7 +68,8 @@ def decode_string(string, encoding=None):
 def select_latest_verified_vm_image_with_node_agent_sku(
         batch_client, publisher, offer, sku_starts_with):
     """Select the latest verified image that Azure Batch supports given
-    a publisher, offer and sku (starts with filter).
+    a publisher, offer and sku (starts with filter).  The result is cached
+    by image_resolver, with a TTL.
 
     :param batch_client: The batch client to use.
     :type batch_client: `batchserviceclient.BatchServiceClient`
@@ -75,19 +79,7 @@ def select_latest_verified_vm_image_with_node_agent_sku(
     :rtype: tuple
     :return: (node agent sku id to use, vm image ref to use)
     """
-    # get verified vm image list and node agent sku ids from service
-    node_agent_skus = batch_client.account.list_node_agent_skus()
-    # pick the latest supported sku
-    skus_to_use = [
-        (sku, image_ref) for sku in node_agent_skus for image_ref in sorted(
-            sku.verified_image_references, key=lambda item: item.sku)
-        if image_ref.publisher.lower() == publisher.lower() and
-        image_ref.offer.lower() == offer.lower() and
-        image_ref.sku.startswith(sku_starts_with)
-    ]
-    # skus are listed in reverse order, pick first for latest
-    sku_to_use, image_ref_to_use = skus_to_use[0]
-    return (sku_to_use.id, image_ref_to_use)
+    return image_resolver.resolve(batch_client, publisher, offer, sku_starts_with)
 
 
 def wait_for_tasks_to_complete(batch_client, job_id, timeout):
@@ -99,19 +91,10 @@ def wait_for_tasks_to_complete(batch_client, job_id, timeout):
     :param timeout: The maximum amount of time to wait.
     :type timeout: `datetime.timedelta`
     """
-    time_to_timeout_at = datetime.datetime.now() + timeout
-
-    while datetime.datetime.now() < time_to_timeout_at:
-        print("Checking if all tasks are complete...")
-        tasks = batch_client.task.list(job_id)
-
-        incomplete_tasks = [task for task in tasks if
-                            task.state != batchmodels.TaskState.completed]
-        if not incomplete_tasks:
-            return
-        time.sleep(5)
-
-    raise TimeoutError("Timed out waiting for tasks to complete")
+    print("Waiting for all tasks to complete...")
+    monitor = JobMonitor(batch_client, job_id, min_interval=5)
+    if not monitor.wait(timeout):
+        raise TimeoutError("Timed out waiting for tasks to complete")
 
 
 def print_task_output(batch_client, job_id, task_ids, encoding=None):
@@ -0,0 +1,121 @@
+from __future__ import print_function
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+import azure.batch.models as batchmodels
+
+# Resolution of the latest verified VM image and its node agent sku id,
+# shared by BatchClient and helpers.py.
+#
+# Results are memoized in-process and cached on disk with a TTL, keyed by
+# publisher, offer and sku prefix, so that pool creation does not list the
+# node agent skus on every run.  If the listing fails or is slower than
+# timeout_seconds, the last known good value is used, even if expired.
+
+DEFAULT_CACHE_FILE = 'tmp/node_agent_sku_cache.json'
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+
+_memo = dict()
+_lock = threading.Lock()
+
+
+def cache_key(publisher, offer, sku_starts_with):
+    return '{}|{}|{}'.format(publisher.lower(), offer.lower(), sku_starts_with)
+
+def select_image(node_agent_skus, publisher, offer, sku_starts_with):
+    # pick the latest supported sku; skus are listed in reverse order, pick first for latest
+    skus_to_use = [
+        (sku, image_ref) for sku in node_agent_skus for image_ref in sorted(
+            sku.verified_image_references, key=lambda item: item.sku)
+        if image_ref.publisher.lower() == publisher.lower() and
+        image_ref.offer.lower() == offer.lower() and
+        image_ref.sku.startswith(sku_starts_with)
+    ]
+    if not skus_to_use:
+        raise ValueError('no verified image for {} {} {}'.format(publisher, offer, sku_starts_with))
+    sku_to_use, image_ref_to_use = skus_to_use[0]
+    return (sku_to_use.id, image_ref_to_use)
+
+def read_cache(cache_file):
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'rt') as f:
+                return json.load(f)
+        except ValueError:
+            print('ignoring unreadable image cache {}'.format(cache_file))
+    return dict()
+
+def write_cache_entry(cache_file, key, sku_id, image_ref):
+    with _lock:
+        cache = read_cache(cache_file)
+        entry = dict()
+        entry['node_agent_sku_id'] = sku_id
+        entry['publisher'] = image_ref.publisher
+        entry['offer'] = image_ref.offer
+        entry['sku'] = image_ref.sku
+        entry['version'] = image_ref.version
+        entry['resolved_epoch'] = int(time.time())
+        cache[key] = entry
+        dirname = os.path.dirname(cache_file)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp_file = cache_file + '.tmp'
+        with open(tmp_file, 'wt') as f:
+            f.write(json.dumps(cache, sort_keys=True, indent=2))
+        os.replace(tmp_file, cache_file)
+
+def entry_value(entry):
+    image_ref = batchmodels.ImageReference(
+        publisher=entry['publisher'],
+        offer=entry['offer'],
+        sku=entry['sku'],
+        version=entry['version'])
+    return (entry['node_agent_sku_id'], image_ref)
+
+def list_and_select(batch_client, publisher, offer, sku_starts_with, timeout_seconds):
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        future = executor.submit(
+            lambda: select_image(batch_client.account.list_node_agent_skus(), publisher, offer, sku_starts_with))
+        return future.result(timeout=timeout_seconds)
+    finally:
+        executor.shutdown(wait=False)
+
+def resolve(batch_client, publisher, offer, sku_starts_with,
+            ttl_seconds=DEFAULT_TTL_SECONDS, cache_file=DEFAULT_CACHE_FILE, timeout_seconds=30):
+    """
+    Return (node agent sku id, ImageReference) for the latest verified image
+    matching the publisher, offer and sku prefix.
+    """
+    key = cache_key(publisher, offer, sku_starts_with)
+    with _lock:
+        if key in _memo:
+            return _memo[key]
+
+    entry = read_cache(cache_file).get(key)
+    if entry and (time.time() - entry['resolved_epoch']) < ttl_seconds:
+        value = entry_value(entry)
+    else:
+        try:
+            value = list_and_select(batch_client, publisher, offer, sku_starts_with, timeout_seconds)
+            write_cache_entry(cache_file, key, value[0], value[1])
+        except Exception as e:
+            # timeouts, service and network errors; a missing image (ValueError) is not recoverable
+            if not entry or isinstance(e, ValueError):
+                raise
+            print('node agent sku listing failed ({}); using last known good image'.format(
+                type(e).__name__))
+            value = entry_value(entry)
+
+    with _lock:
+        _memo[key] = value
+    return value
+
+def clear(cache_file=DEFAULT_CACHE_FILE):
+    with _lock:
+        _memo.clear()
+        if os.path.isfile(cache_file):
+            os.remove(cache_file)
@@ -0,0 +1,90 @@
+from __future__ import print_function
+import json
+import re
+import threading
+import time
+
+# A per-task progress watermark for csv_etl_task.py --idempotent y, so that
+# a retried task resumes after the rows it already wrote.
+#
+# The concurrent bulk writers complete batches out of order, and a batch
+# holds the rows of one partition key, so the watermark of a file is the
+# number of its leading rows which have all been written; rows after it may
+# have been written too.  That is safe because the documents have ids
+# derived from the row, and are upserted, so rewriting a row replaces the
+# document rather than duplicating it.  The watermark is saved, via the
+# given function, at most every interval_seconds, and when a file is done.
+
+DEFAULT_INTERVAL_SECONDS = 10.0
+INVALID_ID_CHARACTERS = re.compile(r'[/\\?#]')
+
+
+def document_id(doc):
+    # stable across reruns of the same csv row; CosmosDB ids may not contain / \ ? #
+    return INVALID_ID_CHARACTERS.sub('_', '{}-{}'.format(doc['postal_cd'], doc['seq']))
+
+
+class ProgressWatermark(object):
+
+    def __init__(self, save_func=None, interval_seconds=DEFAULT_INTERVAL_SECONDS, state=None):
+        # save_func is called with the JSON text of the state
+        self.save_func = save_func
+        self.interval_seconds = float(interval_seconds)
+        self.files = dict()    # file name -> {'committed': rows, 'done': bool}
+        self.pending = dict()  # file name -> set of rows written after the committed ones
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.last_saved = time.time()
+        self.saves = 0
+        for name, progress in (state or dict()).items():
+            self.files[name] = {'committed': int(progress.get('committed', 0)), 'done': bool(progress.get('done'))}
+
+    @classmethod
+    def loads(cls, text, save_func=None, interval_seconds=DEFAULT_INTERVAL_SECONDS):
+        state = json.loads(text).get('files', dict()) if text else None
+        return cls(save_func, interval_seconds, state)
+
+    def committed(self, name):
+        # the rows of the file to skip
+        with self.lock:
+            return self.files.get(name, dict()).get('committed', 0)
+
+    def done(self, name):
+        with self.lock:
+            return self.files.get(name, dict()).get('done', False)
+
+    def mark(self, rows):
+        # rows is a list of (file name, row index) which have been written
+        with self.lock:
+            for name, row in rows:
+                progress = self.files.setdefault(name, {'committed': 0, 'done': False})
+                pending = self.pending.setdefault(name, set())
+                if row >= progress['committed']:
+                    pending.add(row)
+                while progress['committed'] in pending:
+                    pending.remove(progress['committed'])
+                    progress['committed'] += 1
+        if time.time() - self.last_saved >= self.interval_seconds:
+            self.save()
+
+    def finish(self, name):
+        with self.lock:
+            self.files.setdefault(name, {'committed': 0, 'done': False})['done'] = True
+            self.pending.pop(name, None)
+        self.save(blocking=True)
+
+    def to_dict(self):
+        with self.lock:
+            return {'files': dict((name, dict(progress)) for name, progress in self.files.items()),
+                    'saved': time.time()}
+
+    def save(self, blocking=False):
+        # unless blocking, a save in progress on another writer thread is as good as this one
+        if not self.save_func or not self.save_lock.acquire(blocking):
+            return
+        try:
+            self.last_saved = time.time()
+            self.save_func(json.dumps(self.to_dict(), sort_keys=True))
+            self.saves += 1
+        finally:
+            self.save_lock.release()
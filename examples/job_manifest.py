@@ -0,0 +1,191 @@
+from __future__ import print_function
+import argparse
+import json
+import os
+import threading
+import time
+
+# Checkpoint manifest of a Batch job: the task id, state and output blobs of
+# each input, so that a rerun can skip the inputs which already completed.
+#
+# The manifest is saved locally in tmp/ and mirrored to the job container,
+# so a job can be resumed from another machine.  Input states are:
+#   pending    - not yet submitted in this job
+#   submitted  - its task was added; not known to have completed
+#   completed  - its task completed with exit code 0
+#   failed     - its task completed with a nonzero exit code or a failure
+#
+# python job_manifest.py --func status --job csvetl-1537000000
+
+MANIFEST_BLOB_NAME = 'job-manifest.json'
+
+PENDING   = 'pending'
+SUBMITTED = 'submitted'
+COMPLETED = 'completed'
+FAILED    = 'failed'
+
+
+def default_manifest_file(job_id):
+    return 'tmp/job-manifest-{}.json'.format(job_id)
+
+def job_container_name(job_id):
+    return 'job-' + job_id.lower()
+
+
+class JobManifest(object):
+
+    def __init__(self, job_id, pool_id=None, manifest_file=None, save_interval_seconds=10):
+        self.job_id = job_id
+        self.pool_id = pool_id
+        self.previous_job_ids = list()
+        self.manifest_file = manifest_file or default_manifest_file(job_id)
+        self.save_interval_seconds = float(save_interval_seconds)
+        self.inputs = dict()        # input name -> dict of job_id, task_id, state, exit_code, output_blobs
+        self.task_inputs = dict()   # task id in this job -> list of input names
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # saves may come from the submitting and monitoring threads
+        self.last_save = 0.0
+
+    def add_input(self, name):
+        with self.lock:
+            if name not in self.inputs:
+                self.inputs[name] = self.new_entry()
+
+    def split_input(self, name, part_names):
+        # an input run by several tasks, e.g. byte ranges of a large file; each part is then an input
+        with self.lock:
+            self.inputs.pop(name, None)
+            for part_name in part_names:
+                self.inputs.setdefault(part_name, self.new_entry())
+
+    def new_entry(self):
+        return {'job_id': None, 'task_id': None, 'state': PENDING, 'exit_code': None, 'output_blobs': list()}
+
+    def record_task(self, task_id, names):
+        with self.lock:
+            self.task_inputs[task_id] = list(names)
+            for name in names:
+                entry = self.inputs.setdefault(name, self.new_entry())
+                entry['job_id'] = self.job_id
+                entry['task_id'] = task_id
+                entry['state'] = SUBMITTED
+
+    def record_completion(self, task_id, succeeded, exit_code=None, output_blobs=None):
+        # output_blobs maps each input name of the task to its list of output blob names
+        with self.lock:
+            for name in self.task_inputs.get(task_id, list()):
+                entry = self.inputs[name]
+                entry['state'] = COMPLETED if succeeded else FAILED
+                entry['exit_code'] = exit_code
+                entry['output_blobs'] = list((output_blobs or dict()).get(name, list()))
+
+    def needs_run(self, name):
+        entry = self.inputs.get(name)
+        return entry is None or entry['state'] != COMPLETED
+
+    def has_unfinished_tasks(self):
+        return any(e['state'] == SUBMITTED for e in self.inputs.values())
+
+    def counts(self):
+        counts = dict((state, 0) for state in [PENDING, SUBMITTED, COMPLETED, FAILED])
+        for entry in self.inputs.values():
+            counts[entry['state']] += 1
+        return counts
+
+    def start_job(self, job_id, pool_id=None):
+        """
+        Carry this manifest over to a new job which reruns the inputs which
+        did not complete; completed inputs keep their task and output blobs.
+        """
+        manifest = JobManifest(job_id, pool_id, save_interval_seconds=self.save_interval_seconds)
+        manifest.previous_job_ids = self.previous_job_ids + [self.job_id]
+        for name, entry in self.inputs.items():
+            entry = dict(entry)
+            if entry['state'] != COMPLETED:
+                entry = manifest.new_entry()
+            manifest.inputs[name] = entry
+        return manifest
+
+    def to_dict(self):
+        with self.lock:
+            doc = dict()
+            doc['job_id'] = self.job_id
+            doc['pool_id'] = self.pool_id
+            doc['previous_job_ids'] = self.previous_job_ids
+            doc['saved_epoch'] = int(time.time())
+            doc['inputs'] = dict((name, dict(entry)) for name, entry in self.inputs.items())
+            return doc
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), sort_keys=True, indent=2)
+
+    def save(self):
+        dirname = os.path.dirname(self.manifest_file)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp_file = self.manifest_file + '.tmp'
+        with self.save_lock:
+            with open(tmp_file, 'wt') as f:
+                f.write(self.to_json())
+            os.replace(tmp_file, self.manifest_file)
+            self.last_save = time.time()
+
+    def save_due(self):
+        return time.time() - self.last_save >= self.save_interval_seconds
+
+    def mirror(self, blob_client, container_name=None):
+        blob_client.create_blob_from_text(
+            container_name or job_container_name(self.job_id), MANIFEST_BLOB_NAME, self.to_json())
+
+    def print_report(self):
+        c = self.counts()
+        print('job manifest {}: {} completed, {} failed, {} submitted, {} pending'.format(
+            self.job_id, c[COMPLETED], c[FAILED], c[SUBMITTED], c[PENDING]))
+
+
+def from_dict(doc, manifest_file=None):
+    manifest = JobManifest(doc['job_id'], doc.get('pool_id'), manifest_file)
+    manifest.previous_job_ids = list(doc.get('previous_job_ids', list()))
+    manifest.inputs = dict((name, dict(entry)) for name, entry in doc['inputs'].items())
+    for name, entry in manifest.inputs.items():
+        if entry['job_id'] == manifest.job_id and entry['task_id']:
+            manifest.task_inputs.setdefault(entry['task_id'], list()).append(name)
+    return manifest
+
+def load(job_id, blob_client=None):
+    """
+    Load the manifest of the given job from tmp/, or else from the job
+    container.  Returns None if there is neither.
+    """
+    manifest_file = default_manifest_file(job_id)
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, 'rt') as f:
+            return from_dict(json.load(f), manifest_file)
+    if blob_client is not None:
+        try:
+            text = blob_client.get_blob_to_text(job_container_name(job_id), MANIFEST_BLOB_NAME).content
+            return from_dict(json.loads(text), manifest_file)
+        except Exception as e:
+            print('no manifest for job {} in container {}: {}'.format(
+                job_id, job_container_name(job_id), type(e).__name__))
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--func', required=True, help='status')
+    parser.add_argument('--job',  required=True, help='The job id, including its epoch suffix')
+    args = parser.parse_args()
+
+    if args.func == 'status':
+        manifest = load(args.job)
+        if manifest is None:
+            print('no manifest for job {} in tmp/'.format(args.job))
+        else:
+            manifest.print_report()
+            for name, entry in sorted(manifest.inputs.items()):
+                if entry['state'] != COMPLETED:
+                    print('{:<10} {:<12} {}'.format(entry['state'], str(entry['task_id']), name))
+
+    else:
+        print('invalid function: {}'.format(args.func))
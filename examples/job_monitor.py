@@ -0,0 +1,146 @@
+from __future__ import print_function
+import datetime
+import sys
+import time
+
+import azure.batch.models as batchmodels
+
+from retry_policy import first_listed
+
+# Low-overhead monitoring of the tasks in a Batch job.
+#
+# Rather than listing every task in the job on each poll, JobMonitor reads
+# the aggregate task counts for the job, and only lists tasks, with a
+# server-side filter and a select clause, when it needs the individual
+# tasks.  The polling interval adapts to how quickly tasks are completing.
+
+COMPLETED_TASK_SELECT = 'id,state,stateTransitionTime,executionInfo,nodeInfo'
+
+
+def odata_datetime(dt):
+    return "datetime'{}'".format(dt.strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+
+
+class JobMonitor(object):
+
+    def __init__(self, batch_client, job_id, on_task_completed=None,
+                 min_interval=2.0, max_interval=60.0, backoff_factor=1.5):
+        self.batch_client = batch_client
+        self.job_id = job_id
+        self.on_task_completed = on_task_completed  # called with each newly completed task
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max_interval)
+        self.backoff_factor = float(backoff_factor)
+        self.interval = self.min_interval
+        self.completed_ids = set()
+        self.completed_watermark = None  # latest stateTransitionTime of a completed task seen
+        self.last_counts = None
+        self.last_poll_time, self.last_completed = time.time(), 0
+        self.counters = dict()
+        self.counters['polls'] = 0
+        self.counters['count_calls'] = 0
+        self.counters['list_calls'] = 0
+        self.counters['tasks_listed'] = 0
+        self.counters['sleep_seconds'] = 0.0
+
+    def wait(self, timeout):
+        """
+        Wait until all tasks in the job are completed; timeout is a
+        datetime.timedelta.  Returns True if the tasks completed, False if
+        the timeout expired first.
+        """
+        timeout_expiration = datetime.datetime.now() + timeout
+
+        while datetime.datetime.now() < timeout_expiration:
+            if self.poll():
+                return True
+            remaining = (timeout_expiration - datetime.datetime.now()).total_seconds()
+            sleep_seconds = max(0.0, min(self.interval, remaining))
+            self.counters['sleep_seconds'] += sleep_seconds
+            time.sleep(sleep_seconds)
+        return False
+
+    def poll(self, submitting=False):
+        """
+        Poll the job once, passing any newly completed tasks to the callback,
+        and adapt the interval to the next poll.  Returns True once all tasks
+        have completed; never while submitting, as more tasks are to come.
+        """
+        self.counters['polls'] += 1
+        counts = self.get_task_counts()
+        now = time.time()
+
+        if self.on_task_completed and counts.completed > len(self.completed_ids):
+            self.fetch_completed_tasks()
+
+        if not submitting and counts.active + counts.running == 0 and self.confirm_all_completed():
+            if self.on_task_completed:
+                self.fetch_completed_tasks()
+            return True
+
+        if submitting:
+            # no completions yet is the tasks being added, not the job stalling; no backoff
+            self.interval = self.min_interval
+        else:
+            rate = (counts.completed - self.last_completed) / max(now - self.last_poll_time, 0.001)
+            self.adapt_interval(rate, counts.active + counts.running)
+        self.last_poll_time, self.last_completed = now, counts.completed
+        return False
+
+    def get_task_counts(self):
+        self.counters['count_calls'] += 1
+        self.last_counts = self.batch_client.job.get_task_counts(self.job_id)
+        return self.last_counts
+
+    def adapt_interval(self, rate, remaining_tasks):
+        if rate > 0:
+            # tasks are completing; poll sooner, but no sooner than the expected finish
+            self.interval = max(self.min_interval, self.interval / self.backoff_factor)
+            expected_finish = remaining_tasks / rate
+            self.interval = max(self.min_interval, min(self.interval, expected_finish))
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff_factor)
+
+    def confirm_all_completed(self):
+        # the task counts can lag the task states by a few seconds; confirm with a cheap filtered list
+        # one page of at most one task; list() would follow every page of the incomplete tasks
+        options = batchmodels.TaskListOptions(filter="state ne 'completed'", select='id', max_results=1)
+        self.counters['list_calls'] += 1
+        incomplete = first_listed(self.batch_client.task, 'list', self.job_id, task_list_options=options)
+        self.counters['tasks_listed'] += 0 if incomplete is None else 1
+        return incomplete is None
+
+    def fetch_completed_tasks(self):
+        # list only the completed tasks, and only those which completed since the last fetch
+        task_filter = "state eq 'completed'"
+        if self.completed_watermark:
+            # the watermark is a service timestamp; the overlap covers tasks which completed during the last list
+            since = self.completed_watermark - datetime.timedelta(seconds=2)
+            task_filter = '{} and stateTransitionTime ge {}'.format(task_filter, odata_datetime(since))
+        options = batchmodels.TaskListOptions(filter=task_filter, select=COMPLETED_TASK_SELECT)
+
+        newly_completed = list()
+        for task in self.list_tasks(options):
+            if task.id in self.completed_ids:
+                continue
+            self.completed_ids.add(task.id)
+            newly_completed.append(task)
+            transition_time = getattr(task, 'state_transition_time', None)
+            if transition_time and (self.completed_watermark is None or transition_time > self.completed_watermark):
+                self.completed_watermark = transition_time
+
+        for task in newly_completed:
+            self.on_task_completed(task)
+        return newly_completed
+
+    def list_tasks(self, options):
+        self.counters['list_calls'] += 1
+        tasks = list(self.batch_client.task.list(self.job_id, task_list_options=options))
+        self.counters['tasks_listed'] += len(tasks)
+        return tasks
+
+    def print_report(self):
+        c = self.counters
+        print('job monitor: {} polls, {} count calls, {} list calls, {} tasks listed, {:.1f}s sleeping'.format(
+            c['polls'], c['count_calls'], c['list_calls'], c['tasks_listed'], c['sleep_seconds']))
+        sys.stdout.flush()
@@ -0,0 +1,108 @@
+from __future__ import print_function
+import argparse
+import json
+import math
+import os
+
+# Task slots per node: how many tasks a pool node runs concurrently, derived
+# from the core and memory counts of its VM size and a declared per-task
+# resource profile, and the expected node-hour savings over one task per node.
+#
+# The VM sizes are read from the output of list_vm_sizes.sh (az vm list-sizes).
+#
+# python node_slots.py --vmsize Standard_DS3_v2 --cores 1 --memorymb 1024
+# python node_slots.py --vmsize Standard_DS3_v2 --tasks 15 --nodes 2 --taskminutes 5
+
+VM_SIZES_FILES = ['vm-sizes.json', 'shipyard/vm-sizes-eastus.json']
+
+NODE_RESERVED_MEMORY_MB = 1024  # the OS, the node agent and the start task's packages
+MAX_SLOTS_PER_CORE = 4           # the service limit on max_tasks_per_node
+
+FILL_SPREAD = 'spread'
+FILL_PACK = 'pack'
+
+
+class TaskProfile(object):
+
+    def __init__(self, cores=1.0, memory_mb=512):
+        self.cores = float(cores)          # cores used while running; below 1 for i/o-bound tasks
+        self.memory_mb = int(memory_mb)    # peak resident memory
+
+    def __str__(self):
+        return '{} cores, {} MB'.format(self.cores, self.memory_mb)
+
+
+def load_vm_sizes(files=VM_SIZES_FILES):
+    # dict of lower-case VM size name to its az vm list-sizes entry; the first file listing a size wins
+    sizes = dict()
+    for vm_sizes_file in files:
+        if os.path.isfile(vm_sizes_file):
+            with open(vm_sizes_file, 'rt') as f:
+                for entry in json.load(f):
+                    sizes.setdefault(entry['name'].lower(), entry)
+    return sizes
+
+def slots_per_node(vm_size, profile, vm_sizes=None, reserved_memory_mb=NODE_RESERVED_MEMORY_MB):
+    """
+    The number of tasks with the given profile which fit on one node of
+    vm_size, bounded by its cores, its memory less reserved_memory_mb, and
+    the service limit.  Returns (slots, reason); 1 if the size is unknown.
+    """
+    if vm_sizes is None:
+        vm_sizes = load_vm_sizes()
+    entry = vm_sizes.get(vm_size.lower())
+    if not entry:
+        return 1, 'unknown vm size {}'.format(vm_size)
+    cores, memory_mb = entry['numberOfCores'], entry['memoryInMb']
+    by_cores = int(cores / profile.cores) if profile.cores > 0 else cores * MAX_SLOTS_PER_CORE
+    by_memory = int((memory_mb - reserved_memory_mb) / profile.memory_mb) if profile.memory_mb > 0 else by_cores
+    slots = max(1, min(by_cores, by_memory, cores * MAX_SLOTS_PER_CORE))
+    reason = '{} cores, {} MB; limited by {}'.format(
+        cores, memory_mb, 'cores' if by_cores <= by_memory else 'memory')
+    return slots, reason
+
+def node_fill_type(autoscale):
+    # an autoscaled pool packs tasks onto fewer nodes so that idle nodes can be released;
+    # a fixed pool spreads them, so concurrent tasks do not share a node until they must
+    return FILL_PACK if autoscale else FILL_SPREAD
+
+def waves(task_count, node_count, slots):
+    return int(math.ceil(float(task_count) / max(1, node_count * slots)))
+
+def expected_savings(task_count, node_count, slots, task_minutes=1.0):
+    """
+    Node-hours of a fixed pool running equal-length tasks, with one slot
+    and with the given slots per node.  Returns (one_slot_hours,
+    multi_slot_hours, nodes needed with slots to match the one-slot time).
+    """
+    one = node_count * waves(task_count, node_count, 1) * task_minutes / 60.0
+    multi = node_count * waves(task_count, node_count, slots) * task_minutes / 60.0
+    nodes = node_count
+    while nodes > 1 and waves(task_count, nodes - 1, slots) <= waves(task_count, node_count, 1):
+        nodes -= 1
+    return one, multi, nodes
+
+def print_savings(task_count, node_count, slots, task_minutes=1.0):
+    one, multi, nodes = expected_savings(task_count, node_count, slots, task_minutes)
+    if task_count < 1 or one <= 0:
+        return
+    print('task slots: {} tasks on {} nodes take {} waves with {} slots per node, rather than {}; '
+          '{:.2f} node-hours rather than {:.2f} ({:.0f}% fewer), or {} nodes in the same time'.format(
+              task_count, node_count, waves(task_count, node_count, slots), slots,
+              waves(task_count, node_count, 1), multi, one, 100.0 * (one - multi) / one, nodes))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vmsize',      required=False, help='The pool VM size', default='Standard_DS3_v2')
+    parser.add_argument('--cores',       required=False, help='Cores used by one task', default='1')
+    parser.add_argument('--memorymb',    required=False, help='Peak memory of one task in MB', default='512')
+    parser.add_argument('--tasks',       required=False, help='Number of tasks in the job', default='100')
+    parser.add_argument('--nodes',       required=False, help='Number of nodes in the pool', default='2')
+    parser.add_argument('--taskminutes', required=False, help='Minutes per task', default='5')
+    args = parser.parse_args()
+
+    profile = TaskProfile(args.cores, args.memorymb)
+    slots, reason = slots_per_node(args.vmsize, profile)
+    print('{}: {} slots per node for tasks of {} ({})'.format(args.vmsize, slots, profile, reason))
+    print_savings(int(args.tasks), int(args.nodes), slots, float(args.taskminutes))
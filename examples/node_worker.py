@@ -0,0 +1,268 @@
+from __future__ import print_function
+import argparse
+import fcntl
+import importlib
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver  # python 2.7, the node's python
+
+# A node-resident worker which keeps the task modules, and their azure,
+# pandas and pydocumentdb imports, loaded in a warm Python process, so that
+# a short task does not spend most of its time starting Python and importing.
+#
+# A task command line is this script with --func run, which imports nothing
+# heavy: it sends the task module, arguments, working directory and
+# environment over a unix socket, and exits with the unit's exit code.  The
+# first task on a node finds no worker, starts one in the background, and
+# runs its own unit in-process.  So the worker runs as the tasks' user, not
+# as the start task's admin user; BatchClient gives the tasks the pool-wide
+# non-admin auto-user, with --nodeworker y, so they all share one worker.
+# The socket is in a directory only that user can open, and the worker also
+# refuses connections from other users.
+#
+# The worker forks a child per unit, so units get their own working
+# directory and environment, run concurrently on multi-slot nodes, and a
+# crash does not take the worker down.  The child writes to the task's own
+# stdout and stderr, so the task output files are as before.  If the task's
+# process goes away, e.g. Batch kills it on a timeout or job termination,
+# the child kills the unit, and any processes it started.
+#
+# Each unit's timing is returned to the task, which prints it, and appended
+# to node_worker_units.jsonl next to the socket.
+#
+# python node_worker.py --func serve --modules states_task
+# python node_worker.py --func run --module states_task -- --filepath postal_codes_nc.csv ...
+
+SOCKET_NAME = 'node_worker.sock'
+SOCKET_DIRECTORY = 'node_worker-{}'   # per user id
+LOCK_NAME = 'node_worker.lock'
+LOG_NAME = 'node_worker.log'
+UNITS_LOG_NAME = 'node_worker_units.jsonl'
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)  # linux; not defined by python 2.7's socket module
+WARM_IMPORTS = ['azure.storage.blob', 'pandas', 'pydocumentdb.document_client']
+
+
+def default_directory():
+    # the node-shared directory on a node; this script's directory elsewhere
+    return os.environ.get('AZ_BATCH_NODE_SHARED_DIR') or os.path.dirname(os.path.realpath(__file__))
+
+def socket_path(directory=None):
+    return os.path.join(directory or default_directory(), SOCKET_DIRECTORY.format(os.getuid()), SOCKET_NAME)
+
+def private_directory(path):
+    # the socket's directory, created for this user only; one which other users could open is refused
+    directory = os.path.dirname(path)
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError:
+        pass  # exists
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError('node worker: {} is not a directory private to uid {}'.format(directory, os.getuid()))
+    return directory
+
+def peer_uid(sock):
+    pid, uid, gid = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i')))
+    return uid
+
+def import_module(name):
+    directory = default_directory()
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    return importlib.import_module(name)
+
+def call_main(module_name, argv):
+    # the exit code of module.main(argv), as the script's process would exit with
+    try:
+        code = import_module(module_name).main(argv)
+    except SystemExit as e:
+        code = e.code
+    except Exception:
+        traceback.print_exc()
+        code = 1
+    if code is None:
+        return 0
+    return code if isinstance(code, int) else 1
+
+
+class UnitHandler(socketserver.StreamRequestHandler):
+    # runs in the child forked for the unit
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        started = time.time()
+        self.finished = False
+        os.setpgid(0, 0)  # the unit, and the processes it starts, can be killed together
+        watcher = threading.Thread(target=self.watch_client)
+        watcher.daemon = True
+        watcher.start()
+        self.adopt_task_process(request)
+        code = call_main(request['module'], request['argv'])
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.finished = True
+        unit = {
+            'module': request['module'],
+            'job_id': request['env'].get('AZ_BATCH_JOB_ID'),
+            'task_id': request['env'].get('AZ_BATCH_TASK_ID'),
+            'exit_code': code,
+            'started': started,
+            'queued_seconds': round(started - request['sent'], 4),
+            'seconds': round(time.time() - started, 4),
+            'import_seconds': self.server.import_seconds,
+            'pid': os.getpid()}
+        self.server.log_unit(unit)
+        self.wfile.write((json.dumps(unit) + '\n').encode('utf-8'))
+
+    def watch_client(self):
+        # the client sends nothing more, so the read returns when its process exits or is killed
+        try:
+            data = self.connection.recv(1)
+        except socket.error:
+            data = b''
+        if not data and not self.finished:
+            os.killpg(os.getpgid(0), signal.SIGKILL)
+
+    def adopt_task_process(self, request):
+        # the task's working directory, environment, stdout and stderr
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        for fd in [1, 2]:
+            try:
+                target = os.open('/proc/{}/fd/{}'.format(request['pid'], fd), os.O_WRONLY | os.O_APPEND)
+            except OSError:
+                continue  # stays in the worker log
+            os.dup2(target, fd)
+            os.close(target)
+
+
+class NodeWorker(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+
+    def __init__(self, path, modules):
+        self.import_seconds = preload(modules)
+        self.units_log = os.path.join(os.path.dirname(path), UNITS_LOG_NAME)
+        if os.path.exists(path):
+            os.remove(path)
+        socketserver.UnixStreamServer.__init__(self, path, UnitHandler)
+        os.chmod(path, 0o600)
+
+    def verify_request(self, request, client_address):
+        # only the tasks' own user may run code in the worker
+        if peer_uid(request) != os.getuid():
+            print('node worker: refused a connection from uid {}'.format(peer_uid(request)))
+            sys.stdout.flush()
+            return False
+        return True
+
+    def log_unit(self, unit):
+        # one short line per unit, so appends from concurrent children do not interleave
+        with open(self.units_log, 'at') as f:
+            f.write(json.dumps(unit, sort_keys=True) + '\n')
+
+
+def preload(modules):
+    # the seconds spent importing, which each unit no longer pays
+    t1 = time.time()
+    for name in WARM_IMPORTS + list(modules):
+        try:
+            import_module(name)
+        except ImportError as e:
+            print('node worker: unable to preload {}: {}'.format(name, e))
+    return round(time.time() - t1, 4)
+
+def serve(path, modules):
+    # one worker per user; a second, e.g. started by a concurrent first task, exits
+    lock = open(os.path.join(private_directory(path), LOCK_NAME), 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        print('node worker: already running for {}'.format(path))
+        return
+    worker = NodeWorker(path, modules)
+    print('node worker: pid {} serving {} with {} preloaded in {}s'.format(
+        os.getpid(), path, ','.join(modules), worker.import_seconds))
+    sys.stdout.flush()
+    worker.serve_forever()
+
+def start_worker(module_name, path):
+    # detached from the task, so that it outlives it; as the task's user
+    directory = private_directory(path)
+    with open(os.devnull, 'rb') as devnull, open(os.path.join(directory, LOG_NAME), 'ab') as log:
+        subprocess.Popen(
+            [sys.executable, os.path.realpath(__file__), '--func', 'serve', '--modules', module_name, '--socket', path],
+            cwd=directory, stdin=devnull, stdout=log, stderr=subprocess.STDOUT, close_fds=True, preexec_fn=os.setsid)
+
+def run(module_name, argv, path):
+    """
+    Run the unit on the node worker.  If the worker is not running, start it
+    for the next tasks, and run the unit in-process.  Returns the unit's exit
+    code.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        print('node worker: not running at {}; starting it, and running {} in-process'.format(path, module_name))
+        sys.stdout.flush()
+        try:
+            start_worker(module_name, path)
+        except (OSError, RuntimeError) as e:
+            print('node worker: unable to start: {}'.format(e))
+        return call_main(module_name, argv)
+
+    request = {'module': module_name, 'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ),
+               'pid': os.getpid(), 'sent': time.time()}
+    sys.stdout.flush()
+    try:
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        reply = sock.makefile('rb').readline().decode('utf-8')
+    finally:
+        sock.close()
+    for fd in [1, 2]:
+        try:
+            os.lseek(fd, 0, os.SEEK_END)  # past what the unit wrote, when stdout is a file without O_APPEND
+        except OSError:
+            pass
+    if not reply:
+        print('node worker: no reply for {}; the unit did not complete'.format(module_name))
+        return 1
+    unit = json.loads(reply)
+    print('node worker: {} ran in {:.3f}s in pid {}, {:.3f}s queued, {:.2f}s of imports avoided'.format(
+        module_name, unit['seconds'], unit['pid'], unit['queued_seconds'], unit['import_seconds']))
+    return unit['exit_code']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--func',    required=True,  help='serve or run')
+    parser.add_argument('--modules', required=False, help='With serve, comma-separated task modules to preload', default='')
+    parser.add_argument('--module',  required=False, help='With run, the task module whose main() runs the unit')
+    parser.add_argument('--socket',  required=False, help='The unix socket path; defaults to the node-shared directory')
+    parser.add_argument('argv', nargs=argparse.REMAINDER, help='With run, the task arguments, after --')
+    args = parser.parse_args()
+    path = args.socket or socket_path()
+
+    if args.func == 'serve':
+        serve(path, [m for m in args.modules.split(',') if m])
+    elif args.func == 'run':
+        argv = args.argv[1:] if args.argv[:1] == ['--'] else args.argv
+        sys.exit(run(args.module, argv, path))
+    else:
+        print('invalid function: {}'.format(args.func))
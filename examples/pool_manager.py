@@ -0,0 +1,201 @@
+from __future__ import print_function
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import azure.batch.batch_service_client as batch
+import azure.batch.batch_auth as batchauth
+import azure.batch.models as batchmodels
+
+# Warm-pool lifecycle management: reuse an existing, idle, compatible pool
+# rather than provisioning a new pool for every job.
+#
+# The registry is the pools themselves; a managed pool carries metadata with
+# the fingerprint of its configuration (VM size, image, node agent sku and
+# start task), the job which has leased it, when it was last used, and its
+# idle time-to-live.  Leases are taken with an If-Match on the pool ETag, so
+# two clients cannot acquire the same pool.  A lease is stale, and the pool
+# free to reuse or reap, once it is past its expiry or its job has no active
+# or running tasks; a client which exits without releasing its pool does not
+# hold it forever.
+#
+# python pool_manager.py --func list
+# python pool_manager.py --func reap
+# python pool_manager.py --func reap --idlettl 0
+
+FINGERPRINT_KEY   = 'warmpool-fingerprint'
+LEASE_KEY         = 'warmpool-lease'
+LEASE_EXPIRES_KEY = 'warmpool-lease-expires'
+LAST_USED_KEY     = 'warmpool-last-used'
+IDLE_TTL_KEY      = 'warmpool-idle-ttl-minutes'
+
+LEASE_GRACE_SECONDS = 600  # a new lease is honoured while its job is still being created
+LEASE_TTL_SECONDS   = 24 * 3600  # the longest a lease is honoured, whatever the state of its job
+
+POOL_SELECT = 'id,eTag,state,allocationState,vmSize,enableAutoScale,currentDedicatedNodes,targetDedicatedNodes,metadata'
+
+
+def pool_fingerprint(vm_size, image_reference, node_agent_sku_id, start_task_commands, file_hashes, scaling=None):
+    # file_hashes are the content hashes of the start task resource files; SAS urls vary per run
+    doc = dict()
+    doc['scaling'] = scaling
+    doc['vm_size'] = vm_size.lower()
+    doc['image'] = [image_reference.publisher, image_reference.offer,
+                    image_reference.sku, image_reference.version]
+    doc['node_agent_sku_id'] = node_agent_sku_id
+    doc['start_task'] = list(start_task_commands)
+    doc['files'] = sorted(file_hashes)
+    return hashlib.sha256(json.dumps(doc, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+def metadata_dict(pool):
+    return dict((item.name, item.value) for item in (pool.metadata or list()))
+
+def metadata_list(d):
+    return [batchmodels.MetadataItem(name=k, value=str(v)) for k, v in sorted(d.items())]
+
+
+class PoolManager(object):
+
+    def __init__(self, batch_client, idle_ttl_minutes=30):
+        self.batch_client = batch_client
+        self.idle_ttl_minutes = int(idle_ttl_minutes)
+
+    def managed_pools(self):
+        options = batchmodels.PoolListOptions(
+            filter="state eq 'active'", select=POOL_SELECT)
+        return [p for p in self.batch_client.pool.list(pool_list_options=options)
+                if FINGERPRINT_KEY in metadata_dict(p)]
+
+    def add_metadata(self, pool_param, fingerprint, lease):
+        # adds the warm-pool metadata to a PoolAddParameter before pool.add
+        md = dict()
+        md[FINGERPRINT_KEY] = fingerprint
+        md[LEASE_KEY] = lease
+        md[LAST_USED_KEY] = int(time.time())
+        md[LEASE_EXPIRES_KEY] = md[LAST_USED_KEY] + LEASE_TTL_SECONDS
+        md[IDLE_TTL_KEY] = self.idle_ttl_minutes
+        pool_param.metadata = metadata_list(md)
+        return pool_param
+
+    def acquire(self, fingerprint, lease, node_count):
+        """
+        Find an unleased, active pool with the given fingerprint, lease it to
+        the given job id, and resize it to node_count if necessary.
+        Returns the pool id, or None if there is no reusable pool.
+        """
+        for pool in self.managed_pools():
+            md = metadata_dict(pool)
+            if md.get(FINGERPRINT_KEY) != fingerprint or self.is_leased(md):
+                continue
+            md[LEASE_KEY] = lease
+            md[LAST_USED_KEY] = int(time.time())
+            md[LEASE_EXPIRES_KEY] = md[LAST_USED_KEY] + LEASE_TTL_SECONDS
+            if not self.patch_metadata(pool, md):
+                continue  # another client leased it first
+            print('reusing warm pool {} ({} dedicated nodes)'.format(pool.id, pool.current_dedicated_nodes))
+            self.resize(pool, node_count)
+            return pool.id
+        return None
+
+    def release(self, pool_id):
+        pool = self.batch_client.pool.get(
+            pool_id, pool_get_options=batchmodels.PoolGetOptions(select=POOL_SELECT))
+        md = metadata_dict(pool)
+        md[LEASE_KEY] = ''
+        md[LAST_USED_KEY] = int(time.time())
+        md.pop(LEASE_EXPIRES_KEY, None)
+        self.patch_metadata(pool, md, check_etag=False)
+        print('released warm pool {}; idle ttl {} minutes'.format(pool_id, md.get(IDLE_TTL_KEY)))
+
+    def is_leased(self, md):
+        # a lease past its expiry, or held by a job which no longer exists, has completed,
+        # or has no active or running tasks, is stale
+        lease = md.get(LEASE_KEY)
+        if not lease:
+            return False
+        now = int(time.time())
+        if LEASE_EXPIRES_KEY in md and now >= int(md[LEASE_EXPIRES_KEY]):
+            return False
+        if now - int(md.get(LAST_USED_KEY, 0)) < LEASE_GRACE_SECONDS:
+            return True
+        try:
+            job = self.batch_client.job.get(lease, job_get_options=batchmodels.JobGetOptions(select='id,state'))
+        except batchmodels.batch_error.BatchErrorException as err:
+            if err.error and err.error.code == 'JobNotFound':
+                return False
+            raise
+        if job.state in [batchmodels.JobState.completed, batchmodels.JobState.deleting]:
+            return False
+        counts = self.batch_client.job.get_task_counts(lease)
+        return counts.active + counts.running > 0
+
+    def patch_metadata(self, pool, md, check_etag=True):
+        options = None
+        if check_etag:
+            options = batchmodels.PoolPatchOptions(if_match=pool.e_tag)
+        try:
+            self.batch_client.pool.patch(
+                pool.id, batchmodels.PoolPatchParameter(metadata=metadata_list(md)),
+                pool_patch_options=options)
+            return True
+        except batchmodels.batch_error.BatchErrorException as err:
+            if err.error and err.error.code == 'ConditionNotMet':
+                return False
+            raise
+
+    def resize(self, pool, node_count):
+        if pool.enable_auto_scale:
+            return
+        if pool.target_dedicated_nodes == node_count:
+            return
+        if pool.allocation_state != batchmodels.AllocationState.steady:
+            print('pool {} is already resizing; not resized'.format(pool.id))
+            return
+        print('resizing pool {} from {} to {} dedicated nodes'.format(
+            pool.id, pool.target_dedicated_nodes, node_count))
+        self.batch_client.pool.resize(
+            pool.id, batchmodels.PoolResizeParameter(target_dedicated_nodes=node_count))
+
+    def reap_idle_pools(self, idle_ttl_minutes=None):
+        # deletes the unleased managed pools which have been idle for longer than their ttl
+        now = int(time.time())
+        deleted = list()
+        for pool in self.managed_pools():
+            md = metadata_dict(pool)
+            if self.is_leased(md):
+                continue
+            ttl = idle_ttl_minutes if idle_ttl_minutes is not None else int(md.get(IDLE_TTL_KEY, self.idle_ttl_minutes))
+            idle_seconds = now - int(md.get(LAST_USED_KEY, 0))
+            if idle_seconds > ttl * 60:
+                print('deleting pool {}, idle for {} minutes'.format(pool.id, idle_seconds // 60))
+                self.batch_client.pool.delete(pool.id)
+                deleted.append(pool.id)
+        return deleted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--func',    required=True,  help='list or reap')
+    parser.add_argument('--idlettl', required=False, help='Override the idle ttl in minutes when reaping')
+    args = parser.parse_args()
+
+    credentials = batchauth.SharedKeyCredentials(
+        os.environ["AZURE_BATCH_ACCOUNT"], os.environ["AZURE_BATCH_KEY"])
+    batch_client = batch.BatchServiceClient(credentials, base_url=os.environ["AZURE_BATCH_URL"])
+    manager = PoolManager(batch_client)
+
+    if args.func == 'list':
+        for pool in manager.managed_pools():
+            print(json.dumps({'id': pool.id, 'vm_size': pool.vm_size,
+                              'nodes': pool.current_dedicated_nodes,
+                              'metadata': metadata_dict(pool)}, sort_keys=True, indent=2))
+
+    elif args.func == 'reap':
+        ttl = int(args.idlettl) if args.idlettl is not None else None
+        deleted = manager.reap_idle_pools(ttl)
+        print('{} pools deleted'.format(len(deleted)))
+
+    else:
+        print('invalid function: {}'.format(args.func))
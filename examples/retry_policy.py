@@ -0,0 +1,213 @@
+from __future__ import print_function
+import random
+import sys
+import threading
+import time
+
+import azure.batch.models as batchmodels
+from azure.common import AzureHttpError
+
+# A shared retry and backoff policy for the Batch and Blob service calls.
+#
+# RetryPolicy.wrap() returns a proxy for a BatchServiceClient or a
+# BlockBlobService whose service calls are retried on throttling, server busy
+# and transient server errors.  The delay honours the service's Retry-After
+# hint when there is one, and is otherwise exponential with full jitter, so
+# that many concurrent callers do not retry in lockstep.  Each operation,
+# e.g. 'pool.add' or 'blob.create_container', has a budget of total backoff
+# time, after which the error is raised.  Counters record the retries and
+# the time spent backing off, per operation.
+
+RETRIABLE_ERROR_CODES = [
+    'ServerBusy', 'OperationTimedOut', 'InternalError', 'TooManyRequests', 'ServiceUnavailable']
+RETRIABLE_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+
+# local methods of the clients which make no service call
+NOT_RETRIED = ['generate_blob_shared_access_signature', 'generate_container_shared_access_signature',
+               'make_blob_url', 'config']
+
+# methods which read or write the caller's stream; a retry could not rewind it, so the caller retries them
+NOT_RETRIED_STREAMS = ['get_blob_to_stream', 'create_blob_from_stream', 'append_blob_from_stream']
+
+DEFAULT_BUDGET_SECONDS = 120.0
+DEFAULT_BUDGETS = {
+    'pool.add': 300.0,             # creating the pool is the most expensive call to lose
+    'job.add': 300.0,
+    'task.add_collection': 300.0,
+    'job.get_task_counts': 30.0,   # polled; the next poll is as good as a retry
+}
+
+
+def error_code(err):
+    error = getattr(err, 'error', None)
+    return getattr(error, 'code', None)
+
+def status_code(err):
+    status = getattr(err, 'status_code', None)  # AzureHttpError
+    if status is None:
+        response = getattr(err, 'response', None)
+        status = getattr(response, 'status_code', None)
+    return status
+
+def retry_after_seconds(err):
+    # the Retry-After header of a throttled Batch response, if any
+    response = getattr(err, 'response', None)
+    headers = getattr(response, 'headers', None) or dict()
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def is_retriable(err):
+    if isinstance(err, batchmodels.batch_error.BatchErrorException):
+        return error_code(err) in RETRIABLE_ERROR_CODES or status_code(err) in RETRIABLE_STATUS_CODES
+    if isinstance(err, AzureHttpError):
+        return status_code(err) in RETRIABLE_STATUS_CODES
+    # connection resets and timeouts surface as these, from requests and msrest
+    return type(err).__name__ in ['ConnectionError', 'Timeout', 'ReadTimeout', 'ClientRequestError']
+
+def is_conflict_after_retry(err):
+    # a create which succeeded on an attempt whose response was lost fails with ...Exists on the retry
+    code = error_code(err) or ''
+    return code.endswith('Exists') or code.endswith('AlreadyExists') or \
+        (isinstance(err, AzureHttpError) and status_code(err) == 409)
+
+
+class RetryPolicy(object):
+
+    def __init__(self, max_attempts=6, base_seconds=0.5, max_seconds=30.0,
+                 budget_seconds=DEFAULT_BUDGET_SECONDS, budgets=None, seed=None, sleep=time.sleep):
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_seconds = float(base_seconds)
+        self.max_seconds = float(max_seconds)
+        self.budget_seconds = float(budget_seconds)
+        self.budgets = dict(DEFAULT_BUDGETS)
+        self.budgets.update(budgets or dict())
+        self.random = random.Random(seed)
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.counters = dict()  # operation -> dict of calls, retries, backoff_seconds, failures
+        self.on_call = None     # if set, called with the operation name before each attempt
+
+    def budget(self, operation):
+        return self.budgets.get(operation, self.budget_seconds)
+
+    def delay(self, attempt, err=None):
+        # seconds to wait before the given retry attempt (1 for the first retry)
+        ceiling = min(self.max_seconds, self.base_seconds * (2 ** (attempt - 1)))
+        with self.lock:
+            jittered = self.random.uniform(0, ceiling)
+        retry_after = retry_after_seconds(err) if err is not None else None
+        if retry_after is not None:
+            # wait at least as long as asked, plus a little jitter
+            return retry_after + jittered * 0.1
+        return jittered
+
+    def count(self, operation, key, value=1):
+        with self.lock:
+            c = self.counters.setdefault(
+                operation, {'calls': 0, 'retries': 0, 'backoff_seconds': 0.0, 'failures': 0})
+            c[key] += value
+
+    def backoff(self, operation, attempt, err=None):
+        seconds = self.delay(attempt, err)
+        self.count(operation, 'retries')
+        self.count(operation, 'backoff_seconds', seconds)
+        self.sleep(seconds)
+        return seconds
+
+    def call(self, operation, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs), retrying retriable errors until the
+        attempts or the operation's backoff budget are exhausted.
+        """
+        self.count(operation, 'calls')
+        attempt, waited = 0, 0.0
+        while True:
+            attempt += 1
+            if self.on_call:
+                self.on_call(operation)
+            try:
+                return func(*args, **kwargs)
+            except Exception as err:
+                if attempt > 1 and is_conflict_after_retry(err):
+                    return None
+                if not is_retriable(err) or attempt >= self.max_attempts or waited >= self.budget(operation):
+                    self.count(operation, 'failures')
+                    raise
+                waited += self.backoff(operation, attempt, err)
+
+    def wrap(self, client, prefix=None):
+        # a proxy of a BatchServiceClient (prefix None) or a BlockBlobService (prefix 'blob')
+        return RetryingProxy(client, self, prefix)
+
+    def totals(self):
+        with self.lock:
+            totals = {'calls': 0, 'retries': 0, 'backoff_seconds': 0.0, 'failures': 0}
+            for c in self.counters.values():
+                for key in totals:
+                    totals[key] += c[key]
+            return totals
+
+    def print_report(self):
+        t = self.totals()
+        print('retries: {} calls, {} retries, {:.1f}s backing off, {} failures'.format(
+            t['calls'], t['retries'], t['backoff_seconds'], t['failures']))
+        with self.lock:
+            for operation, c in sorted(self.counters.items()):
+                if c['retries'] or c['failures']:
+                    print('  {:<36} {:>6} calls {:>5} retries {:>7.1f}s {:>3} failures'.format(
+                        operation, c['calls'], c['retries'], c['backoff_seconds'], c['failures']))
+        sys.stdout.flush()
+
+
+def first_listed(group, name, *args, **kwargs):
+    """
+    The first item of a Batch list operation of an operation group, or None.
+    max_results only sets the page size, and list() would follow every page,
+    as the proxy does; this reads the first page only, retried as the proxy
+    would retry the list.
+    """
+    if isinstance(group, RetryingProxy):
+        operation = '{}.{}'.format(group._prefix, name)
+        return group._policy.call(operation, lambda: next(iter(getattr(group._target, name)(*args, **kwargs)), None))
+    return next(iter(getattr(group, name)(*args, **kwargs)), None)
+
+def unwrapped(client):
+    # the client a RetryingProxy wraps, for callers which retry their calls themselves
+    return client._target if isinstance(client, RetryingProxy) else client
+
+
+class RetryingProxy(object):
+    """
+    Forwards attribute access to the wrapped client.  Methods are retried
+    under the operation name '<prefix>.<method>'; the operation groups of a
+    BatchServiceClient (pool, job, task, ...) are themselves proxied, with
+    their attribute name as the prefix.  Batch list operations return lazy
+    pages, which are read inside the retry so that a throttled page fetch is
+    retried too.
+    """
+
+    def __init__(self, target, policy, prefix=None):
+        self._target = target
+        self._policy = policy
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if name.startswith('_') or name in NOT_RETRIED or name in NOT_RETRIED_STREAMS:
+            return value
+        if self._prefix is None:
+            if callable(value) or isinstance(value, (str, bytes, int, float, bool, dict, list, tuple, type(None))):
+                return value
+            return RetryingProxy(value, self._policy, name)  # an operation group
+        if not callable(value):
+            return value
+        operation = '{}.{}'.format(self._prefix, name)
+        if self._prefix != 'blob' and name.startswith('list'):
+            return lambda *args, **kwargs: self._policy.call(operation, lambda: list(value(*args, **kwargs)))
+        return lambda *args, **kwargs: self._policy.call(operation, value, *args, **kwargs)
+
+    def __str__(self):
+        return str(self._target)
@@ -0,0 +1,232 @@
+from __future__ import print_function
+import argparse
+import collections
+import contextlib
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+# Spans for the stages of a BatchClient run: wall-clock time, API calls and
+# bytes moved.
+#
+# Each thread has a stack of open spans.  An API call or a transfer counts
+# toward every span open on the thread, so a stage includes its nested spans,
+# e.g. 'create pool' includes 'resolve image' and 'pool add'.  Work handed to
+# a thread pool is wrapped with propagate(), so that it counts toward the
+# spans of the thread which handed it over.
+#
+# Stages may overlap, e.g. the input uploads run while the pool and job are
+# created, so the report is a timeline of the top-level stages rather than a
+# list of durations.  The critical path is the chain of stages, back from the
+# last to finish, where each stage started as its predecessor ended; these
+# are the stages worth making faster.  Every span is also written as a line
+# of JSON, to compare runs:
+#
+# python stage_timer.py --func compare --file tmp/spans.jsonl
+
+DEFAULT_SPANS_FILE = 'tmp/spans.jsonl'
+CHAIN_SLACK_SECONDS = 0.05  # the gap allowed between a stage and the one that waited for it
+BAR_WIDTH = 40
+
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def open_spans():
+    # the spans open on this thread, outermost first, including those adopted by propagate()
+    if not hasattr(_local, 'spans'):
+        _local.spans = list()
+    return _local.spans
+
+def current():
+    spans = open_spans()
+    return spans[-1] if spans else None
+
+def record_call(operation=None):
+    # RetryPolicy.on_call; each attempt of a service call
+    with _lock:
+        for span in open_spans():
+            span.calls += 1
+
+def record_bytes(nbytes):
+    with _lock:
+        for span in open_spans():
+            span.bytes += nbytes
+
+def propagate(func):
+    # func, to be run on another thread as part of the spans now open on this one
+    adopted = list(open_spans())
+    if not adopted:
+        return func
+
+    def run(*args, **kwargs):
+        spans = open_spans()
+        depth = len(spans)
+        spans.extend(s for s in adopted if s not in spans)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            del spans[depth:]
+    return run
+
+
+class Stage(object):
+
+    def __init__(self, name, start, parent=None, attrs=None):
+        self.name = name
+        self.start = start
+        self.end = None
+        self.parent = parent
+        self.attrs = attrs or dict()
+        self.calls = 0
+        self.bytes = 0
+
+    def seconds(self):
+        return (self.end or time.time()) - self.start
+
+
+class StageTimer(object):
+
+    def __init__(self):
+        self.origin = time.time()
+        self.lock = threading.Lock()
+        self.stages = list()
+
+    @contextlib.contextmanager
+    def stage(self, name, **attrs):
+        s = Stage(name, time.time(), current(), attrs)
+        with self.lock:
+            self.stages.append(s)
+        spans = open_spans()
+        spans.append(s)
+        try:
+            yield s
+        finally:
+            s.end = time.time()
+            if s in spans:
+                spans.remove(s)
+
+    def timed(self, name, func, *args):
+        with self.stage(name):
+            return func(*args)
+
+    def finished(self, top_level=False):
+        with self.lock:
+            return [s for s in self.stages if s.end is not None and not (top_level and s.parent)]
+
+    def critical_path(self):
+        stages = sorted(self.finished(top_level=True), key=lambda s: s.end)
+        if not stages:
+            return list()
+        path = [stages[-1]]
+        while True:
+            current_stage = path[-1]
+            before = [s for s in stages if s is not current_stage and s not in path and
+                      s.end <= current_stage.start + CHAIN_SLACK_SECONDS]
+            if not before:
+                break
+            path.append(max(before, key=lambda s: s.end))
+        return list(reversed(path))
+
+    def to_dict(self, s):
+        doc = {'span': s.name, 'parent': s.parent.name if s.parent else None,
+               'start': round(s.start - self.origin, 3), 'seconds': round(s.seconds(), 3),
+               'calls': s.calls, 'bytes': s.bytes}
+        doc.update(s.attrs)
+        return doc
+
+    def to_list(self):
+        return [self.to_dict(s) for s in self.finished()]
+
+    def summary(self):
+        # name -> dict of count, seconds, calls, bytes; in order of first start
+        rows = dict()
+        for s in sorted(self.finished(), key=lambda s: s.start):
+            row = rows.setdefault(s.name, {'count': 0, 'seconds': 0.0, 'calls': 0, 'bytes': 0})
+            row['count'] += 1
+            row['seconds'] += s.seconds()
+            row['calls'] += s.calls
+            row['bytes'] += s.bytes
+        return rows
+
+    def save(self, jsonl_file, **run):
+        """
+        Append each span to the JSON lines file, with the given run fields,
+        e.g. job_id, on every line.
+        """
+        dirname = os.path.dirname(jsonl_file)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        started = datetime.datetime.utcfromtimestamp(self.origin).isoformat()
+        with open(jsonl_file, 'at') as f:
+            for doc in self.to_list():
+                line = dict(run)
+                line['run_start'] = started
+                line.update(doc)
+                f.write(json.dumps(line, sort_keys=True) + '\n')
+        return jsonl_file
+
+    def print_report(self):
+        stages = self.finished(top_level=True)
+        if not stages:
+            return
+        total = max(s.end for s in stages) - self.origin
+        critical = self.critical_path()
+        scale = BAR_WIDTH / max(total, 0.001)
+        print('stages: {:.1f}s wall clock, critical path {}'.format(
+            total, ' > '.join(s.name for s in critical)))
+        for s in sorted(stages, key=lambda s: s.start):
+            offset = int((s.start - self.origin) * scale)
+            width = max(1, int(s.seconds() * scale))
+            print('  {} {:<20} {:>7.2f}s  +{:<7.2f} |{}{}'.format(
+                '*' if s in critical else ' ', s.name, s.seconds(), s.start - self.origin,
+                ' ' * offset, '#' * width))
+        print('  {:<22} {:>6} {:>9} {:>7} {:>12}'.format('span', 'count', 'seconds', 'calls', 'bytes'))
+        for name, row in self.summary().items():
+            print('  {:<22} {:>6} {:>9.2f} {:>7} {:>12}'.format(
+                name, row['count'], row['seconds'], row['calls'], row['bytes']))
+        sys.stdout.flush()
+
+
+def read_runs(jsonl_file):
+    # job_id -> list of the span dicts of that run, in file order
+    runs = collections.OrderedDict()
+    with open(jsonl_file, 'rt') as f:
+        for line in f:
+            if line.strip():
+                doc = json.loads(line)
+                runs.setdefault(doc.get('job_id'), list()).append(doc)
+    return runs
+
+def compare_runs(jsonl_file, last=10):
+    # seconds of each top-level stage, one row per run; a regression stands out down a column
+    runs = list(read_runs(jsonl_file).items())[-last:]
+    names = list()
+    for _, spans in runs:
+        for doc in spans:
+            if doc['parent'] is None and doc['span'] not in names:
+                names.append(doc['span'])
+    print('{:<32} {}'.format('job', ' '.join('{:>12}'.format(name[:12]) for name in names)))
+    for job_id, spans in runs:
+        seconds = dict()
+        for doc in spans:
+            if doc['parent'] is None:
+                seconds[doc['span']] = seconds.get(doc['span'], 0.0) + doc['seconds']
+        print('{:<32} {}'.format(str(job_id)[:32], ' '.join(
+            '{:>12.2f}'.format(seconds[name]) if name in seconds else '{:>12}'.format('-') for name in names)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--func',  required=True,  help='compare')
+    parser.add_argument('--file',  required=False, help='The spans JSON lines file', default=DEFAULT_SPANS_FILE)
+    parser.add_argument('--last',  required=False, help='The number of most recent runs to compare', default='10')
+    args = parser.parse_args()
+
+    if args.func == 'compare':
+        compare_runs(args.file, int(args.last))
+    else:
+        print('invalid function: {}'.format(args.func))
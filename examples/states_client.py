@@ -1,6 +1,5 @@
 from __future__ import print_function
 import argparse
-import datetime 
 import json
 import os
 import sys
@@ -10,11 +9,12 @@ import traceback
 import azure.storage.blob as azureblob
 import azure.batch.batch_service_client as batch
 import azure.batch.batch_auth as batchauth
-import azure.batch.models as batchmodels
 
 sys.path.append('.')
 import helpers
+from async_batch_client import async_variant
 from batch_client import BatchClient
+import node_slots
 
 # Azure Batch client program which submits a job.
 # Chris Joakim, Microsoft, 2018/07/26
@@ -25,47 +25,59 @@ class StatesBatchClient(BatchClient):
     def __init__(self, args):
         BatchClient.__init__(self, args)
 
-    def add_tasks(self):
-        tasks = list()
+    def task_profile(self):
+        # pandas is single-threaded; the state csv files are read into memory
+        return node_slots.TaskProfile(cores=1, memory_mb=1024)
+
+    def task_output_blobs(self, task_id, input_names):
+        # states_task.py writes one results csv blob per input file
+        return dict((name, ['results-info-{}-{}-{}'.format(self.JOB_ID, task_id, name)]) for name in input_names)
+
+    def stream_inputs(self):
+        return str(getattr(self.args, 'stream', 'n')).lower() == 'y'
+
+    def stream_args(self):
+        # the task arguments to read the input blobs with ranged reads, rather than as resource files
+        if not self.stream_inputs():
+            return ''
+        read_token = self.get_container_sas_token(self.args.cin, permission=azureblob.ContainerPermissions(read=True))
+        return ' --stream y --inputcontainer {} --inputtoken "{}" --chunkkb {} --readahead {}'.format(
+            self.args.cin, read_token, self.args.chunkkb, self.args.readahead)
+
+    def generate_tasks(self):
         sas_token_cin  = self.get_container_sas_token(self.args.cin)   # input container sas token
         sas_token_clog = self.get_container_sas_token(self.args.clog)  # logging container sas token
 
         cin_container_sas_token = self.get_container_sas_token(self.args.cin)
         permission = azureblob.models.BlobPermissions(read=True, add=True, create=True, write=True, delete=True)
 
-        for idx, blob in enumerate(self.blob_input_files):
-            sas_token = self.blob_client.generate_blob_shared_access_signature(
-                self.args.cin,
-                blob.name,
-                permission=permission,
-                expiry=datetime.datetime.utcnow() + datetime.timedelta(hours=2))
-
-            sas_url = self.blob_client.make_blob_url(
-                self.args.cin,
-                blob.name,
-                sas_token=sas_token)
+        for idx, blobs in enumerate(self.input_groups()):
+            task_id = 'task{}'.format(idx+1)
+            file_args, manifest_files = self.input_file_args(task_id, [blob.name for blob in blobs])
+            resource_files = [self.blob_resource_file(self.args.cin, blob.name, permission=permission) for blob in blobs]
+            if self.stream_inputs():
+                resource_files = list()  # the task reads the blobs itself
 
-            template = 'python $AZ_BATCH_NODE_SHARED_DIR/{} --filepath {} --storageaccount {} --outputcontainer {} --outputtoken "{}" --loggingcontainer {} --loggingtoken "{}" --idx {} --dryrun {}'
+            template = '{} {} --storageaccount {} --outputcontainer {} --outputtoken "{}" --loggingcontainer {} --loggingtoken "{}" --idx {} --dryrun {}{}'
             command  = [
                 template.format(
-                    self.TASK_FILE,
-                    blob.name,
+                    self.task_command(),
+                    file_args,
                     self.STORAGE_ACCOUNT_NAME,
                     self.args.cin,
                     sas_token_cin,
                     self.args.clog,
                     sas_token_clog,
                     str(idx),
-                    self.args.dryrun
+                    self.args.dryrun,
+                    self.stream_args()
                 )
             ]
             print('command: {}'.format(command))
-            tasks.append(batch.models.TaskAddParameter(
-                'task{}'.format(idx+1),
+            yield batch.models.TaskAddParameter(
+                task_id,
                 helpers.wrap_commands_in_shell('linux', command),
-                resource_files=[batchmodels.ResourceFile(file_path=blob.name, blob_source=sas_url)]))
-
-        self.batch_client.task.add_collection(self.JOB_ID, tasks)
+                resource_files=resource_files + manifest_files)
 
 
 if __name__ == '__main__':
@@ -80,14 +92,43 @@ if __name__ == '__main__':
     parser.add_argument('--cout',      required=False, help='The name of the Output Blob Container', default='batchlog')
     parser.add_argument('--clog',      required=False, help='The name of the Logging Blob Container', default='batchlog')
     parser.add_argument('--timeout',   required=False, help='Batch job timeout period in minutes', default='30')
+    parser.add_argument('--uploadconcurrency', required=False, help='The maximum number of concurrent file uploads', default='8')
+    parser.add_argument('--uploadcache', required=False, help='Specify n to disable skipping unchanged file uploads', default='y')
+    parser.add_argument('--outputtailkb', required=False, help='Optionally collect only the last N KB of each task stdout/stderr file')
+    parser.add_argument('--reusepool', required=False, help='Specify y to reuse an idle compatible pool, and keep the pool for reuse', default='n')
+    parser.add_argument('--poolidlettl', required=False, help='Minutes a reused pool may sit idle before it is deleted', default='30')
+    parser.add_argument('--autoscale', required=False, help='Specify y to size the pool with an autoscale formula driven by pending tasks', default='n')
+    parser.add_argument('--minnodes', required=False, help='With autoscale, the minimum number of nodes', default='0')
+    parser.add_argument('--maxnodes', required=False, help='With autoscale, the maximum number of nodes; defaults to nodecount')
+    parser.add_argument('--lowpriorityshare', required=False, help='With autoscale, the fraction of nodes which may be low-priority', default='0')
+    parser.add_argument('--scaledowngrace', required=False, help='With autoscale, the minutes the backlog must stay low before the pool scales down', default='10')
+    parser.add_argument('--wheelhouse', required=False, help='Specify y to install the node packages offline from a prebuilt wheelhouse', default='n')
+    parser.add_argument('--taskslots', required=False, help='Concurrent tasks per node, or auto to size from the VM cores and memory', default='auto')
+    parser.add_argument('--nodefill', required=False, help='spread or pack tasks across nodes, or auto', default='auto')
+    parser.add_argument('--checkpoint', required=False, help='Specify n to not keep a job manifest of the state of each input', default='y')
+    parser.add_argument('--resume', required=False, help='A previous job id to resume; reattach if still running, else rerun only its failed and unfinished inputs')
+    parser.add_argument('--packkb', required=False, help='Optionally pack small input files into tasks of about N KB of input', default='0')
+    parser.add_argument('--packseconds', required=False, help='Optionally pack small input files into tasks of about N expected seconds', default='0')
+    parser.add_argument('--maxattempts', required=False, help='Attempts of each throttled or transient-failing Batch and Blob call', default='6')
+    parser.add_argument('--asyncio', required=False, help='Specify y to overlap the uploads, pool, job and task submission with asyncio', default='n')
+    parser.add_argument('--pipeline', required=False, help='Specify n to upload all input files before creating the pool and job', default='y')
+    parser.add_argument('--spansfile', required=False, help='The JSON lines file the timing spans of each run are appended to', default='tmp/spans.jsonl')
+    parser.add_argument('--stream', required=False, help='Specify y for the tasks to read the csv blobs with ranged reads, rather than staging them as resource files', default='n')
+    parser.add_argument('--chunkkb', required=False, help='With stream, the KB of each ranged blob read', default='4096')
+    parser.add_argument('--readahead', required=False, help='With stream, the chunks read ahead of the parsing', default='4')
+    parser.add_argument('--nodeworker', required=False, help='Specify y to run the tasks on a warm worker process started on each node', default='n')
     parser.add_argument('--dryrun',    required=False, help='Optionally specify y for dry-run mode with minimal task functionality', default='n')
     args = parser.parse_args()
-    batch_client = StatesBatchClient(args)
+    client_class = StatesBatchClient
+    if args.asyncio.lower() == 'y':
+        client_class = async_variant(StatesBatchClient)
+    batch_client = client_class(args)
     job_submitted = False
 
     try:
         # Add the (Python) Task script that will be executed on the Azure Batch nodes.
         batch_client.add_task_file(os.path.realpath(args.task))
+        batch_client.add_task_file(os.path.realpath('blob_stream.py'))  # imported by states_task.py
 
         blobs_to_process = dict()
         states_to_process = (args.states).split(',')
@@ -96,7 +137,7 @@ if __name__ == '__main__':
             blobs_to_process[blobname] = st
 
         blobs = batch_client.get_blobs(args.cin)
-        for blob in blobs.items:
+        for blob in blobs:
             if blob.name in blobs_to_process:
                 print('adding blob: {}'.format(blob.name))
                 batch_client.add_storage_input_blob(blob)
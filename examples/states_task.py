@@ -15,6 +15,8 @@ import pandas as pd
 
 import azure.storage.blob as azureblob
 
+import blob_stream
+
 
 # Azure Batch Task which will be executed on the Azure Batch nodes.
 # Reads the specified US_state csv blob files and calculates the mean latitude and longitude of the state. 
@@ -37,14 +39,30 @@ def write_logging_blob(client, args, name, blobtext):
     blobname = '{}-{}-{}-{}-{}.log'.format(job_id, task_id, start_epoch, name, curr_epoch)
     client.create_blob_from_text(args.loggingcontainer, blobname, blobtext)
 
+def is_stream(args):
+    # read the csv blobs from the input container, rather than the resource files
+    return str(args.stream).lower() == 'y'
+
+def input_file_paths(args):
+    # the files of a packed task are listed in a manifest, one per line
+    file_paths = list(args.filepath or list())
+    if args.manifest:
+        with open(args.manifest, 'rt') as f:
+            file_paths.extend([line.strip() for line in f if line.strip()])
+    return file_paths
 
-if __name__ == '__main__':
+
+def main(argv=None):
+    # also called by node_worker.py, in a process forked from a warm worker
+    global start_epoch
+    start_epoch = int(time.time())
 
     # 'python $AZ_BATCH_NODE_SHARED_DIR/{} --filepath {} --storageaccount {} --outputcontainer {} --outputtoken "{}" --loggingcontainer {} --loggingtoken "{}" --idx {} --dryrun {}'
 
     try:
         parser = argparse.ArgumentParser()
-        parser.add_argument('--filepath',         required=True, help='The path to the csv file to process')
+        parser.add_argument('--filepath',         required=False, action='append', help='The path to a csv file to process; may be repeated')
+        parser.add_argument('--manifest',         required=False, help='The path to a file listing the csv files to process, one per line')
         parser.add_argument('--storageaccount',   required=True, help='The name the Azure Storage account for the output and logging container.')
         parser.add_argument('--outputcontainer',  required=True, help='The Azure Blob storage container for output.')
         parser.add_argument('--outputtoken',      required=True, help='The SAS token providing write access to the output container.')
@@ -52,9 +70,17 @@ if __name__ == '__main__':
         parser.add_argument('--loggingtoken',     required=True, help='The SAS token providing write access to the logging container.')
         parser.add_argument('--idx',              required=True, help='The index number of the file within the job')
         parser.add_argument('--dryrun',           required=False, help='Optionally specify y for dry-run mode with minimal task functionality', default='n')
-        args = parser.parse_args()
-
-        output_blob_client, logging_blob_client = None, None
+        parser.add_argument('--stream',           required=False, help='Specify y to read the csv blobs from the input container, rather than local files', default='n')
+        parser.add_argument('--inputcontainer',   required=False, help='With stream, the Azure Blob storage container of the csv blobs.')
+        parser.add_argument('--inputtoken',       required=False, help='With stream, the SAS token providing read access to the input container.')
+        parser.add_argument('--chunkkb',          required=False, help='With stream, the KB of each ranged blob read', type=int, default=4096)
+        parser.add_argument('--readahead',        required=False, help='With stream, the chunks read ahead of the parsing', type=int, default=4)
+        args = parser.parse_args(argv)
+        file_paths = input_file_paths(args)
+        if not file_paths:
+            parser.error('one of --filepath or --manifest is required')
+
+        output_blob_client, logging_blob_client, input_blob_client = None, None, None
 
         if is_dryrun(args):
             print('dryrun; not creating blob clients')
@@ -69,10 +95,16 @@ if __name__ == '__main__':
                 sas_token=args.loggingtoken)
             write_logging_blob(
                 logging_blob_client, args, 'boj', 'start time is: {}'.format(start_epoch))
+            if is_stream(args):
+                input_blob_client = azureblob.BlockBlobService(
+                    account_name=args.storageaccount,
+                    sas_token=args.inputtoken)
 
         # Create and populate a dictionary for logging purposes.
         log_obj = dict()
         log_obj['args.filepath'] = args.filepath
+        log_obj['args.manifest'] = args.manifest
+        log_obj['file_paths'] = file_paths
         log_obj['args.storageaccount'] = args.storageaccount
         log_obj['args.outputcontainer'] = args.outputcontainer
         log_obj['args.outputtoken'] = args.outputtoken
@@ -80,6 +112,7 @@ if __name__ == '__main__':
         log_obj['args.loggingtoken'] = args.outputtoken
         log_obj['args.idx'] = args.idx
         log_obj['args.dryrun'] = args.dryrun
+        log_obj['args.stream'] = args.stream
         log_obj['start_epoch'] = start_epoch
 
         # Azure Batch adds some standard well-defined environment variables.
@@ -102,26 +135,38 @@ if __name__ == '__main__':
                 logging_blob_client, args, 'environment', env_json)
 
             log_obj['env'] = 'azure'
-            fq_input_file = os.path.realpath(args.filepath)
-            log_obj['fq_input_file'] = fq_input_file
-
-            # Calculate the output blob filenames
-            results_csv_filename = 'results-info-{}-{}-{}'.format(job_id, task_id, args.filepath)
             log_json_filename = 'log-info-{}-{}.json'.format(job_id, task_id)
-            log_obj['results_csv_filename'] = results_csv_filename
             log_obj['log_json_filename'] = log_json_filename
-            write_logging_blob(
-                logging_blob_client, args, 'calc-filenames', env_json)
-
-            # Use Pandas to get the geographical center of the State; the mean of longitude and latitude values.
-            df = pd.read_csv(fq_input_file, delimiter=',')
-            mean_lat = df["latitude"].mean()
-            mean_lng = df["longitude"].mean()
-            results_csv_line = '{},{},{},{},{}'.format(job_id, task_id, args.filepath, mean_lat, mean_lng)
-
-            # Write the CSV blob with the Pandas-calculated values.
-            write_output_blob(
-                output_blob_client, args, results_csv_filename, results_csv_line)
+            log_obj['fq_input_files'] = list()
+            log_obj['results_csv_filenames'] = list()
+
+            for file_path in file_paths:
+                if is_stream(args):
+                    fq_input_file = '{}/{}'.format(args.inputcontainer, file_path)
+                else:
+                    fq_input_file = os.path.realpath(file_path)
+                log_obj['fq_input_files'].append(fq_input_file)
+
+                # Calculate the output blob filename
+                results_csv_filename = 'results-info-{}-{}-{}'.format(job_id, task_id, file_path)
+                log_obj['results_csv_filenames'].append(results_csv_filename)
+                write_logging_blob(
+                    logging_blob_client, args, 'calc-filenames', env_json)
+
+                # Use Pandas to get the geographical center of the State; the mean of longitude and latitude values.
+                if is_stream(args):
+                    with blob_stream.open_binary(input_blob_client, args.inputcontainer, file_path,
+                                                 chunk_bytes=args.chunkkb * 1024, read_ahead=args.readahead) as f:
+                        df = pd.read_csv(f, delimiter=',')
+                else:
+                    df = pd.read_csv(fq_input_file, delimiter=',')
+                mean_lat = df["latitude"].mean()
+                mean_lng = df["longitude"].mean()
+                results_csv_line = '{},{},{},{},{}'.format(job_id, task_id, file_path, mean_lat, mean_lng)
+
+                # Write the CSV blob with the Pandas-calculated values.
+                write_output_blob(
+                    output_blob_client, args, results_csv_filename, results_csv_line)
 
             log_json = json.dumps(log_obj, sort_keys=True, indent=2)
             write_logging_blob(
@@ -129,3 +174,7 @@ if __name__ == '__main__':
     except:
         print(sys.exc_info())
         traceback.print_exc()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+from __future__ import print_function
+import codecs
+import concurrent.futures
+import io
+import os
+import sys
+import threading
+
+import azure.batch.models as batchmodels
+
+import stage_timer
+
+# Parallel, streaming collection of task output files (stdout.txt, stderr.txt)
+# from the compute nodes.  File content is written to disk chunk by chunk as
+# it arrives, so memory use is bounded regardless of the file sizes, and
+# optionally only the last tail_bytes of each file are fetched with a ranged
+# read.  A file which cannot be fetched is recorded in failures and
+# skipped, and the other files are still collected.  With an encoding, the
+# content is decoded from it and written as utf-8 text, rather than as the
+# raw bytes from the node.
+
+STANDARD_OUT_FILE_NAME = 'stdout.txt'
+STANDARD_ERR_FILE_NAME = 'stderr.txt'
+
+TASK_OUTPUT_SELECT = 'id,nodeInfo'
+
+
+class TaskOutputCollector(object):
+
+    def __init__(self, batch_client, job_id, output_dir='tmp', concurrency=8, tail_bytes=None,
+                 stream_names=(STANDARD_OUT_FILE_NAME, STANDARD_ERR_FILE_NAME),
+                 file_name_template='{job_id}-{task_id}-{stream_name}', encoding=None):
+        self.batch_client = batch_client
+        self.job_id = job_id
+        self.output_dir = output_dir
+        self.concurrency = max(1, int(concurrency))
+        self.tail_bytes = int(tail_bytes) if tail_bytes else None
+        self.stream_names = list(stream_names)
+        self.file_name_template = file_name_template
+        self.encoding = encoding
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.counters['files'] = 0
+        self.counters['bytes'] = 0
+        self.counters['errors'] = 0
+        self.failures = list()  # (task_id, stream_name, error) of each file not collected
+
+    def list_tasks(self):
+        # one listing, selecting only what is needed; no per-task task.get calls
+        options = batchmodels.TaskListOptions(select=TASK_OUTPUT_SELECT)
+        return self.batch_client.task.list(self.job_id, task_list_options=options)
+
+    def collect(self, tasks=None):
+        """
+        Download the output files of the given tasks (default: all tasks in
+        the job) into output_dir.  Tasks may be any iterable of CloudTask
+        objects with id and node_info.  Returns the list of files written.
+        """
+        if tasks is None:
+            tasks = self.list_tasks()
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        written = list()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = list()
+            for task in tasks:
+                node_id = task.node_info.node_id if task.node_info else None
+                print('Task: {}  Node: {}'.format(task.id, node_id))
+                for stream_name in self.stream_names:
+                    futures.append(executor.submit(stage_timer.propagate(self.download), task.id, stream_name))
+            for future in concurrent.futures.as_completed(futures):
+                output_file = future.result()
+                if output_file:
+                    written.append(output_file)
+        self.print_report()
+        return written
+
+    def output_file_path(self, task_id, stream_name):
+        file_name = self.file_name_template.format(
+            job_id=self.job_id, task_id=task_id, stream_name=stream_name)
+        return os.path.join(self.output_dir, file_name)
+
+    def download(self, task_id, stream_name):
+        output_file = self.output_file_path(task_id, stream_name)
+        try:
+            options = self.range_options(task_id, stream_name)
+            stream = self.batch_client.file.get_from_task(
+                self.job_id, task_id, stream_name, file_get_from_task_options=options)
+            nbytes = self.write_stream(stream, output_file)
+        except Exception as err:
+            if isinstance(err, batchmodels.batch_error.BatchErrorException) and err.error:
+                error = err.error.code
+            else:
+                error = '{}: {}'.format(type(err).__name__, err)
+            print('unable to get {} of task {}: {}'.format(stream_name, task_id, error))
+            if os.path.exists(output_file):
+                os.remove(output_file)  # not a partial file mistaken for the whole
+            with self.lock:
+                self.counters['errors'] += 1
+                self.failures.append((task_id, stream_name, error))
+            return None
+
+        with self.lock:
+            self.counters['files'] += 1
+            self.counters['bytes'] += nbytes
+        stage_timer.record_bytes(nbytes)
+        print('stream file written {}'.format(output_file))
+        return output_file
+
+    def write_stream(self, stream, output_file):
+        # returns the bytes received
+        nbytes = 0
+        if self.encoding is None:
+            with open(output_file, 'wb') as f:
+                for chunk in stream:
+                    f.write(chunk)
+                    nbytes += len(chunk)
+            return nbytes
+        decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+        with io.open(output_file, 'w', encoding='utf-8') as f:
+            for chunk in stream:
+                f.write(decoder.decode(chunk))
+                nbytes += len(chunk)
+            f.write(decoder.decode(b'', final=True))
+        return nbytes
+
+    def range_options(self, task_id, stream_name):
+        if not self.tail_bytes:
+            return None
+        response = self.batch_client.file.get_properties_from_task(
+            self.job_id, task_id, stream_name, raw=True)
+        length = int(response.headers.get('Content-Length', 0))
+        if length <= self.tail_bytes:
+            return None
+        return batchmodels.FileGetFromTaskOptions(
+            ocp_range='bytes={}-{}'.format(length - self.tail_bytes, length - 1))
+
+    def print_report(self):
+        c = self.counters
+        print('task output: {} files, {} bytes, {} errors'.format(c['files'], c['bytes'], c['errors']))
+        sys.stdout.flush()
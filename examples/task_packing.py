@@ -0,0 +1,80 @@
+from __future__ import print_function
+import argparse
+import os
+
+# Packing of many small input files into fewer Batch tasks.
+#
+# With one task per input file, small inputs are dominated by the fixed cost
+# of each task: scheduling, the resource file downloads, interpreter start and
+# the imports.  pack() groups the inputs into bins of a target capacity with
+# the first-fit decreasing heuristic, where the weight of an input is either
+# its size in bytes, or its expected runtime in seconds.  Each packed task is
+# given a manifest listing its files.
+#
+# python task_packing.py --dir data --packkb 64
+# python task_packing.py --dir data --packseconds 30
+
+MAX_FILES_PER_TASK = 100  # bounds the size of a task's resource file list
+
+# rough cost model of an input file; the fixed part is per file, not per task
+PER_FILE_SECONDS = 0.5
+BYTES_PER_SECOND = 256 * 1024
+
+
+def expected_seconds(nbytes, per_file_seconds=PER_FILE_SECONDS, bytes_per_second=BYTES_PER_SECOND):
+    return per_file_seconds + float(nbytes) / bytes_per_second
+
+def pack(items, weight_func, capacity, max_items=MAX_FILES_PER_TASK):
+    """
+    Group items into bins whose total weight is at most capacity, and which
+    hold at most max_items, with first-fit decreasing.  An item heavier than
+    capacity gets a bin of its own.  The items within each bin, and the bins
+    themselves, keep the original item order.  Returns a list of lists.
+    """
+    indexed = [(weight_func(item), idx, item) for idx, item in enumerate(items)]
+    indexed.sort(key=lambda t: (-t[0], t[1]))
+    bins = list()  # [total weight, [(idx, item), ...]]
+    for weight, idx, item in indexed:
+        for b in bins:
+            if b[0] + weight <= capacity and len(b[1]) < max_items:
+                b[0] += weight
+                b[1].append((idx, item))
+                break
+        else:
+            bins.append([weight, [(idx, item)]])
+    groups = [sorted(b[1], key=lambda t: t[0]) for b in bins]
+    groups.sort(key=lambda g: g[0][0])
+    return [[item for idx, item in g] for g in groups]
+
+def manifest_text(file_paths):
+    # one file path per line, relative to the task working directory
+    return ''.join('{}\n'.format(p) for p in file_paths)
+
+def print_report(groups, weight_func, unit):
+    weights = [sum(weight_func(item) for item in g) for g in groups]
+    files = sum(len(g) for g in groups)
+    if not groups:
+        print('task packing: no inputs')
+        return
+    print('task packing: {} files in {} tasks; {} per task min {:.1f} max {:.1f}'.format(
+        files, len(groups), unit, min(weights), max(weights)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir',         required=True,  help='Directory of input files to pack')
+    parser.add_argument('--packkb',      required=False, help='Target KB of input per task')
+    parser.add_argument('--packseconds', required=False, help='Target expected seconds per task')
+    args = parser.parse_args()
+
+    paths = sorted(os.path.join(args.dir, name) for name in os.listdir(args.dir))
+    paths = [p for p in paths if os.path.isfile(p)]
+    if args.packseconds:
+        weight, capacity, unit = lambda p: expected_seconds(os.path.getsize(p)), float(args.packseconds), 'seconds'
+    else:
+        weight, capacity, unit = os.path.getsize, int(args.packkb or 64) * 1024, 'bytes'
+
+    groups = pack(paths, weight, capacity)
+    for idx, group in enumerate(groups):
+        print('task{}: {}'.format(idx, ' '.join(os.path.basename(p) for p in group)))
+    print_report(groups, weight, unit)
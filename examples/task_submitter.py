@@ -0,0 +1,176 @@
+from __future__ import print_function
+import concurrent.futures
+import json
+import sys
+import threading
+import time
+
+import azure.batch.models as batchmodels
+
+from retry_policy import RETRIABLE_ERROR_CODES
+import stage_timer
+
+# Chunked, concurrent submission of Batch tasks via task.add_collection.
+#
+# The service accepts at most 100 tasks, and a serialized body of less than
+# 1MB, per add_collection request.  TaskSubmitter consumes any iterable of
+# TaskAddParameter objects (typically a generator), packs them into chunks
+# under both limits, and keeps a bounded number of chunks in flight so that
+# the full task list is never held in memory.
+
+MAX_TASKS_PER_REQUEST = 100
+MAX_BYTES_PER_REQUEST = 900 * 1024  # some headroom below the 1MB service limit
+
+
+def task_size(task):
+    # approximate serialized size of a TaskAddParameter in the request body
+    try:
+        return len(json.dumps(task.serialize()))
+    except (AttributeError, TypeError):
+        return len(str(task))
+
+
+class TaskSubmitter(object):
+
+    def __init__(self, batch_client, job_id, concurrency=4, max_tasks=MAX_TASKS_PER_REQUEST,
+                 max_bytes=MAX_BYTES_PER_REQUEST, max_attempts=5, backoff_seconds=1.0, retry_policy=None):
+        self.batch_client = batch_client
+        self.job_id = job_id
+        self.concurrency = max(1, int(concurrency))
+        self.max_tasks = min(int(max_tasks), MAX_TASKS_PER_REQUEST)
+        self.max_bytes = int(max_bytes)
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff_seconds = float(backoff_seconds)
+        self.retry_policy = retry_policy  # if given, its jittered delays and counters are used for backoff
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.counters['tasks_submitted'] = 0
+        self.counters['tasks_existing'] = 0
+        self.counters['tasks_failed'] = 0
+        self.counters['requests'] = 0
+        self.counters['retries'] = 0
+        self.counters['elapsed'] = 0.0
+        self.failures = list()  # (task_id, error code, message)
+
+    def chunks(self, tasks):
+        # the request body bytes are counted toward the open stage_timer spans
+        chunk, chunk_bytes = list(), 0
+        for task in tasks:
+            size = task_size(task)
+            if chunk and (len(chunk) >= self.max_tasks or chunk_bytes + size > self.max_bytes):
+                stage_timer.record_bytes(chunk_bytes)
+                yield chunk
+                chunk, chunk_bytes = list(), 0
+            chunk.append(task)
+            chunk_bytes += size
+        if chunk:
+            stage_timer.record_bytes(chunk_bytes)
+            yield chunk
+
+    def submit(self, tasks):
+        """
+        Submit the given iterable of TaskAddParameter objects to the job.
+        Returns the counters dict; raises RuntimeError if any task could not
+        be added after all retries.
+        """
+        t1 = time.time()
+        max_pending = self.concurrency * 2
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = set()
+            for chunk in self.chunks(tasks):
+                pending.add(executor.submit(stage_timer.propagate(self.submit_chunk), chunk))
+                if len(pending) >= max_pending:
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    self.check_futures(done)
+            done, pending = concurrent.futures.wait(pending)
+            self.check_futures(done)
+
+        self.counters['elapsed'] = time.time() - t1
+        self.print_report()
+        if self.failures:
+            for task_id, code, message in self.failures:
+                print('task add failed: {} {} {}'.format(task_id, code, message))
+            raise RuntimeError('{} tasks could not be added to job {}'.format(
+                len(self.failures), self.job_id))
+        return self.counters
+
+    def check_futures(self, futures):
+        for future in futures:
+            future.result()  # re-raises any unexpected exception from submit_chunk
+
+    def submit_chunk(self, chunk):
+        attempt = 0
+        while chunk:
+            attempt += 1
+            try:
+                result = self.add_collection(chunk, attempt)
+            except batchmodels.batch_error.BatchErrorException as err:
+                code = err.error.code if err.error else None
+                if code == 'RequestBodyTooLarge' and len(chunk) > 1:
+                    # our size estimate was too low; split the chunk and resubmit both halves
+                    half = len(chunk) // 2
+                    self.submit_chunk(chunk[:half])
+                    self.submit_chunk(chunk[half:])
+                    return
+                if code in RETRIABLE_ERROR_CODES and attempt < self.max_attempts:
+                    self.backoff(attempt, err)
+                    continue
+                raise
+            chunk = self.process_result(chunk, result, attempt)
+            if chunk:
+                self.backoff(attempt)
+
+    def add_collection(self, chunk, attempt):
+        # the only retries of add_collection are submit_chunk's; batch_client must not be a RetryingProxy
+        with self.lock:
+            self.counters['requests'] += 1
+        if self.retry_policy:
+            if attempt == 1:
+                self.retry_policy.count('task.add_collection', 'calls')
+            if self.retry_policy.on_call:
+                self.retry_policy.on_call('task.add_collection')
+        return self.batch_client.task.add_collection(self.job_id, chunk)
+
+    def process_result(self, chunk, result, attempt):
+        # returns the tasks in the chunk which should be resubmitted
+        by_id = dict((task.id, task) for task in chunk)
+        retry = list()
+        with self.lock:
+            for task_result in result.value:
+                status = task_result.status
+                code = task_result.error.code if task_result.error else None
+                if status == batchmodels.TaskAddStatus.success:
+                    self.counters['tasks_submitted'] += 1
+                elif code == 'TaskExists':
+                    # added by an earlier attempt whose response was lost
+                    self.counters['tasks_existing'] += 1
+                elif status == batchmodels.TaskAddStatus.server_error and attempt < self.max_attempts:
+                    retry.append(by_id[task_result.task_id])
+                else:
+                    message = task_result.error.message.value \
+                        if task_result.error and task_result.error.message else ''
+                    self.counters['tasks_failed'] += 1
+                    self.failures.append((task_result.task_id, code, message))
+        return retry
+
+    def backoff(self, attempt, err=None):
+        with self.lock:
+            self.counters['retries'] += 1
+        if self.retry_policy:
+            self.retry_policy.backoff('task.add_collection', attempt, err)
+        else:
+            time.sleep(self.backoff_seconds * (2 ** (attempt - 1)))
+
+    def tasks_per_second(self):
+        elapsed = self.counters['elapsed']
+        if elapsed > 0:
+            return (self.counters['tasks_submitted'] + self.counters['tasks_existing']) / elapsed
+        return 0.0
+
+    def print_report(self):
+        c = self.counters
+        print('task submission: {} added, {} existing, {} failed, {} requests, {} retries, {:.2f}s, {:.1f} tasks/s'.format(
+            c['tasks_submitted'], c['tasks_existing'], c['tasks_failed'],
+            c['requests'], c['retries'], c['elapsed'], self.tasks_per_second()))
+        sys.stdout.flush()
@@ -31,7 +31,26 @@ if __name__ == '__main__':
     parser.add_argument('--cout',      required=False, help='The name of the Output Blob Container', default='batchcsv')
     parser.add_argument('--clog',      required=False, help='The name of the Logging Blob Container', default='batchlog')
     parser.add_argument('--timeout',   required=False, help='Batch job timeout period in minutes', default='30')
+    parser.add_argument('--uploadconcurrency', required=False, help='The maximum number of concurrent file uploads', default='8')
+    parser.add_argument('--uploadcache', required=False, help='Specify n to disable skipping unchanged file uploads', default='y')
+    parser.add_argument('--outputtailkb', required=False, help='Optionally collect only the last N KB of each task stdout/stderr file')
+    parser.add_argument('--reusepool', required=False, help='Specify y to reuse an idle compatible pool, and keep the pool for reuse', default='n')
+    parser.add_argument('--poolidlettl', required=False, help='Minutes a reused pool may sit idle before it is deleted', default='30')
+    parser.add_argument('--autoscale', required=False, help='Specify y to size the pool with an autoscale formula driven by pending tasks', default='n')
+    parser.add_argument('--minnodes', required=False, help='With autoscale, the minimum number of nodes', default='0')
+    parser.add_argument('--maxnodes', required=False, help='With autoscale, the maximum number of nodes; defaults to nodecount')
+    parser.add_argument('--lowpriorityshare', required=False, help='With autoscale, the fraction of nodes which may be low-priority', default='0')
+    parser.add_argument('--scaledowngrace', required=False, help='With autoscale, the minutes the backlog must stay low before the pool scales down', default='10')
+    parser.add_argument('--wheelhouse', required=False, help='Specify y to install the node packages offline from a prebuilt wheelhouse', default='n')
+    parser.add_argument('--taskslots', required=False, help='Concurrent tasks per node, or auto to size from the VM cores and memory', default='auto')
+    parser.add_argument('--nodefill', required=False, help='spread or pack tasks across nodes, or auto', default='auto')
+    parser.add_argument('--checkpoint', required=False, help='Specify n to not keep a job manifest of the state of each input', default='y')
+    parser.add_argument('--resume', required=False, help='A previous job id to resume; reattach if still running, else rerun only its failed and unfinished inputs')
     parser.add_argument('--outdir',    required=False, help='The name of the Local Output Directory', default='out')
+    parser.add_argument('--downloadprefix', required=False, help='Optionally download only the output blobs with this name prefix')
+    parser.add_argument('--downloadconcurrency', required=False, help='The maximum number of concurrent blob downloads', default='8')
+    parser.add_argument('--maxattempts', required=False, help='Attempts of each throttled or transient-failing Batch and Blob call', default='6')
+    parser.add_argument('--nodeworker', required=False, help='Specify y to run the tasks on a warm worker process started on each node', default='n')
     args = parser.parse_args()
     print('Batch Client {} at {}'.format(__file__, datetime.datetime.utcnow()))
 
@@ -56,7 +75,7 @@ if __name__ == '__main__':
         util.list_blobs(args.ctask)
         util.list_blobs(args.cin)
         util.list_blobs(args.cout)
-        util.download_blobs_from_container(args.cout, args.outdir)
+        util.download_blobs_from_container(args.cout, args.outdir, args.downloadprefix)
 
         print()
         input('Press ENTER to delete the job and pool...')
@@ -80,7 +99,7 @@ if __name__ == '__main__':
         util.list_blobs(args.ctask)
         util.list_blobs(args.cin)
         util.list_blobs(args.cout)
-        util.download_blobs_from_container(args.cout, args.outdir)
+        util.download_blobs_from_container(args.cout, args.outdir, args.downloadprefix)
 
         print()
         input('Press ENTER to delete the job and pool...')
@@ -5,6 +5,7 @@ import datetime
 import json
 import os
 import string
+import sys
 import time
 import zipfile
 
@@ -57,7 +58,9 @@ def write_log_data(blob_client, container, log_data):
         app_events.append('ERROR in write_log_data')
 
 
-if __name__ == '__main__':
+def main(argv=None):
+    # also called by node_worker.py, in a process forked from a warm worker
+    global app_events
     print('Task {} at {}'.format(__file__, datetime.datetime.utcnow()))
     parser = argparse.ArgumentParser()
     parser.add_argument('--filepath',         required=True, help='The path to the zip file to process')
@@ -68,7 +71,7 @@ if __name__ == '__main__':
     parser.add_argument('--loggingtoken',     required=True, help='The SAS token providing write access to the Storage container.')
 
     parser.add_argument('--dev', required=True, help='Specify True if local development on macOS/Windows')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     epoch = int(time.time())
 
     print('args.filepath:         {}'.format(args.filepath))
@@ -132,3 +135,7 @@ if __name__ == '__main__':
         write_log_data(blob_client, args.outputcontainer, log_data)
     else:
         print('dev mode; no result blob processing')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,188 @@
+from __future__ import print_function
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+
+from azure.common import AzureMissingResourceHttpError
+
+# Persistent local manifest of files previously uploaded to blob storage,
+# used by BatchClient.upload_file_to_container to skip re-uploading files
+# which have not changed since the last run.
+#
+# Each entry is keyed by container and local file path, and records the
+# file size, mtime, md5 content hash, blob name and blob ETag.
+#
+# python upload_cache.py --func report
+# python upload_cache.py --func invalidate --path data/NC1.zip
+# python upload_cache.py --func invalidate --container batchzips
+# python upload_cache.py --func clear
+
+DEFAULT_MANIFEST_FILE = 'tmp/upload_cache.json'
+REPORT_SAMPLES = 3  # file names listed per hit or miss reason in report()
+
+
+def file_md5(file_path, chunk_size=1024 * 1024):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class UploadCache(object):
+
+    def __init__(self, manifest_file=DEFAULT_MANIFEST_FILE, verify_remote=True):
+        self.manifest_file = manifest_file
+        self.verify_remote = verify_remote  # HEAD the blob to confirm its ETag before skipping
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.hits = list()
+        self.misses = list()
+        self.load()
+
+    def entry_key(self, container_name, file_path):
+        return '{}|{}'.format(container_name, os.path.realpath(file_path))
+
+    def load(self):
+        if os.path.isfile(self.manifest_file):
+            with open(self.manifest_file, 'rt') as f:
+                self.entries = json.load(f)
+        return self.entries
+
+    def save(self):
+        with self.lock:
+            dirname = os.path.dirname(self.manifest_file)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            tmp_file = self.manifest_file + '.tmp'
+            with open(tmp_file, 'wt') as f:
+                f.write(json.dumps(self.entries, sort_keys=True, indent=2))
+            os.replace(tmp_file, self.manifest_file)
+
+    def lookup(self, blob_client, container_name, file_path, blob_name):
+        """
+        Return the cached entry if the local file and the blob are both
+        unchanged since the recorded upload, otherwise None.  Records the
+        lookup as a hit or a miss for report().
+        """
+        key = self.entry_key(container_name, file_path)
+        with self.lock:
+            entry = self.entries.get(key)
+        reason = self.stale_reason(blob_client, container_name, file_path, blob_name, entry)
+        with self.lock:
+            if reason:
+                self.misses.append((file_path, reason))
+                return None
+            self.hits.append((file_path, 'unchanged'))
+            return entry
+
+    def stale_reason(self, blob_client, container_name, file_path, blob_name, entry):
+        if entry is None:
+            return 'not cached'
+        if entry['blob_name'] != blob_name:
+            return 'blob name changed'
+        stat = os.stat(file_path)
+        if stat.st_size != entry['size']:
+            return 'size changed'
+        if stat.st_mtime != entry['mtime']:
+            # touched, but the content may be the same; compare the hashes
+            md5 = file_md5(file_path)
+            if md5 != entry['md5']:
+                return 'content changed'
+            with self.lock:
+                entry['mtime'] = stat.st_mtime
+        if self.verify_remote:
+            try:
+                blob = blob_client.get_blob_properties(container_name, blob_name)
+            except AzureMissingResourceHttpError:
+                return 'blob missing'
+            if blob.properties.etag != entry['etag']:
+                return 'blob etag changed'
+        return None
+
+    def record(self, container_name, file_path, blob_name, etag):
+        stat = os.stat(file_path)
+        entry = dict()
+        entry['container'] = container_name
+        entry['file_path'] = os.path.realpath(file_path)
+        entry['blob_name'] = blob_name
+        entry['size'] = stat.st_size
+        entry['mtime'] = stat.st_mtime
+        entry['md5'] = file_md5(file_path)
+        entry['etag'] = etag
+        entry['uploaded_epoch'] = int(time.time())
+        with self.lock:
+            self.entries[self.entry_key(container_name, file_path)] = entry
+        return entry
+
+    def invalidate(self, file_path=None, container_name=None):
+        # removes the entries matching the given file path and/or container; returns the removed count
+        realpath = os.path.realpath(file_path) if file_path else None
+        with self.lock:
+            keys = [k for k, e in self.entries.items()
+                    if (realpath is None or e['file_path'] == realpath) and
+                    (container_name is None or e['container'] == container_name)]
+            for key in keys:
+                del self.entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            count = len(self.entries)
+            self.entries = dict()
+        return count
+
+    def report(self):
+        # the lookups since the previous report: counts per reason, with a few sample file names
+        with self.lock:
+            hits, misses = self.hits, self.misses
+            self.hits, self.misses = list(), list()
+        print('upload cache: {} hits, {} misses, {} entries in {}'.format(
+            len(hits), len(misses), len(self.entries), self.manifest_file))
+        for kind, lookups in [('hit', hits), ('miss', misses)]:
+            by_reason = dict()
+            for file_path, reason in lookups:
+                by_reason.setdefault(reason, list()).append(file_path)
+            for reason in sorted(by_reason.keys()):
+                file_paths = by_reason[reason]
+                more = len(file_paths) - REPORT_SAMPLES
+                print('  {}: {} {}, e.g. {}{}'.format(
+                    kind, len(file_paths), reason, ', '.join(file_paths[:REPORT_SAMPLES]),
+                    ' and {} more'.format(more) if more > 0 else ''))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--func',      required=True,  help='report, invalidate, or clear')
+    parser.add_argument('--manifest',  required=False, help='The upload cache manifest file', default=DEFAULT_MANIFEST_FILE)
+    parser.add_argument('--path',      required=False, help='The local file path to invalidate')
+    parser.add_argument('--container', required=False, help='The Blob Container to invalidate')
+    args = parser.parse_args()
+
+    cache = UploadCache(args.manifest)
+
+    if args.func == 'report':
+        for key in sorted(cache.entries.keys()):
+            e = cache.entries[key]
+            print('{} -> {}/{}  size: {}  md5: {}  etag: {}'.format(
+                e['file_path'], e['container'], e['blob_name'], e['size'], e['md5'], e['etag']))
+        print('{} entries'.format(len(cache.entries)))
+
+    elif args.func == 'invalidate':
+        if args.path or args.container:
+            count = cache.invalidate(args.path, args.container)
+            cache.save()
+            print('{} entries invalidated'.format(count))
+        else:
+            print('specify --path and/or --container to invalidate')
+
+    elif args.func == 'clear':
+        count = cache.clear()
+        cache.save()
+        print('{} entries cleared'.format(count))
+
+    else:
+        print('invalid function: {}'.format(args.func))
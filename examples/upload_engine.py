@@ -0,0 +1,141 @@
+from __future__ import print_function
+import concurrent.futures
+import os
+import sys
+import threading
+import time
+
+import stage_timer
+
+# Parallel, bounded-concurrency upload stage used by BatchClient to stage
+# task scripts and local input files in Azure Blob Storage.
+#
+# The per-file work (upload, SAS token, ResourceFile) is a callable supplied
+# by the caller, typically BatchClient.upload_file_to_container, so this
+# module only deals with concurrency, retries and progress counters.
+
+
+class UploadResult(object):
+
+    def __init__(self, index, file_path):
+        self.index = index
+        self.file_path = file_path
+        self.value = None      # the return value of the upload function, i.e. - a ResourceFile
+        self.attempts = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.error = None
+
+    def succeeded(self):
+        return self.error is None
+
+
+class ParallelUploader(object):
+
+    def __init__(self, upload_func, concurrency=8, max_attempts=3, backoff_seconds=1.0, verbose=True):
+        # upload_func is called as upload_func(container_name, file_path)
+        self.upload_func = upload_func
+        self.concurrency = max(1, int(concurrency))
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff_seconds = float(backoff_seconds)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.counters = dict()
+        self.counters['files_total'] = 0
+        self.counters['files_done'] = 0
+        self.counters['files_failed'] = 0
+        self.counters['retries'] = 0
+        self.counters['bytes_total'] = 0
+        self.counters['bytes_done'] = 0
+        self.counters['elapsed'] = 0.0
+
+    def upload(self, container_name, file_paths, on_complete=None):
+        """
+        Upload the given local files to the container, with at most
+        self.concurrency uploads in flight.  Returns the upload function
+        values (ResourceFiles) in the same order as file_paths.
+        The optional on_complete callback receives each UploadResult
+        as soon as its file is done.
+        """
+        results = self.upload_results(container_name, file_paths, on_complete)
+        failures = [r for r in results if not r.succeeded()]
+        if failures:
+            for r in failures:
+                print('upload failed: {} -> {}'.format(r.file_path, r.error))
+            raise RuntimeError('{} of {} uploads to container {} failed'.format(
+                len(failures), len(results), container_name))
+        return [r.value for r in results]
+
+    def upload_results(self, container_name, file_paths, on_complete=None):
+        file_paths = list(file_paths)
+        results = [None] * len(file_paths)
+        with self.lock:
+            self.counters['files_total'] += len(file_paths)
+            for file_path in file_paths:
+                self.counters['bytes_total'] += self.file_size(file_path)
+
+        t1 = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = list()
+            for idx, file_path in enumerate(file_paths):
+                futures.append(executor.submit(stage_timer.propagate(self.upload_one), container_name, idx, file_path))
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                results[result.index] = result
+                self.print_progress()
+                if on_complete:
+                    on_complete(result)
+
+        with self.lock:
+            self.counters['elapsed'] += time.time() - t1
+        return results
+
+    def upload_one(self, container_name, idx, file_path):
+        result = UploadResult(idx, file_path)
+        result.bytes = self.file_size(file_path)
+        t1 = time.time()
+        while result.attempts < self.max_attempts:
+            result.attempts += 1
+            try:
+                result.value = self.upload_func(container_name, file_path)
+                result.error = None
+                break
+            except Exception as e:
+                result.error = e
+                if result.attempts < self.max_attempts:
+                    with self.lock:
+                        self.counters['retries'] += 1
+                    time.sleep(self.backoff_seconds * (2 ** (result.attempts - 1)))
+        result.elapsed = time.time() - t1
+
+        with self.lock:
+            if result.succeeded():
+                self.counters['files_done'] += 1
+                self.counters['bytes_done'] += result.bytes
+            else:
+                self.counters['files_failed'] += 1
+        return result
+
+    def file_size(self, file_path):
+        try:
+            return os.path.getsize(file_path)
+        except OSError:
+            return 0
+
+    def throughput(self):
+        # bytes per second, over the wall-clock time spent in upload_results()
+        elapsed = self.counters['elapsed']
+        if elapsed > 0:
+            return self.counters['bytes_done'] / elapsed
+        return 0.0
+
+    def print_progress(self):
+        if self.verbose:
+            c = self.counters
+            print('upload progress: {}/{} files, {}/{} bytes, {} failed, {} retries'.format(
+                c['files_done'], c['files_total'], c['bytes_done'], c['bytes_total'],
+                c['files_failed'], c['retries']))
+            sys.stdout.flush()
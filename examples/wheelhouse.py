@@ -0,0 +1,258 @@
+from __future__ import print_function
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+import azure.batch.batch_service_client as batch
+import azure.batch.batch_auth as batchauth
+import azure.batch.models as batchmodels
+
+# A prebuilt wheelhouse of the node Python packages, so that the pool start
+# task installs them offline from a single staged resource file, rather than
+# bootstrapping pip from the internet and resolving each package from PyPI on
+# every node.
+#
+# The wheels are downloaded for the node's platform and Python, and packed
+# with a requirements file pinning every wheel by its sha256 hash into a
+# deterministic tar.gz.  On the node the start task verifies the tarball's
+# hash, installs with --no-index --require-hashes, and leaves a marker in the
+# node-shared directory, so a node which already has a matching install (for
+# example after a reboot) skips it.
+#
+# python wheelhouse.py --func build
+# python wheelhouse.py --func build --requirements node_requirements.txt
+# python wheelhouse.py --func build --buildpython ~/.pyenv/versions/2.7.18/bin/python
+# python wheelhouse.py --func commands
+# python wheelhouse.py --func bootstrap --pools statespool_1537000000,statespool_1537000900
+
+DEFAULT_REQUIREMENTS_FILE = 'node_requirements.txt'
+DEFAULT_OUTPUT_DIR = 'tmp/wheelhouse'
+
+# the Python which runs the start task and the tasks; python is 2.7 on the Ubuntu 16.04 image
+NODE_PLATFORM = 'manylinux1_x86_64'
+NODE_PYTHON_VERSION = '27'
+NODE_PYTHON_ABI = 'cp27mu'
+
+# pip wheel builds for the interpreter running it, and has no --python-version;
+# the sdists are therefore built by a Python 2.7, like the nodes', not this client's Python 3
+NODE_BUILD_PYTHON = os.environ.get('WHEELHOUSE_BUILD_PYTHON', 'python2.7')
+
+NODE_SHARED_WHEELHOUSE_DIR = '$AZ_BATCH_NODE_SHARED_DIR/wheelhouse'
+
+
+def read_requirements(requirements_file=DEFAULT_REQUIREMENTS_FILE):
+    requirements = list()
+    with open(requirements_file, 'rt') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if line:
+                requirements.append(line)
+    return requirements
+
+def file_sha256(file_path):
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def wheel_name_and_version(wheel_file):
+    # {name}-{version}(-{build})?-{python}-{abi}-{platform}.whl
+    parts = os.path.basename(wheel_file).split('-')
+    return parts[0], parts[1]
+
+
+class Wheelhouse(object):
+
+    def __init__(self, tarball, sha256, pip_wheel):
+        self.tarball = tarball      # local path of the tar.gz
+        self.sha256 = sha256        # hash of the tar.gz, checked on the node
+        self.pip_wheel = pip_wheel  # file name of the pip wheel in the tarball, used to bootstrap pip
+
+    def blob_name(self):
+        return os.path.basename(self.tarball)
+
+    def install_commands(self):
+        """
+        The start task commands which install the wheelhouse, staged as a
+        resource file in the start task working directory.  These are
+        wrapped in single quotes by wrap_commands_in_shell, so use only
+        double quotes.
+        """
+        install_dir = '{}/{}'.format(NODE_SHARED_WHEELHOUSE_DIR, self.sha256)
+        marker = '{}.installed'.format(install_dir)
+        install = [
+            'echo "{}  {}" | sha256sum -c -'.format(self.sha256, self.blob_name()),
+            'rm -rf {}'.format(install_dir),
+            'mkdir -p {}'.format(install_dir),
+            'tar -xzf {} -C {}'.format(self.blob_name(), install_dir),
+            'python {}/{}/pip install --no-index --find-links {} --require-hashes -r {}/requirements.txt'.format(
+                install_dir, self.pip_wheel, install_dir, install_dir),
+            'touch {}'.format(marker)]
+        return ['if [ -f {} ]; then echo "wheelhouse {} already installed"; else {}; fi'.format(
+            marker, self.sha256[:12], '; '.join(install))]
+
+    def to_dict(self):
+        return {'tarball': self.tarball, 'sha256': self.sha256, 'pip_wheel': self.pip_wheel}
+
+
+def build_key(requirements, platform, python_version, abi):
+    doc = {'requirements': sorted(requirements), 'platform': platform,
+           'python_version': python_version, 'abi': abi}
+    return hashlib.sha256(json.dumps(doc, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def pip_download(requirements, wheel_dir, platform, python_version, abi, no_deps=False):
+    cmd = [sys.executable, '-m', 'pip', 'download', '--dest', wheel_dir, '--find-links', wheel_dir,
+           '--only-binary=:all:', '--platform', platform, '--python-version', python_version,
+           '--implementation', 'cp', '--abi', abi]
+    if no_deps:
+        cmd.append('--no-deps')
+    return subprocess.call(cmd + list(requirements)) == 0
+
+def node_compatible(wheel_file, python_version=NODE_PYTHON_VERSION):
+    # a wheel built from an sdist must be pure python, and tagged for the nodes' Python 2.7
+    parts = os.path.basename(wheel_file)[:-len('.whl')].split('-')
+    pythons, abi, platform = parts[-3].split('.'), parts[-2], parts[-1]
+    tags = ['py' + python_version[0], 'py' + python_version]
+    return abi == 'none' and platform == 'any' and any(tag in tags for tag in pythons)
+
+def pip_wheel(requirement, wheel_dir, build_python=NODE_BUILD_PYTHON):
+    # builds a wheel from an sdist with the nodes' Python 2.7; only correct for pure-python packages
+    cmd = [build_python, '-m', 'pip', 'wheel', '--no-deps', '--wheel-dir', wheel_dir, requirement]
+    try:
+        return subprocess.call(cmd) == 0
+    except OSError as e:
+        raise RuntimeError('unable to run {} to build {}: {}'.format(build_python, requirement, e))
+
+def download_wheels(requirements, wheel_dir, platform, python_version, abi, build_python=NODE_BUILD_PYTHON):
+    # packages published only as an sdist are built locally, then the full
+    # dependency closure is resolved against those and the binary wheels on PyPI
+    for requirement in requirements:
+        if not pip_download([requirement], wheel_dir, platform, python_version, abi, no_deps=True):
+            print('no binary wheel for {}; building it from the sdist with {}'.format(requirement, build_python))
+            existing = set(os.listdir(wheel_dir))
+            if not pip_wheel(requirement, wheel_dir, build_python):
+                raise RuntimeError('unable to build a wheel for {}'.format(requirement))
+            for wheel in set(os.listdir(wheel_dir)) - existing:
+                if wheel.endswith('.whl') and not node_compatible(wheel, python_version):
+                    raise RuntimeError('{} built {}, which the cp{} nodes cannot install'.format(
+                        build_python, wheel, python_version))
+    if not pip_download(requirements, wheel_dir, platform, python_version, abi):
+        raise RuntimeError('unable to download the dependencies of {}'.format(requirements))
+
+def write_hashed_requirements(wheel_dir):
+    # every wheel in the closure, pinned by hash, for pip install --require-hashes
+    lines = list()
+    for wheel in sorted(os.listdir(wheel_dir)):
+        if wheel.endswith('.whl'):
+            name, version = wheel_name_and_version(wheel)
+            lines.append('{}=={} --hash=sha256:{}'.format(
+                name, version, file_sha256(os.path.join(wheel_dir, wheel))))
+    with open(os.path.join(wheel_dir, 'requirements.txt'), 'wt') as f:
+        f.write('\n'.join(lines) + '\n')
+    return lines
+
+def write_tarball(wheel_dir, tarball):
+    # sorted members, and fixed owners and times, so the same wheels give the same hash
+    with open(tarball, 'wb') as raw:
+        with gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0) as gz:
+            with tarfile.open(fileobj=gz, mode='w') as tar:
+                for name in sorted(os.listdir(wheel_dir)):
+                    info = tar.gettarinfo(os.path.join(wheel_dir, name), arcname=name)
+                    info.mtime, info.uid, info.gid, info.uname, info.gname = 0, 0, 0, '', ''
+                    with open(os.path.join(wheel_dir, name), 'rb') as f:
+                        tar.addfile(info, f)
+    return tarball
+
+def build(requirements_file=DEFAULT_REQUIREMENTS_FILE, output_dir=DEFAULT_OUTPUT_DIR,
+          platform=NODE_PLATFORM, python_version=NODE_PYTHON_VERSION, abi=NODE_PYTHON_ABI, rebuild=False,
+          build_python=NODE_BUILD_PYTHON):
+    """
+    Build, or reuse a previous build of, the wheelhouse for the given
+    requirements file and node platform.  Returns a Wheelhouse.
+    """
+    requirements = read_requirements(requirements_file) + ['pip']
+    key = build_key(requirements, platform, python_version, abi)
+    tarball = os.path.join(output_dir, 'wheelhouse-{}.tar.gz'.format(key))
+    manifest_file = os.path.join(output_dir, 'wheelhouse-{}.json'.format(key))
+
+    if not rebuild and os.path.isfile(tarball) and os.path.isfile(manifest_file):
+        with open(manifest_file, 'rt') as f:
+            manifest = json.load(f)
+        if manifest['sha256'] == file_sha256(tarball):
+            print('reusing wheelhouse {}'.format(tarball))
+            return Wheelhouse(tarball, manifest['sha256'], manifest['pip_wheel'])
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    wheel_dir = tempfile.mkdtemp(prefix='wheelhouse-', dir=output_dir)
+    try:
+        print('building wheelhouse for {} on {} cp{}'.format(requirements_file, platform, python_version))
+        download_wheels(requirements, wheel_dir, platform, python_version, abi, build_python)
+        pip_wheels = [w for w in os.listdir(wheel_dir) if w.startswith('pip-') and w.endswith('.whl')]
+        if not pip_wheels:
+            raise RuntimeError('no pip wheel in the wheelhouse')
+        lines = write_hashed_requirements(wheel_dir)
+        write_tarball(wheel_dir, tarball)
+    finally:
+        for name in os.listdir(wheel_dir):
+            os.remove(os.path.join(wheel_dir, name))
+        os.rmdir(wheel_dir)
+
+    wheelhouse = Wheelhouse(tarball, file_sha256(tarball), pip_wheels[0])
+    with open(manifest_file, 'wt') as f:
+        f.write(json.dumps(wheelhouse.to_dict(), sort_keys=True, indent=2))
+    print('wheelhouse {}: {} wheels, {} bytes, sha256 {}'.format(
+        tarball, len(lines), os.path.getsize(tarball), wheelhouse.sha256))
+    return wheelhouse
+
+def start_task_durations(batch_client, pool_id):
+    # seconds from start to end of the start task on each node which has completed it
+    durations = list()
+    options = batchmodels.ComputeNodeListOptions(select='id,startTaskInfo')
+    for node in batch_client.compute_node.list(pool_id, compute_node_list_options=options):
+        info = node.start_task_info
+        if info and info.start_time and info.end_time:
+            durations.append((info.end_time - info.start_time).total_seconds())
+    return durations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--func',         required=True,  help='build, commands, or bootstrap')
+    parser.add_argument('--requirements', required=False, help='The node requirements file', default=DEFAULT_REQUIREMENTS_FILE)
+    parser.add_argument('--rebuild',      required=False, help='Specify y to rebuild an existing wheelhouse', default='n')
+    parser.add_argument('--pools',        required=False, help='Comma-separated pool ids to compare start task times')
+    parser.add_argument('--buildpython',  required=False, help='The Python 2.7 interpreter which builds wheels from sdists', default=NODE_BUILD_PYTHON)
+    args = parser.parse_args()
+
+    if args.func == 'build':
+        build(args.requirements, rebuild=(args.rebuild.lower() == 'y'), build_python=args.buildpython)
+
+    elif args.func == 'commands':
+        for command in build(args.requirements, build_python=args.buildpython).install_commands():
+            print(command)
+
+    elif args.func == 'bootstrap':
+        # node bootstrap time of pools created with and without --wheelhouse y
+        credentials = batchauth.SharedKeyCredentials(
+            os.environ["AZURE_BATCH_ACCOUNT"], os.environ["AZURE_BATCH_KEY"])
+        batch_client = batch.BatchServiceClient(credentials, base_url=os.environ["AZURE_BATCH_URL"])
+        print('{:<40} {:>6} {:>8} {:>8} {:>8}'.format('pool', 'nodes', 'min', 'median', 'max'))
+        for pool_id in args.pools.split(','):
+            durations = start_task_durations(batch_client, pool_id)
+            if durations:
+                print('{:<40} {:>6} {:>8.1f} {:>8.1f} {:>8.1f}'.format(
+                    pool_id, len(durations), min(durations), statistics.median(durations), max(durations)))
+            else:
+                print('{:<40} no completed start tasks'.format(pool_id))
+
+    else:
+        print('invalid function: {}'.format(args.func))